@@ -3,6 +3,10 @@ import numpy as np
 from random import shuffle
 import random
 import pickle
+import sys
+# Scripts run from their own directory, utils are in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.label_bitsets import from_tags, to_tags, words_for
 
 images = []
 
@@ -52,17 +56,20 @@ for (l, a) in keptlabels:
 #labels = labels[-21:]
 
 labels_ids = {}
+tag_ids = {}
 with open('labels.txt', 'w') as f:
     i = 0
     for (l, a) in reversed(labels):
         id = 1 << i
         print("{0} {1}".format(id, l))
+        tag_ids[l] = i
         i += 1
         labels_ids[l] = id
 
 print(labels_ids)
 
 items = {}
+label_words = words_for(len(labels))
 number_of_two_and_more = 0
 
 categorized = {key: [] for (key, _) in labels}
@@ -75,15 +82,18 @@ print('kept labels {}'.format(keptlabels))
 
 for i in range(len(content)):
     label = 0
+    tags = []
     k = 0
     for (l, a) in labels:
         if a[i] == 1:
             label |= labels_ids[l]
+            tags.append(tag_ids[l])
             k += 1
     if k > 1:
         number_of_two_and_more += 1
     if label != 0 and content[i] in images and (label & bitfilter) != 0:
-        items[i] = ((label, content[i]))
+        # Items keep labels as bitsets of all tags
+        items[i] = ((from_tags([tags], label_words)[0], content[i]))
         #print((label, content[i]))
         for l, id in labels_ids.items():
             if (label & id) != 0:
@@ -199,8 +209,9 @@ def generate(style):
             for (label,fname) in data:
                 fname = fname.replace('\\','/')
                 outF.write('{}/out/{} '.format(os.getcwd(),fname))
+                tags = set(to_tags(label))
                 for i in range(81):
-                    if label & (1<<i) == 0:
+                    if i not in tags:
                         outF.write('0 ')
                     else:
                         outF.write('1 ')
@@ -19,8 +19,28 @@ cimport numpy as np
 cimport cython
 from utils.timer import timer
 from hashranking import hamming
+from utils.label_bitsets import to_bitsets
+
+cdef extern int __builtin_popcountll(unsigned long long) nogil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint __share_tag(np.uint64_t[:, ::1] a, np.intp_t i, np.uint64_t[:, ::1] b, np.intp_t j, np.intp_t words):
+    cdef np.uint64_t common = 0
+    for k in range(words):
+        common |= a[i, k] & b[j, k]
+    return common != 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int __shared_tags(np.uint64_t[:, ::1] a, np.intp_t i, np.uint64_t[:, ::1] b, np.intp_t j, np.intp_t words):
+    cdef int count = 0
+    for k in range(words):
+        count += __builtin_popcountll(a[i, k] & b[j, k])
+    return count
 
-cdef extern int __builtin_popcount(unsigned int) nogil
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -86,13 +106,14 @@ cdef __calc_map(np.int32_t[:,::1] order, np.int32_t[:,::1] labels_train, np.int3
 #@timer
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef __calc_map_and(np.int32_t[:, ::1] order, np.uint64_t[::1] labels_trainL, np.uint64_t[::1] labels_trainH, np.uint64_t[::1] labels_testL, np.uint64_t[::1] labels_testH, int top_n):
+cdef __calc_map_and(np.int32_t[:, ::1] order, np.uint64_t[:, ::1] labels_train, np.uint64_t[:, ::1] labels_test, int top_n):
     """compute mean average precision (MAP)"""
 
     cdef np.float32_t map = <float>0.0
 
     cdef np.intp_t Q = order.shape[0]
     cdef np.intp_t N = order.shape[1]
+    cdef np.intp_t words = min(labels_train.shape[1], labels_test.shape[1])
 
     if top_n == 0:
         top_n = N
@@ -115,7 +136,7 @@ cdef __calc_map_and(np.int32_t[:, ::1] order, np.uint64_t[::1] labels_trainL, np
     for q in range(Q):
         for i in range(top_n):
             index = order[q, i]
-            relevance[i] = <float>1.0 if ((labels_testL[q] & labels_trainL[index]) | (labels_testH[q] & labels_trainH[index])) != <unsigned int>0 else <float>0.0
+            relevance[i] = <float>1.0 if __share_tag(labels_test, q, labels_train, index, words) else <float>0.0
         cumulative = np.cumsum(relevance)
         number_of_relative_docs = cumulative[top_n-1]
 
@@ -123,7 +144,7 @@ cdef __calc_map_and(np.int32_t[:, ::1] order, np.uint64_t[::1] labels_trainL, np
 
         for i in range(N):
             index = order[q, i]
-            total_number_of_relevant_documents += <float>1.0 if ((labels_testL[q] & labels_trainL[index]) | (labels_testH[q] & labels_trainH[index])) != <unsigned int>0 else <float>0.0
+            total_number_of_relevant_documents += <float>1.0 if __share_tag(labels_test, q, labels_train, index, words) else <float>0.0
 
         if number_of_relative_docs != 0:
             precision = cumulative / pos
@@ -147,38 +168,37 @@ cdef __calc_map_and(np.int32_t[:, ::1] order, np.uint64_t[::1] labels_trainL, np
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef __calc_map_weighted(np.int32_t[:,::1] order,np.int32_t[:,::1] labels_train,np.int32_t[:,::1] labels_test):
+cdef __calc_map_weighted(np.int32_t[:,::1] order, np.uint64_t[:, ::1] labels_train, np.uint64_t[:, ::1] labels_test, int top_n):
 
     cdef np.float32_t map = <float>0.0
 
     cdef np.intp_t Q = order.shape[0]
     cdef np.intp_t N = order.shape[1]
+    cdef np.intp_t words = min(labels_train.shape[1], labels_test.shape[1])
+
+    if top_n == 0:
+        top_n = N
 
     cdef np.intp_t relCount = 0
     cdef np.float32_t ap = <float>0.0
 
     cdef int index
     cdef int rel
-    cdef np.float32_t acg
-
-
+    cdef int acg
 
     for q in range(Q):
         relCount = 0
         ap = <float>0.0
-        for i in range(100):
+        # Accumulated gain of all items ranked so far, so ACG at rank i is acg / (i + 1)
+        acg = 0
+        for i in range(top_n):
             index = order[q,i]
-            rel = __builtin_popcount(labels_train[index,0]&labels_test[q,0])
+            rel = min(__shared_tags(labels_test, q, labels_train, index, words), 255)
+            acg += rel
 
             if (rel > 0):
                 relCount += 1
-                acg = rel
-                for n in range(i-1,0,-1):
-                    index = order[q,n]
-                    acg += __builtin_popcount(labels_train[index,0]&labels_test[q,0])
-                acg/= i+1
-
-                ap+= acg
+                ap += <float>acg / (i+1)
         if relCount > 0:
             ap /= relCount
             map += ap
@@ -187,49 +207,220 @@ cdef __calc_map_weighted(np.int32_t[:,::1] order,np.int32_t[:,::1] labels_train,
 
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def labeles_to_two_64bword(np.ndarray labels):
-    cdef np.intp_t N = labels.shape[0]
-    cdef np.uint64_t[::1] outh = np.zeros(N, dtype=np.uint64)
-    cdef np.uint64_t[::1] outl = np.zeros(N, dtype=np.uint64)
-    for i in range(N):
-        outh[i] = (np.uint64)((labels[i] >> 64) & 0xFFFFFFFFFFFFFFFF)
-        outl[i] = (np.uint64)((labels[i]) & 0xFFFFFFFFFFFFFFFF)
-    return outl, outh
+def prepare_labels(labels, and_mode, weighted_mode=False):
+    """Convert labels to the form that calc_map_prepared expects: label bitsets of shape [count, words] for "and"
+    and weighted comparison (see utils.label_bitsets), int32 array of shape [count, 1] otherwise. Conversion of
+    labels given as Python ints is slow, so when MAP is computed in chunks, it is done once"""
+    if and_mode or weighted_mode:
+        return to_bitsets(labels)
+    else:
+        return np.ascontiguousarray(np.asarray(labels).reshape(-1, 1), dtype=np.int32)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def calc_map(order, labels_train, labels_test, top_n, and_mode,weighted_mode = False):
-
+def calc_map_prepared(order, labels_train, labels_test, top_n, and_mode, weighted_mode=False):
+    """Same as calc_map, but labels are already converted with prepare_labels"""
+    order = np.ascontiguousarray(order, dtype=np.int32)
     if and_mode:
-        labels_trainL, labels_trainH = labeles_to_two_64bword(labels_train)
-        labels_testL, labels_testH = labeles_to_two_64bword(labels_test)
-        return __calc_map_and(order.astype(np.int32), labels_trainL, labels_trainH, labels_testL, labels_testH, top_n)
+        return __calc_map_and(order, labels_train, labels_test, top_n)
     elif not weighted_mode:
-        return __calc_map(order.astype(np.int32), labels_train.astype(np.int32), labels_test.astype(np.int32), top_n)
+        return __calc_map(order, labels_train, labels_test, top_n)
     else:
-        return __calc_map_weighted(order.astype(np.int32),labels_train.astype(np.int32),labels_test.astype(np.int32))
+        return __calc_map_weighted(order, labels_train, labels_test, top_n)
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def calc_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode,weighted_mode=False):
+def calc_map(order, labels_train, labels_test, top_n, and_mode,weighted_mode = False):
+    return calc_map_prepared(order,
+                             prepare_labels(labels_train, and_mode, weighted_mode),
+                             prepare_labels(labels_test, and_mode, weighted_mode),
+                             top_n, and_mode, weighted_mode)
+
+
+def hash_storage(bits):
+    """Return HashRankingContext storage id for the given hash length: 32bit, 64bit or multi-word"""
+    if bits > 64:
+        return 2
+    return 1 if bits > 32 else 0
+
+
+class MapContext:
+    """HashRankingContext that is kept between evaluations on the same labels. Labels are converted and loaded
+    once, and the buffers are reused, so each evaluation only loads the hashes. Use one context per thread.
+    If prepared is set, labels are already converted with prepare_labels. thread_count limits the ranking threads,
+    all cores are used by default"""
+    def __init__(self, labels_train, labels_test, and_mode, weighted_mode=False, prepared=False, thread_count=None):
+        self.and_mode = and_mode
+        self.thread_count = thread_count
+        self.bitsets = and_mode or weighted_mode
+        self.lc = 1 if and_mode else 0 if not weighted_mode else 2
+        if not prepared:
+            labels_train = prepare_labels(labels_train, and_mode, weighted_mode)
+            labels_test = prepare_labels(labels_test, and_mode, weighted_mode)
+        if self.bitsets:
+            self.labels_train = labels_train
+            self.labels_test = labels_test
+        else:
+            self.labels_train = np.ascontiguousarray(labels_train, dtype=np.int32).reshape(-1).view(np.uint32)
+            self.labels_test = np.ascontiguousarray(labels_test, dtype=np.int32).reshape(-1).view(np.uint32)
+        self.db_size = self.labels_train.shape[0]
+        self.query_size = self.labels_test.shape[0]
+        self.hr = None
+        self.bits = None
+
+    def init(self, bits):
+        """Allocate buffers for hashes of given length and load the labels"""
+        self.hr = hamming.HashRankingContext()
+        self.hr.Init(self.db_size, self.query_size, hash_storage(bits), self.lc, bits)
+        if self.thread_count is not None:
+            self.hr.SetThreadCount(self.thread_count)
+        self.bits = bits
+
+        if self.bitsets:
+            # HashRankingContext stores bitsets word-major
+            self.hr.LoadQueryLabelBits(np.ascontiguousarray(self.labels_test.T))
+            self.hr.LoadDBLabelBits(np.ascontiguousarray(self.labels_train.T))
+        else:
+            self.hr.LoadQueryLabels(self.labels_test)
+            self.hr.LoadDBLabels(self.labels_train)
+
+    def map(self, hashes_train, hashes_test, average_ties=False, top_n=0, curve=False, cutoffs=None, radius=None, asymmetric=False, bit_weights=None):
+        """Same as calc_map_fast with the labels of the context"""
+        self.__load_hashes(hashes_train, hashes_test, asymmetric, bit_weights)
+        return _run_map(self.hr, average_ties, top_n, curve, cutoffs, radius)
+
+    def map_rerank(self, hashes_train, hashes_test, embeddings_train, embeddings_test, shortlist=100, cutoffs=None, asymmetric=False, bit_weights=None):
+        """Same as calc_map_rerank with the labels of the context"""
+        self.__load_hashes(hashes_train, hashes_test, asymmetric, bit_weights)
+        self.hr.LoadDBEmbeddings(embeddings_train)
+        self.hr.LoadQueryEmbeddings(embeddings_test)
+        return tuple(self.hr.RerankMap(shortlist, [shortlist] if cutoffs is None else list(cutoffs)))
+
+    def query_ap(self):
+        """AP of each query of the last map evaluation"""
+        return self.hr.QueryAP()
+
+    def start_rotation_search(self, hashes_train, hashes_test, top_n=0):
+        """Load hashes and keep their distances for the incremental rotation search. Returns tie averaged MAP"""
+        self.__load_hashes(hashes_train, hashes_test)
+        return self.hr.StartRotationSearch(top_n)
+
+    def propose_rotation(self, a, b, bits_train, bits_test):
+        """Return tie averaged MAP after bits a and b of DB and query hashes are replaced with the given ones,
+        arrays of shape [size, 2]. Nothing is changed until commit_rotation is called"""
+        return self.hr.ProposeColumns(a, b, bits_train, bits_test)
+
+    def commit_rotation(self):
+        """Apply the last proposed rotation"""
+        self.hr.CommitProposal()
+
+    def __load_hashes(self, hashes_train, hashes_test, asymmetric=False, bit_weights=None):
+        if hashes_train.shape[0] != self.db_size or hashes_test.shape[0] != self.query_size:
+            raise ValueError("Number of hashes does not match number of labels")
+        if self.hr is None or hashes_train.shape[1] != self.bits:
+            self.init(hashes_train.shape[1])
+
+        _load_queries(self.hr, hashes_test, asymmetric, bit_weights)
+        self.hr.LoadDBHashes(hashes_train)
+
+
+def _load_queries(hr, hashes_test, asymmetric, bit_weights):
+    """Load query hashes for the hamming, asymmetric or weighted hamming distance. bit_weights is an array of shape
+    [bits] or [queries, bits], or 'margin' to weight the bits of each query by the magnitudes of its components"""
+    hashes_test = np.ascontiguousarray(hashes_test, dtype=np.float32)
+    if asymmetric and bit_weights is not None:
+        raise ValueError("Bit weights are not supported for the asymmetric distance")
+    if asymmetric:
+        hr.LoadQueryFloats(hashes_test)
+        return
+    hr.LoadQueryHashes(hashes_test)
+    if isinstance(bit_weights, str):
+        if bit_weights != 'margin':
+            raise ValueError("Unknown bit weights: {0}".format(bit_weights))
+        bit_weights = np.abs(hashes_test)
+    if bit_weights is not None:
+        hr.SetBitWeights(np.asarray(bit_weights, dtype=np.float32))
+
+
+def calc_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode,weighted_mode=False, average_ties=False, top_n=0, curve=False, cutoffs=None, radius=None, asymmetric=False, bit_weights=None):
+    context = MapContext(labels_train, labels_test, and_mode, weighted_mode)
+    return context.map(hashes_train, hashes_test, average_ties, top_n, curve, cutoffs, radius, asymmetric, bit_weights)
+
+
+def calc_map_rerank(hashes_train, hashes_test, labels_train, labels_test, and_mode, weighted_mode=False, shortlist=100, cutoffs=None, embeddings_train=None, embeddings_test=None, asymmetric=False, bit_weights=None):
+    """Two-stage retrieval: shortlist of the hash ranking re-ranked by the dot product of embeddings, the hashes
+    themselves if embeddings are not given. Returns MAP over the shortlist and precision at the cutoffs"""
+    context = MapContext(labels_train, labels_test, and_mode, weighted_mode)
+    return context.map_rerank(hashes_train, hashes_test,
+                              hashes_train if embeddings_train is None else embeddings_train,
+                              hashes_test if embeddings_test is None else embeddings_test,
+                              shortlist, cutoffs, asymmetric, bit_weights)
+
+
+def calc_rerank(hashes_train, hashes_test, shortlist=100, embeddings_train=None, embeddings_test=None, asymmetric=False, bit_weights=None):
+    """Return indices of the re-ranked shortlist of each query, array of shape [queries, shortlist]"""
+    bits = hashes_train.shape[1]
+    hr = hamming.HashRankingContext()
+    hr.Init(hashes_train.shape[0], hashes_test.shape[0], hash_storage(bits), 0, bits)
+    _load_queries(hr, hashes_test, asymmetric, bit_weights)
+    hr.LoadDBHashes(np.ascontiguousarray(hashes_train, dtype=np.float32))
+    hr.LoadDBEmbeddings(hashes_train if embeddings_train is None else embeddings_train)
+    hr.LoadQueryEmbeddings(hashes_test if embeddings_test is None else embeddings_test)
+    return hr.Rerank(shortlist).astype(np.int32)
+
+
+def calc_rank_fast(hashes_train, hashes_test, top_n=0, asymmetric=False, bit_weights=None):
+    """Return indices of the first top_n DB items ranked by distance to each query, array of shape [queries, top_n].
+    Items at equal distance are ranked in the DB order"""
+    bits = hashes_train.shape[1]
     hr = hamming.HashRankingContext()
-    hr.Init(hashes_train.shape[0], hashes_test.shape[0], 1 if hashes_train.shape[1] > 32 else 0, 1 if and_mode else 0 if not weighted_mode else 2)
+    hr.Init(hashes_train.shape[0], hashes_test.shape[0], hash_storage(bits), 0, bits)
+    _load_queries(hr, hashes_test, asymmetric, bit_weights)
+    hr.LoadDBHashes(np.ascontiguousarray(hashes_train, dtype=np.float32))
+    return np.stack([hr.Sort(q, top_n) for q in range(hashes_test.shape[0])]).astype(np.int32)
 
-    hr.LoadQueryHashes(hashes_test)
-    hr.LoadDBHashes(hashes_train)
 
-    if and_mode:
-        labels_trainL, labels_trainH = labeles_to_two_64bword(labels_train)
-        labels_testL, labels_testH = labeles_to_two_64bword(labels_test)
-        hr.LoadQueryLabelsLDW(labels_testL)
-        hr.LoadQueryLabelsHDW(labels_testH)
-        hr.LoadDBLabelsLDW(labels_trainL)
-        hr.LoadDBLabelsHDW(labels_trainH)
+def calc_map_packed(db, hashes_test, labels_test, and_mode, weighted_mode=False, average_ties=False, top_n=0, curve=False, cutoffs=None, radius=None, asymmetric=False, bit_weights=None):
+    """Same as calc_map_fast, but DB hashes and labels are taken from utils.hash_file.HashFile. They are used in place,
+    without a copy"""
+    hr = packed_context(db, hashes_test, labels_test, and_mode, weighted_mode, asymmetric, bit_weights)
+    return _run_map(hr, average_ties, top_n, curve, cutoffs, radius)
+
+
+def packed_context(db, hashes_test, labels_test, and_mode, weighted_mode=False, asymmetric=False, bit_weights=None):
+    """HashRankingContext with DB hashes and labels of utils.hash_file.HashFile and the queries loaded. Query labels
+    may be None if only the ranking is needed"""
+    if db.labels is None:
+        raise ValueError("Hash file has no labels")
+    # Weighted comparison takes both bitsets and uint32 tag masks
+    if (and_mode and not db.bitset_labels) or (db.bitset_labels and not (and_mode or weighted_mode)):
+        raise ValueError("Hash file labels do not match the comparison mode")
+
+    hr = hamming.HashRankingContext()
+    # Packed hashes are stored in 64bit words, so short hashes use 64bit storage as well
+    hr.Init(db.count, hashes_test.shape[0], max(hash_storage(db.bits), 1), 1 if and_mode else 0 if not weighted_mode else 2, db.bits)
+
+    _load_queries(hr, hashes_test, asymmetric, bit_weights)
+    hr.LoadDBPacked(db.hashes)
+    hr.LoadDBLabelsPacked(db.labels)
+
+    if labels_test is not None:
+        if and_mode or weighted_mode:
+            hr.LoadQueryLabelBits(np.ascontiguousarray(to_bitsets(labels_test).T))
+        else:
+            hr.LoadQueryLabels(np.array(labels_test).flatten().astype(np.int32))
+    return hr
+
+
+def _run_map(hr, average_ties, top_n, curve, cutoffs, radius):
+    r = -1 if radius is None else radius
+    if curve:
+        result = hr.MapCurve(top_n=top_n, tb=1 if average_ties else 0, cutoffs=[] if cutoffs is None else list(cutoffs), radius=r)
     else:
-        hr.LoadQueryLabels(np.array(labels_test).flatten().astype(np.int32))
-        hr.LoadDBLabels(np.array(labels_train).flatten().astype(np.int32))
+        result = hr.Map(top_n=top_n, tb=1 if average_ties else 0, radius=r)
 
-    return hr.Map()
+    if radius is None:
+        return result
+    return (tuple(result) if curve else (result,)) + (hr.RadiusMetrics(),)
@@ -14,7 +14,6 @@
 # ==============================================================================
 """Batch provider. Returns iterator to batches"""
 
-from random import shuffle
 import matplotlib.pyplot as plt
 from scipy import misc
 import random
@@ -25,8 +24,12 @@ try:
     import queue
 except ImportError:
     import Queue as queue
-from threading import Thread, Lock, Event
+from threading import Thread, Lock, Event, Condition
+import multiprocessing
+import ctypes
+import traceback
 import logging
+import os
 from PIL import Image
 try:
     from BytesIO import BytesIO
@@ -34,26 +37,115 @@ except ImportError:
     from io import BytesIO
 
 
+def _crop_flip(image, image_size, cycled, rx, ry, flip):
+    """Crop of image_size (width, height) out of image. Random for training, where rx, ry in [0, 1) give position of
+    the crop, central otherwise. Image is flipped horizontally if flip is set"""
+    # Similar to DVSQ https://github.com/caoyue10/cvpr17-dvsq/blob/master/net.py#L122
+    startx = image.shape[1] - image_size[0]
+    starty = image.shape[0] - image_size[1]
+    if cycled:
+        startx = min(int(rx * (startx + 1)), startx)
+        starty = min(int(ry * (starty + 1)), starty)
+    else:
+        startx = startx // 2
+        starty = starty // 2
+    image = image[starty:starty + image_size[1], startx:startx + image_size[0]]
+    if flip:
+        image = np.fliplr(image)
+    return image
+
+
+# Environments opened by this process, by (pid, path). LMDB must not open an environment more than once per process
+_environments = {}
+_environments_lock = Lock()
+
+
+def _open_env(lmdb_file):
+    """Read-only LMDB environment of the process, that is shared by all providers and threads of the process"""
+    key = (os.getpid(), os.path.abspath(lmdb_file))
+    with _environments_lock:
+        if key not in _environments:
+            _environments[key] = lmdb.open(lmdb_file, map_size=8 * 1024 * 1024 * 1024, subdir=True, readonly=True,
+                                           lock=False)
+        return _environments[key]
+
+
+def _begin(env):
+    """Read transaction and its cursor, that a worker keeps for its lifetime. The transaction returns buffers, views
+    into the memory map instead of copies"""
+    txn = env.begin(buffers=True)
+    return txn, txn.cursor()
+
+
+def _fetch(cursor, keys):
+    """Yields (i, value) for encoded keys of a batch in the sorted order, so the cursor moves forward through the
+    B-tree. A value is a view that is valid until the cursor moves, so it must be consumed before the next one"""
+    for i in sorted(range(len(keys)), key=keys.__getitem__):
+        if not cursor.set_key(keys[i]):
+            raise KeyError("Key {0} is not in LMDB".format(keys[i]))
+        yield i, cursor.value()
+
+
+def _decode_worker(lmdb_file, shared, shape, tasks, results):
+    """Decode process of BatchProvider. Reads JPEGs of tasks from its own LMDB environment, crops and flips them, and
+    writes them in place to the slot of the shared array of shape [slots, batch_size, height, width, 3]"""
+    env = _open_env(lmdb_file)
+    txn, cursor = _begin(env)
+    images = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+    image_size = (shape[3], shape[2])
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, start, keys, params, cycled = task
+        try:
+            for i, buf in _fetch(cursor, keys):
+                rx, ry, flip = params[i]
+                image = misc.imread(BytesIO(buf), mode='RGB')
+                images[slot, start + i] = _crop_flip(image, image_size, cycled, rx, ry, flip)
+            results.put((slot, None))
+        except Exception:
+            results.put((slot, traceback.format_exc()))
+    txn.abort()
+
+
 class BatchProvider:
-    """All in memory batch provider for small datasets that fit RAM"""
-    def __init__(self, batch_size, items, cycled=True, worker=16, width=224, height=224, lmdb_file=None):
+    """All in memory batch provider for small datasets that fit RAM.
+
+    Batches are written in place to a ring of preallocated batch slots, and "images" of a batch is an array of shape
+    [batch_size, height, width, 3] (uint8 for images, the same dtype as the items for feature vectors) that is valid
+    until the next batch is requested. Images of LMDB datasets are JPEGs, that are decoded by worker threads, or, if
+    processes > 0, by that many decode processes into slots in shared memory.
+
+    Batches are keyed by (epoch, batch index). Items of an epoch are taken in the order of a permutation seeded by
+    (seed, epoch), and random crops and flips of a batch are seeded by (seed, epoch, batch index), so batches and their
+    order depend only on the seed, not on the number of workers. Permutation of the next epoch is prepared when an
+    epoch starts. Without cycling, the provider makes one epoch. get_state and set_state save and restore the position.
+    """
+    def __init__(self, batch_size, items, cycled=True, worker=16, width=224, height=224, lmdb_file=None, processes=0,
+                 seed=None):
         self.items = items
-        shuffle(self.items)
         self.batch_size = batch_size
+        self.seed = random.randint(0, 2 ** 31 - 1) if seed is None else seed
 
+        # Batches are counted from the start over all epochs. Producers claim current_batch, consumer takes next_batch
         self.current_batch = 0
+        self.next_batch = 0
         self.cycled = cycled
-        if self.cycled:
-            worker = 1
         self.done = False
         self.image_size = (width, height)
         self.lock = Lock()
         self.worker = worker
         self.quit_event = Event()
+        self.processes = processes
+        self.lmdb_file = lmdb_file
+        self.permutations = {}
 
-        self.q = queue.Queue(16)
+        # Filled batches by their number, they may be produced out of order
+        self.ready = {}
+        self.ready_condition = Condition()
         self.batches_n = len(self.items)//self.batch_size
-        logging.debug("Batches per epoch: {0}", self.batches_n)
+        logging.debug("Batches per epoch: {0}".format(self.batches_n))
 
         try:
             self.using_lmdb = type(items[0][1]) is str or type(items[0][1]) is unicode
@@ -62,10 +154,40 @@ class BatchProvider:
 
         if self.using_lmdb:
             assert(lmdb_file)
-            self.env = lmdb.open(lmdb_file, map_size=8 * 1024 * 1024 * 1024, subdir=True, readonly=True, lock=False)
+            # Keys are encoded once. Worker threads share the environment of this process, decode processes open
+            # their own
+            self.keys = [item[1].encode('ascii') for item in items]
 
 
+    def get_state(self):
+        """State of the provider, {"seed": seed, "epoch": epoch, "position": batch index} of the next batch to return.
+        Can be pickled and passed to set_state of a provider of the same items and batch size, to continue from there"""
+        epoch, position = divmod(self.next_batch, self.batches_n)
+        return {"seed": self.seed, "epoch": epoch, "position": position}
+
+    def set_state(self, state):
+        """Continue from the state returned by get_state. Must be called before get_batches"""
+        if not 0 <= state["position"] < self.batches_n:
+            raise ValueError("Position {0} is out of range of {1} batches per epoch".format(state["position"],
+                                                                                         self.batches_n))
+        self.seed = state["seed"]
+        self.current_batch = state["epoch"] * self.batches_n + state["position"]
+        self.next_batch = self.current_batch
+        self.permutations = {}
+
     def get_batches(self):
+        if self.using_lmdb and self.processes > 0:
+            for b in self._process_batches():
+                yield b
+            return
+        if self.using_lmdb:
+            self.env = _open_env(self.lmdb_file)
+        # Each worker fills one slot, the consumer holds one, and the rest hold batches produced ahead
+        self.free_slots = queue.Queue()
+        for slot in range(self.worker + 2):
+            self.free_slots.put(slot)
+        self.buffers = [None] * (self.worker + 2)
+        self.consumed_slot = None
         workers = []
         for i in range(self.worker):
             worker = Thread(target=self._worker)
@@ -79,92 +201,185 @@ class BatchProvider:
         except GeneratorExit:
             self.quit_event.set()
             self.done = True
-            while not self.q.empty():
-                try:
-                    self.q.get(False)
-                except queue.Empty:
-                    continue
-                self.q.task_done()
+            with self.ready_condition:
+                ready, self.ready = self.ready, {}
+            # Let workers waiting for a slot finish
+            for slot, _ in ready.values():
+                self.free_slots.put(slot)
+            for worker in workers:
+                self.free_slots.put(None)
 
     def _worker(self):
-        while not (self.quit_event.is_set() and self.done):
-            b = self.__next()
-            if b is None:
-                break
-            self.q.put(b)
+        txn, cursor = _begin(self.env) if self.using_lmdb else (None, None)
+        try:
+            while not self.quit_event.is_set():
+                slot = self.free_slots.get()
+                if slot is None or self.quit_event.is_set():
+                    break
+                k = self.__claim()
+                if k is None:
+                    self.free_slots.put(slot)
+                    break
+                b = self.__next(k, slot, cursor)
+                with self.ready_condition:
+                    self.ready[k] = (slot, b)
+                    self.ready_condition.notify_all()
+        finally:
+            if txn is not None:
+                txn.abort()
 
     def _get_batch(self):
-        if self.q.empty() and self.done:
+        # The consumer is done with the previous batch, when it asks for the next one
+        if self.consumed_slot is not None:
+            self.free_slots.put(self.consumed_slot)
+            self.consumed_slot = None
+        if not self.cycled and self.next_batch >= self.batches_n:
+            self.done = True
             return None
-        item = self.q.get()
-        self.q.task_done()
+        with self.ready_condition:
+            while self.next_batch not in self.ready:
+                self.ready_condition.wait()
+            slot, item = self.ready.pop(self.next_batch)
+        self.next_batch += 1
+        self.consumed_slot = slot
         return item
 
-    def __next(self):
-        self.lock.acquire()
-        if self.current_batch == self.batches_n:
+    def _process_batches(self):
+        slots = self.processes + 2
+        shape = (slots, self.batch_size, self.image_size[1], self.image_size[0], 3)
+        # Decode processes are spawned, not forked: the parent already runs threads of TensorFlow and of other
+        # providers, and a forked child can deadlock on a lock that one of them held at the time of the fork
+        context = multiprocessing.get_context('spawn')
+        shared = context.RawArray(ctypes.c_uint8, int(np.prod(shape)))
+        images = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+        tasks = context.Queue()
+        results = context.Queue()
+        workers = []
+        for i in range(self.processes):
+            worker = context.Process(target=_decode_worker, args=(self.lmdb_file, shared, shape, tasks, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        labels = [None] * slots
+        pending = [0] * slots
+        chunk = (self.batch_size + self.processes - 1) // self.processes
+
+        def submit(slot):
+            k = self.__claim()
+            if k is None:
+                return False
+            indices, params = self.__next_items(k)
+            labels[slot] = [self.__label(i) for i in indices]
+            keys = [self.keys[i] for i in indices]
+            params = [(rx, ry, bool(flip)) for rx, ry, flip in params]
+            for start in range(0, len(indices), chunk):
+                tasks.put((slot, start, keys[start:start + chunk], params[start:start + chunk], self.cycled))
+                pending[slot] += 1
+            return True
+
+        try:
+            # Batches are counted from the start, slot of batch k is k % slots
+            submitted = self.next_batch
+            while submitted - self.next_batch < slots and submit(submitted % slots):
+                submitted += 1
+            while self.next_batch < submitted:
+                slot = self.next_batch % slots
+                while pending[slot] > 0:
+                    try:
+                        s, error = results.get(timeout=1)
+                    except queue.Empty:
+                        # A spawned process that failed to start (e.g. to import this module) never replies
+                        if not all(worker.is_alive() for worker in workers):
+                            raise RuntimeError("Decode process exited unexpectedly")
+                        continue
+                    if error is not None:
+                        raise RuntimeError("Decode process failed:\n" + error)
+                    pending[s] -= 1
+                self.next_batch += 1
+                yield {"images": images[slot], "labels": labels[slot]}
+                # The consumer is done with the slot, when it asks for the next batch
+                if submit(slot):
+                    submitted += 1
             self.done = True
-            if self.cycled:
-                self.done = False
-                self.current_batch = 0
-                shuffled = list(self.items)
-                shuffle(shuffled)
-                self.items = shuffled
-            else:
-                self.lock.release()
+            while True:
+                yield None
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join(1)
+                if worker.is_alive():
+                    worker.terminate()
+
+    def __claim(self):
+        """Number of the next batch to produce, None if the provider is not cycled and the epoch is over"""
+        with self.lock:
+            k = self.current_batch
+            if not self.cycled and k >= self.batches_n:
                 return None
-        cb = self.current_batch
-        self.current_batch += 1
-        items = self.items
-        self.lock.release()
+            self.current_batch += 1
+        return k
 
-        b_images = []
-        b_labels = []
+    def __permutation(self, epoch):
+        with self.lock:
+            permutation = self.permutations.get(epoch)
+        if permutation is None:
+            # Computed outside the lock. Producers that compute it at the same time get the same permutation
+            permutation = np.random.RandomState([self.seed, epoch]).permutation(len(self.items))
+            with self.lock:
+                self.permutations[epoch] = permutation
+                for e in [e for e in self.permutations if e < epoch - 1]:
+                    del self.permutations[e]
+        return permutation
 
-        buffer = BytesIO()
-        for i in range(self.batch_size):
-            item = items[cb * self.batch_size + i]
+    def __next_items(self, k):
+        """Indices of items of batch k and random values of each item for crop position and flip, array of shape
+        [batch_size, 3]"""
+        epoch, index = divmod(k, self.batches_n)
+        permutation = self.__permutation(epoch)
+        if self.cycled and index == 0:
+            self.__permutation(epoch + 1)
+        indices = permutation[index * self.batch_size:(index + 1) * self.batch_size]
+        params = np.random.RandomState([self.seed, epoch, index]).random_sample([self.batch_size, 3])
+        params[:, 2] = np.logical_and(self.cycled, params[:, 2] > 0.5)
+        return indices, params
 
-            if not self.using_lmdb and len(item[1].shape) == 1:
-                image = item[1]
-            elif not self.using_lmdb:
-                image = misc.imresize(item[1], self.image_size, interp='bilinear')
+    def __label(self, i):
+        # Label bitsets are arrays of shape [words], class labels are ints
+        label = self.items[i][0]
+        return label if isinstance(label, np.ndarray) else [label]
 
-                # Similar to DVSQ https://github.com/caoyue10/cvpr17-dvsq/blob/master/net.py#L122
-                if self.cycled:
-                    if random.random() > 0.5:
-                        image = np.fliplr(image)
-            else:
-                with self.env.begin() as txn:
+    def __next(self, k, slot, cursor):
+        indices, params = self.__next_items(k)
 
-                    buf = txn.get(item[1].encode('ascii'))
-                    if buf is None:
-                        print(item[1].encode('ascii'))
-                    buffer.seek(0)
-                    buffer.write(buf)
-                    buffer.seek(0)
-                    image = misc.imread(buffer, mode='RGB')
-                    #misc.imsave(str(i) + "_" + str(item[0])+ "test.jpg", image)
+        if self.using_lmdb:
+            # JPEGs are decoded straight from the memory map, in the key order of the batch
+            order = _fetch(cursor, [self.keys[i] for i in indices])
+        else:
+            order = enumerate(self.items[i][1] for i in indices)
 
-                # Similar to DVSQ https://github.com/caoyue10/cvpr17-dvsq/blob/master/net.py#L122
-                startx = image.shape[1] - self.image_size[0]
-                starty = image.shape[0] - self.image_size[1]
-                if self.cycled:
-                    startx = random.randint(0, startx)
-                    starty = random.randint(0, starty)
-                else:
-                    startx = startx // 2
-                    starty = starty // 2
-                image = image[starty:starty + self.image_size[1], startx:startx + self.image_size[0]]
+        b_images = self.buffers[slot]
+        for i, data in order:
+            rx, ry, flip = params[i]
+
+            if not self.using_lmdb and len(data.shape) == 1:
+                image = data
+            elif not self.using_lmdb:
+                image = misc.imresize(data, self.image_size, interp='bilinear')
 
                 # Similar to DVSQ https://github.com/caoyue10/cvpr17-dvsq/blob/master/net.py#L122
-                if self.cycled:
-                    if random.random() > 0.5:
-                        image = np.fliplr(image)
+                if flip:
+                    image = np.fliplr(image)
+            else:
+                image = misc.imread(BytesIO(data), mode='RGB')
+                image = _crop_flip(image, self.image_size, self.cycled, rx, ry, flip)
 
-            b_images.append(image)
-            b_labels.append([item[0]])
-        feed_dict = {"images": b_images, "labels": b_labels}
+            if b_images is None:
+                b_images = np.empty((self.batch_size,) + image.shape, dtype=image.dtype)
+                self.buffers[slot] = b_images
+            b_images[i] = image
+        feed_dict = {"images": b_images, "labels": [self.__label(i) for i in indices]}
 
         return feed_dict
 
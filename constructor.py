@@ -19,7 +19,7 @@ from matconvnet2tf import MatConvNet2TF
 import numpy as np
 
 def net(batch_size, hash_size, expected_triplet_count=100, margin=0, weight_decay_factor=0, loss_func=None):
-    t_images = tf.placeholder(tf.float32, [None, 224, 224, 3])
+    t_images = tf.placeholder(tf.uint8, [None, 224, 224, 3])
     t_latent = tf.placeholder(tf.float32, [None, 9216])
     t_labels = tf.placeholder(tf.int32, [None, 1])
     t_boolmask = tf.placeholder(tf.bool, [batch_size, batch_size])
@@ -41,7 +41,7 @@ def net(batch_size, hash_size, expected_triplet_count=100, margin=0, weight_deca
                 net_data = np.load('reference_pretrain.npy', encoding='bytes').item()
 
                 # swap(2,1,0)
-                reshaped_image = input
+                reshaped_image = tf.cast(input, tf.float32)
                 tm = tf.Variable([[0, 0, 1], [0, 1, 0], [1, 0, 0]], dtype=tf.float32)
                 reshaped_image = tf.reshape(reshaped_image, [-1, 3])
                 reshaped_image = tf.matmul(reshaped_image, tm)
@@ -17,17 +17,27 @@ import numpy as np
 import pickle
 from mean_average_precision import compute_map
 from mean_average_precision import compute_map_fast
+from utils.label_bitsets import to_bitsets
 from utils import cifar10_reader
 import time
 
-def evaluate(l_train, hashes_train, l_test, hashes_test, l_db, hashes_db, top_n = 0, and_mode=False, force_slow=False, testOnTrain=False,weighted_mode = False):
+def evaluate(l_train, hashes_train, l_test, hashes_test, l_db, hashes_db, top_n = 0, and_mode=False, force_slow=False, testOnTrain=False,weighted_mode = False, radius=None, asymmetric=False):
     """Evaluate MAP. Hardcoded numbers for CIFAR10 case. 1000 images per category, i.e. in total 10000 images,
     are randomly sampled as quire images (selection happens at preparation step). The remaining images are used
     as database images.
+    Returns MAP on train, MAP on test, precision-recall curve and lookup metrics. If radius is set, hash lookup within
+    the hamming radius is evaluated too, and lookup metrics are a tuple of its precision, recall and mean number of
+    retrieved items. They are None if radius is None or force_slow is set.
+    If asymmetric is set, real-valued query hashes are ranked against binary DB hashes, see compute_map_fast.
     """
-    labels_database = np.reshape(np.asarray(l_db), [-1, 1])
-    labels_train = np.reshape(np.asarray(l_train), [-1, 1])
-    labels_test = np.reshape(np.asarray(l_test), [-1, 1])
+    if and_mode or weighted_mode:
+        labels_database = to_bitsets(l_db)
+        labels_train = to_bitsets(l_train)
+        labels_test = to_bitsets(l_test)
+    else:
+        labels_database = np.reshape(np.asarray(l_db), [-1, 1])
+        labels_train = np.reshape(np.asarray(l_train), [-1, 1])
+        labels_test = np.reshape(np.asarray(l_test), [-1, 1])
 
     hashes_database = hashes_db.astype(np.float32)
     hashes_train = hashes_train.astype(np.float32)
@@ -36,19 +46,25 @@ def evaluate(l_train, hashes_train, l_test, hashes_test, l_db, hashes_db, top_n
     map_train = 0.0
 
     if testOnTrain:
-        map_train, _ = compute_map(
+        map_train = compute_map_fast(
            hashes_train[:-1000],
            hashes_train[-1000:],
            labels_train[:-1000],
-           labels_train[-1000:], top_n=top_n, and_mode=and_mode, force_slow=force_slow)
+           labels_train[-1000:], top_n=top_n, and_mode=and_mode, weighted_mode=weighted_mode, asymmetric=asymmetric)
         #print("Test on train " + str(map_train))
 
     #pretime = time.perf_counter()
-    map_test, curve = compute_map(hashes_database, hashes_test, labels_database, labels_test, top_n=top_n, and_mode=and_mode, force_slow=and_mode,weighted_mode = weighted_mode)
+    radius_metrics = None
+    if force_slow:
+        map_test, curve = compute_map(hashes_database, hashes_test, labels_database, labels_test, top_n=top_n, and_mode=and_mode, force_slow=and_mode,weighted_mode = weighted_mode)
+    elif radius is not None:
+        map_test, curve, radius_metrics = compute_map_fast(hashes_database, hashes_test, labels_database, labels_test, top_n=top_n, and_mode=and_mode, weighted_mode=weighted_mode, curve=True, radius=radius, asymmetric=asymmetric)
+    else:
+        map_test, curve = compute_map_fast(hashes_database, hashes_test, labels_database, labels_test, top_n=top_n, and_mode=and_mode, weighted_mode=weighted_mode, curve=True, asymmetric=asymmetric)
     #posttime = time.perf_counter()
     #print('time taken {}'.format(posttime-pretime))
     #print("Test on test " + str(map_test))
-    return map_train, map_test, curve
+    return map_train, map_test, curve, radius_metrics
 
 def map():
     """Read pickled test, train sets and pickled hashes and perform evaluation"""
@@ -4,11 +4,24 @@ import batch_provider
 import pickle
 from constructor import net
 import tensorflow as tf
+from utils.label_bitsets import to_bitsets
 
 BATCH_SIZE = 100 # must be a divider of 10000 and 50000
 
 
-def gen_hashes(t_images, prob, outputs, sess, items, batch_provider_constructor, longints=False):
+def _batch_labels(labels):
+    """Labels of a batch as uint32 class labels of shape [n, 1], or as label bitsets of shape [n, words] if they are
+    bitsets or tag masks that do not fit uint32, including Python ints of item pickles made before bitsets"""
+    labels = np.asarray(labels)
+    if labels.dtype.kind in 'iu' and labels.dtype != np.uint64 and labels.ndim == 2 and labels.shape[1] == 1:
+        if labels.size == 0 or (labels.min() >= 0 and labels.max() <= 0xFFFFFFFF):
+            return labels.astype(np.uint32)
+    return to_bitsets(labels)
+
+
+def gen_hashes(t_images, prob, outputs, sess, items, batch_provider_constructor):
+    """Hashes and labels of the items. Labels are uint32 class labels of shape [count, 1] or label bitsets of shape
+    [count, words], the same as the batches have"""
     bp = batch_provider_constructor(items, False, BATCH_SIZE)
 
     if len(outputs.shape) != 2:
@@ -19,10 +32,7 @@ def gen_hashes(t_images, prob, outputs, sess, items, batch_provider_constructor,
 
     b = np.zeros([len(items), output_size])
 
-    if longints:
-        l = np.zeros([len(items), 1], dtype=np.object)
-    else:
-        l = np.zeros([len(items), 1], dtype=np.uint32)
+    l = []
 
     batches = bp.get_batches()
 
@@ -37,10 +47,17 @@ def gen_hashes(t_images, prob, outputs, sess, items, batch_provider_constructor,
                                     prob: 1.0,})
 
         b[k: k + BATCH_SIZE] = result
-        l[k: k + BATCH_SIZE] = feed_dict["labels"]
+        l.append(_batch_labels(feed_dict["labels"]))
 
         k += BATCH_SIZE
 
+    if all(labels.dtype == np.uint32 for labels in l):
+        l = np.concatenate(l) if len(l) > 0 else np.zeros([0, 1], dtype=np.uint32)
+    else:
+        # Some batches have tags beyond uint32, all labels are converted to bitsets of the same width
+        words = max(labels.shape[1] for labels in l if labels.dtype == np.uint64)
+        l = np.concatenate([to_bitsets(labels, words) for labels in l])
+
     if (len(b) != k) or (len(l) != k):
         print(len(b))
         print(len(l))
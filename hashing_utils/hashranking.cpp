@@ -31,6 +31,11 @@
 #endif
 
 #include <inttypes.h>
+#include <vector>
+#include <thread>
+#include <atomic>
+#include <algorithm>
+#include <cmath>
 
 namespace py = pybind11;
 
@@ -60,6 +65,16 @@ inline uint8_t hamming_distance64(uint64_t x, uint64_t y)
     return (uint8_t)popcount64(val);
 }
 
+inline uint16_t hamming_distanceN(const uint64_t* __restrict x, const uint64_t* __restrict y, int words)
+{
+	uint16_t result = 0;
+	for (int k = 0; k < words; ++k)
+	{
+		result += (uint16_t)popcount64(x[k] ^ y[k]);
+	}
+	return result;
+}
+
 void to_int32_hashes(py::array_t<float, py::array::c_style> x, uint32_t* __restrict out)
 {
 	auto p = x.unchecked<2>();
@@ -102,36 +117,126 @@ void to_int64_hashes(py::array_t<float, py::array::c_style> x, uint64_t* __restr
 	}
 }
 
+void to_words_hashes(py::array_t<float, py::array::c_style> x, uint64_t* __restrict out, int words)
+{
+	auto p = x.unchecked<2>();
+    int w = (int)p.shape(1);
+    int h = (int)p.shape(0);
+
+	for (int i = 0; i < h; ++i)
+	{
+		uint64_t* __restrict output = out + (size_t)i * words;
+		const float* __restrict hash = p.data(i, 0);
+
+		for (int k = 0; k < words; ++k)
+		{
+			output[k] = 0;
+		}
+		for (int y = 0; y < w; ++y)
+		{
+			output[y / 64] |= (hash[y] > 0.0f ? uint64_t(1) : uint64_t(0)) << (y % 64);
+		}
+	}
+}
+
+// Calls f(i, t) for every i in [0, count) from thread_count workers, t is the index of the worker.
+// Items are handed out one by one, so workers stay busy when items take different time
+template<typename F>
+void ParallelFor(int count, int thread_count, F f)
+{
+	thread_count = std::min(thread_count, count);
+	std::atomic<int> next(0);
+
+	auto worker = [&](int t)
+	{
+		for (int i = next++; i < count; i = next++)
+		{
+			f(i, t);
+		}
+	};
+
+	std::vector<std::thread> threads;
+	for (int t = 1; t < thread_count; ++t)
+	{
+		threads.emplace_back(worker, t);
+	}
+	worker(0);
+	for (auto& thread: threads)
+	{
+		thread.join();
+	}
+}
+
+// Per-thread working buffers. Each worker of the query pool owns one, so queries can be ranked concurrently
+struct RankingScratch
+{
+	void Resize(int db_size, int buckets)
+	{
+		dist.resize(db_size);
+		rank.resize(db_size);
+		gain.resize(db_size);
+		total.resize(buckets);
+		relevant.resize(buckets);
+		gain_sum.resize(buckets);
+		position.resize(buckets);
+		cumulative_gain.resize(buckets);
+	}
+
+	std::vector<uint16_t> dist;
+	std::vector<uint32_t> rank;
+	std::vector<uint8_t> gain;
+
+	// Per-distance histograms: number of items, number of relevant items and sum of their gains
+	std::vector<int32_t> total;
+	std::vector<int32_t> relevant;
+	std::vector<int64_t> gain_sum;
+
+	// Running rank and cumulative gain inside of each distance bucket
+	std::vector<int32_t> position;
+	std::vector<int64_t> cumulative_gain;
+
+	// Last distance bucket that gets into top_n and how many of its items get there
+	int cutoff_bucket;
+	int32_t cutoff_count;
+
+	// Precision/recall curve: number of relevant items at each rank and sums over queries at requested cutoffs
+	int32_t total_relevant;
+	// Number of items and relevant items within the lookup radius
+	int32_t radius_total;
+	int32_t radius_relevant;
+	std::vector<double> cum_at_rank;
+	std::vector<int64_t> precision_sum;
+	std::vector<int64_t> recall_sum;
+
+	// Asymmetric or weighted distance of the query to every value of each byte of DB hashes
+	std::vector<uint16_t> lut;
+
+	// Re-ranking of the shortlist: dot products with the query, their order, and the re-ranked DB indices
+	std::vector<float> score;
+	std::vector<uint32_t> order;
+	std::vector<uint32_t> reranked;
+};
+
 class HashRankingContext
 {
 public:
-	HashRankingContext(): m_db_size(0), m_query_size(0), m_dbhashes(nullptr), m_queryhashes(nullptr), m_dist(nullptr), m_rank(nullptr), m_tmp(nullptr),m_labels_db(nullptr),
-	m_labels_query(nullptr),m_labels_dbLDW(nullptr),m_labels_dbHDW(nullptr),m_labels_queryLDW(nullptr),m_labels_queryHDW(nullptr),m_relevance(nullptr),m_cumulative(nullptr),m_precision(nullptr)
+	HashRankingContext(): m_bits(0), m_words(0), m_db_size(0), m_query_size(0), m_thread_count(1), m_dbhashes(nullptr), m_queryhashes(nullptr), m_labels_db(nullptr),
+	m_labels_query(nullptr),m_labels_db_bits(nullptr),m_labels_query_bits(nullptr),m_db_label_words(0),m_query_label_words(0),m_label_words(0),m_ap(nullptr),m_radius(-1),
+	m_distance(DM_hamming),m_max_dist(0),m_weight_scale(1),m_embedding_size(0),m_query_embedding_size(0),m_search_top_n(0),m_proposal_a(0),m_proposal_b(0),m_proposal_valid(false)
 	{
+		m_thread_count = std::max((int)std::thread::hardware_concurrency(), 1);
 	}
 
 	~HashRankingContext()
 	{
-		delete[] m_dbhashes;
-		delete[] m_queryhashes;
-		delete[] m_dist;
-		delete[] m_rank;
-		delete[] m_tmp;
-		delete[] m_labels_db;
-		delete[] m_labels_query;
-		delete[] m_labels_dbLDW;
-		delete[] m_labels_dbHDW;
-		delete[] m_labels_queryLDW;
-		delete[] m_labels_queryHDW;
-		delete[] m_relevance;
-		delete[] m_cumulative;
-		delete[] m_precision;
+		Release();
 	}
 
 	enum HashStorage
 	{
 		HS32b,
-		HS64b
+		HS64b,
+		HSNw
 	};
 
 	enum LabelComparing
@@ -141,8 +246,30 @@ public:
     LC_weighted,
 	};
 
-	void Init(int db_size, int query_size, int hs, int lc)
+	enum TieBreaking
+	{
+		// Items at equal distance are ranked in the DB order, like a stable sort would do
+		TB_index,
+		// AP is averaged over all orderings of items at equal distance
+		TB_average,
+	};
+
+	enum DistanceMode
+	{
+		DM_hamming,
+		// Real-valued queries against binary DB hashes, see LoadQueryFloats
+		DM_asymmetric,
+		// Hamming distance with ties broken by weighted hamming distance, see SetBitWeights
+		DM_weighted,
+	};
+
+	// Asymmetric distance quantizes the magnitude of each query component to this many levels
+	enum { AsymmetricLevels = 64 };
+
+	// Allocates buffers for the given sizes. May be called again on the same context, previous buffers are released
+	void Init(int db_size, int query_size, int hs, int lc, int bits)
 	{
+		Release();
 		m_hs = (HashStorage)hs;
 		m_lc = (LabelComparing)lc;
 		m_db_size = db_size;
@@ -150,58 +277,209 @@ public:
 		switch(hs)
 		{
 		case HS32b:
+			m_bits = 32;
+			m_words = 1;
 			m_dbhashes = reinterpret_cast<uint8_t*>(new uint32_t[m_db_size]);
 			m_queryhashes = reinterpret_cast<uint8_t*>(new uint32_t[m_query_size]);
 			break;
 		case HS64b:
+			m_bits = 64;
+			m_words = 1;
 			m_dbhashes = reinterpret_cast<uint8_t*>(new uint64_t[m_db_size]);
 			m_queryhashes = reinterpret_cast<uint8_t*>(new uint64_t[m_query_size]);
 			break;
+		case HSNw:
+			if (bits <= 0)
+			{
+				throw std::runtime_error("Hash size in bits must be provided for multi-word storage");
+			}
+			m_bits = bits;
+			m_words = (bits + 63) / 64;
+			m_dbhashes = reinterpret_cast<uint8_t*>(new uint64_t[(size_t)m_db_size * m_words]);
+			m_queryhashes = reinterpret_cast<uint8_t*>(new uint64_t[(size_t)m_query_size * m_words]);
+			break;
+		default:
+			throw std::runtime_error("Unknown hash storage");
 		}
-		m_dist = new uint8_t[m_db_size];
-		m_rank = new uint32_t[m_db_size];
-		m_tmp = new uint32_t[m_db_size];
 		m_labels_db = new uint32_t[m_db_size];
 		m_labels_query = new uint32_t[m_query_size];
-		m_labels_dbLDW = new uint64_t[m_db_size];
-		m_labels_dbHDW = new uint64_t[m_db_size];
-		m_labels_queryLDW = new uint64_t[m_query_size];
-		m_labels_queryHDW = new uint64_t[m_query_size];
-		m_relevance = new float[m_db_size];
-		m_cumulative = new float[m_db_size];
-		m_precision = new float[m_db_size];
+		m_labels_db_bits = new uint64_t[m_db_size]();
+		m_labels_query_bits = new uint64_t[m_query_size]();
+		m_db_label_words = 1;
+		m_query_label_words = 1;
+		m_label_words = 1;
+		m_ap = new float[m_query_size]();
+		m_radius_precision.resize(m_query_size);
+		m_radius_recall.resize(m_query_size);
+		m_radius_candidates.resize(m_query_size);
+		m_radius = -1;
+		m_distance = DM_hamming;
+		m_max_dist = m_bits;
+		m_weight_scale = 1;
+
+		m_harmonic.resize(m_db_size + 1);
+		m_harmonic[0] = 0.0;
+		for (int i = 1; i <= m_db_size; ++i)
+		{
+			m_harmonic[i] = m_harmonic[i - 1] + 1.0 / i;
+		}
+
+		SetThreadCount(m_thread_count);
+	}
+
+	void SetThreadCount(int thread_count)
+	{
+		m_thread_count = std::max(thread_count, 1);
+		m_scratch.resize(m_thread_count);
+		for (auto& scratch: m_scratch)
+		{
+			scratch.Resize(m_db_size, m_max_dist + 1);
+		}
+	}
+
+	int GetThreadCount() const
+	{
+		return m_thread_count;
 	}
 
 	void LoadQueryHashes(py::array_t<float, py::array::c_style> x)
 	{
+		StopRotationSearch();
 		if (x.unchecked<2>().shape(0) != m_query_size)
 		{
 			throw std::runtime_error("Size of hashes block do not match the value provided at init");
 		}
-		switch(m_hs)
+		if (x.unchecked<2>().shape(1) > m_bits)
 		{
-		case HS32b:
-			to_int32_hashes(x, reinterpret_cast<uint32_t*>(m_queryhashes));
-			break;
-		case HS64b:
-			to_int64_hashes(x, reinterpret_cast<uint64_t*>(m_queryhashes));
-			break;
+			throw std::runtime_error("Hash length exceeds the hash storage provided at init");
+		}
+		SetDistance(DM_hamming, m_bits);
+		ToHashes(x, m_queryhashes);
+	}
+
+	// Loads real-valued queries for the asymmetric distance to binary DB hashes: the sum of magnitudes of the query
+	// components, whose sign differs from the DB bit. It ranks DB items the same as the inner product of the query
+	// and the DB hash of +1 and -1. Magnitudes are quantized to AsymmetricLevels levels of the largest one, so the
+	// distance is an integer from 0 to AsymmetricLevels * bits, and is computed with a lookup table per byte of the
+	// hash. Hashes loaded with LoadQueryHashes switch back to the hamming distance.
+	void LoadQueryFloats(py::array_t<float, py::array::c_style> x)
+	{
+		StopRotationSearch();
+		auto p = x.unchecked<2>();
+		if (p.shape(0) != m_query_size)
+		{
+			throw std::runtime_error("Size of hashes block do not match the value provided at init");
+		}
+		if (p.shape(1) > m_bits)
+		{
+			throw std::runtime_error("Hash length exceeds the hash storage provided at init");
+		}
+		if (AsymmetricLevels * m_bits > 0xFFFF)
+		{
+			throw std::runtime_error("Asymmetric distance supports hashes of up to 1023 bits");
+		}
+		ToHashes(x, m_queryhashes);
+
+		int w = (int)p.shape(1);
+		m_query_costs.assign((size_t)m_query_size * m_bits, 0);
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			const float* __restrict v = p.data(q, 0);
+			float max_abs = 0.0f;
+			for (int i = 0; i < w; ++i)
+			{
+				max_abs = std::max(max_abs, std::abs(v[i]));
+			}
+			if (max_abs == 0.0f)
+			{
+				continue;
+			}
+			uint16_t* __restrict costs = m_query_costs.data() + (size_t)q * m_bits;
+			for (int i = 0; i < w; ++i)
+			{
+				costs[i] = (uint16_t)std::lround(std::abs(v[i]) / max_abs * AsymmetricLevels);
+			}
+		}
+		SetDistance(DM_asymmetric, AsymmetricLevels * m_bits);
+	}
+
+	// Breaks ties of the hamming distance by the weighted hamming distance: the sum of weights of the bits that
+	// differ. Weights are an array of shape [bits], the same for all queries, or [query_size, bits], for example
+	// the margins of the queries. Applies to the loaded binary query hashes until they are loaded again.
+	// The weighted distance is quantized to S levels, where S + 1 is the largest value such that
+	// (bits + 1) (S + 1) fits 16 bits, bits being the length of the weights, and the key is
+	// hamming distance * (S + 1) + weighted distance. The key is a sum of per-bit costs S + 1 + quantized weight,
+	// so it is computed with the same lookup tables as the asymmetric distance, and the buckets of the key rank by
+	// hamming distance first.
+	void SetBitWeights(py::array_t<float, py::array::c_style | py::array::forcecast> weights)
+	{
+		StopRotationSearch();
+		if (m_distance == DM_asymmetric)
+		{
+			throw std::runtime_error("Bit weights require binary queries");
+		}
+		bool per_query = weights.ndim() == 2;
+		if ((weights.ndim() != 1 && !per_query) || (per_query && weights.shape(0) != m_query_size)
+			|| weights.shape(weights.ndim() - 1) > m_bits)
+		{
+			throw std::runtime_error("Weights must be an array of shape [bits] or [query_size, bits]");
+		}
+		// Scale depends on the length of the weights, not the hash storage, so the keys are the same for any storage.
+		// Bits beyond it are zero in both query and DB hashes and never differ
+		int w = (int)weights.shape(weights.ndim() - 1);
+		int scale = 0xFFFF / (w + 1);
+		int levels = scale - 1;
+
+		m_query_costs.assign((size_t)m_query_size * m_bits, (uint16_t)scale);
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			const float* __restrict v = weights.data() + (per_query ? (size_t)q * w : 0);
+			double sum = 0.0;
+			for (int i = 0; i < w; ++i)
+			{
+				sum += std::max(v[i], 0.0f);
+			}
+			if (sum == 0.0)
+			{
+				continue;
+			}
+			// Rounding down keeps the sum of quantized weights within the levels
+			uint16_t* __restrict costs = m_query_costs.data() + (size_t)q * m_bits;
+			for (int i = 0; i < w; ++i)
+			{
+				costs[i] += (uint16_t)std::floor(std::max(v[i], 0.0f) / sum * levels);
+			}
 		}
+		m_weight_scale = scale;
+		SetDistance(DM_weighted, w * scale + levels);
 	}
 
 	void LoadDBHashes(py::array_t<float, py::array::c_style> x)
 	{
+		StopRotationSearch();
 		if (x.unchecked<2>().shape(0) != m_db_size)
 		{
 			throw std::runtime_error("Size of hashes block do not match the value provided at init");
 		}
+		if (x.unchecked<2>().shape(1) > m_bits)
+		{
+			throw std::runtime_error("Hash length exceeds the hash storage provided at init");
+		}
+		ToHashes(x, m_dbhashes);
+	}
+
+	void ToHashes(py::array_t<float, py::array::c_style> x, uint8_t* out)
+	{
 		switch(m_hs)
 		{
 		case HS32b:
-			to_int32_hashes(x, reinterpret_cast<uint32_t*>(m_dbhashes));
+			to_int32_hashes(x, reinterpret_cast<uint32_t*>(out));
 			break;
 		case HS64b:
-			to_int64_hashes(x, reinterpret_cast<uint64_t*>(m_dbhashes));
+			to_int64_hashes(x, reinterpret_cast<uint64_t*>(out));
+			break;
+		case HSNw:
+			to_words_hashes(x, reinterpret_cast<uint64_t*>(out), m_words);
 			break;
 		}
 	}
@@ -215,285 +493,1989 @@ public:
 		memcpy(m_labels_query, x.unchecked<1>().data(0), 4 * m_query_size);
 	}
 
-	void LoadQueryLabelsLDW(py::array_t<uint64_t, py::array::c_style> x)
+	// Label bitsets of "and" and weighted comparison, an uint64 array of shape [words, query_size], stored word-major.
+	// Tag t is bit t % 64 of word t / 64. DB and query bitsets may have different number of words, missing words
+	// are zero
+	void LoadQueryLabelBits(py::array_t<uint64_t, py::array::c_style | py::array::forcecast> x)
 	{
-		if (x.unchecked<1>().shape(0) != m_query_size)
+		if (x.ndim() != 2 || x.shape(1) != m_query_size || x.shape(0) < 1)
 		{
-			throw std::runtime_error("Size of hashes block do not match the value provided at init");
+			throw std::runtime_error("Label bitsets must be an array of shape [words, query_size]");
 		}
-		memcpy(m_labels_queryLDW, x.unchecked<1>().data(0), 8 * m_query_size);
+		m_query_label_words = (int)x.shape(0);
+		delete[] m_labels_query_bits;
+		m_labels_query_bits = new uint64_t[(size_t)m_query_label_words * m_query_size];
+		memcpy(m_labels_query_bits, x.data(), 8 * (size_t)m_query_label_words * m_query_size);
+		m_label_words = std::min(m_db_label_words, m_query_label_words);
 	}
 
-	void LoadQueryLabelsHDW(py::array_t<uint64_t, py::array::c_style> x)
+	void LoadDBLabels(py::array_t<uint32_t, py::array::c_style | py::array::forcecast> x)
 	{
-		if (x.unchecked<1>().shape(0) != m_query_size)
+		if (x.unchecked<1>().shape(0) != m_db_size)
 		{
 			throw std::runtime_error("Size of hashes block do not match the value provided at init");
 		}
-		memcpy(m_labels_queryHDW, x.unchecked<1>().data(0), 8 * m_query_size);
+		memcpy(m_labels_db, x.unchecked<1>().data(0), 4 * m_db_size);
 	}
 
-	void LoadDBLabels(py::array_t<uint32_t, py::array::c_style | py::array::forcecast> x)
+	// Same as LoadQueryLabelBits, an array of shape [words, db_size]
+	void LoadDBLabelBits(py::array_t<uint64_t, py::array::c_style | py::array::forcecast> x)
 	{
-		if (x.unchecked<1>().shape(0) != m_db_size)
+		if (x.ndim() != 2 || x.shape(1) != m_db_size || x.shape(0) < 1)
 		{
-			throw std::runtime_error("Size of hashes block do not match the value provided at init");
+			throw std::runtime_error("Label bitsets must be an array of shape [words, db_size]");
 		}
-		memcpy(m_labels_db, x.unchecked<1>().data(0), 4 * m_db_size);
+		if (!m_labels_db_bits_owner)
+		{
+			delete[] m_labels_db_bits;
+		}
+		m_labels_db_bits_owner = py::object();
+		SetDBLabelWords((int)x.shape(0));
+		m_labels_db_bits = new uint64_t[(size_t)m_db_label_words * m_db_size];
+		memcpy(m_labels_db_bits, x.data(), 8 * (size_t)m_db_label_words * m_db_size);
 	}
 
-	void LoadDBLabelsHDW(py::array_t<uint64_t, py::array::c_style> x)
+	// Uses packed DB hashes of shape [db_size, words] in place, without a copy. Bit i of a hash is bit i % 64 of
+	// word i / 64, the same as the packing of LoadDBHashes. Requires 64bit or multi-word storage.
+	// The array is referenced by the context, so it may be a read-only memory-mapped file.
+	void LoadDBPacked(py::array_t<uint64_t, py::array::c_style> x)
 	{
-		if (x.unchecked<1>().shape(0) != m_db_size)
+		StopRotationSearch();
+		if (m_hs == HS32b)
 		{
-			throw std::runtime_error("Size of hashes block do not match the value provided at init");
+			throw std::runtime_error("Packed hashes require 64bit or multi-word storage");
+		}
+		if (x.ndim() != 2 || x.shape(0) != m_db_size || x.shape(1) != m_words)
+		{
+			throw std::runtime_error("Packed hashes must be an array of shape [db_size, words]");
 		}
-		memcpy(m_labels_dbHDW, x.unchecked<1>().data(0), 8 * m_db_size);
+		Borrow(m_dbhashes, m_dbhashes_owner, x, 0);
 	}
 
-	void LoadDBLabelsLDW(py::array_t<uint64_t, py::array::c_style> x)
+	// Uses DB labels in place, without a copy. For "and" and weighted comparison labels are uint64 bitsets stored
+	// word-major, as an array of shape [words, db_size], see LoadDBLabelBits. Weighted comparison also takes uint32
+	// tag masks of shape [db_size], that are copied. For equality labels are an uint32 array of shape [db_size].
+	void LoadDBLabelsPacked(py::array x)
 	{
-		if (x.unchecked<1>().shape(0) != m_db_size)
+		if (m_lc == LC_weighted && py::isinstance<py::array_t<uint32_t, py::array::c_style> >(x) && x.ndim() == 1
+			&& x.shape(0) == m_db_size)
 		{
-			throw std::runtime_error("Size of hashes block do not match the value provided at init");
+			py::array_t<uint64_t> bits({1, m_db_size});
+			const uint32_t* labels = static_cast<const uint32_t*>(x.data());
+			std::copy(labels, labels + m_db_size, bits.mutable_data());
+			LoadDBLabelBits(bits);
+		}
+		else if (m_lc != LC_equality)
+		{
+			if (!py::isinstance<py::array_t<uint64_t, py::array::c_style> >(x) || x.ndim() != 2 || x.shape(1) != m_db_size
+				|| x.shape(0) < 1)
+			{
+				throw std::runtime_error("Labels must be an uint64 array of shape [words, db_size]");
+			}
+			SetDBLabelWords((int)x.shape(0));
+			Borrow(m_labels_db_bits, m_labels_db_bits_owner, x, 0);
+		}
+		else
+		{
+			if (!py::isinstance<py::array_t<uint32_t, py::array::c_style> >(x) || x.ndim() != 1 || x.shape(0) != m_db_size)
+			{
+				throw std::runtime_error("Labels must be an uint32 array of shape [db_size]");
+			}
+			Borrow(m_labels_db, m_labels_db_owner, x, 0);
 		}
-		memcpy(m_labels_dbLDW, x.unchecked<1>().data(0), 8 * m_db_size);
 	}
 
-	py::array_t<uint32_t> Sort(int x)
+	// Real-valued embeddings, that the shortlist of the hash ranking is re-ranked by, arrays of shape [size, dim]
+	void LoadDBEmbeddings(py::array_t<float, py::array::c_style | py::array::forcecast> x)
 	{
-		calc_hamming_dist(x);
+		if (x.ndim() != 2 || x.shape(0) != m_db_size)
+		{
+			throw std::runtime_error("Embeddings must be an array of shape [db_size, dim]");
+		}
+		m_embedding_size = (int)x.shape(1);
+		m_db_embeddings.assign(x.data(), x.data() + x.size());
+	}
 
-		int32_t count[65];
-		int32_t total;
-		int32_t old_count;
-		int8_t key;
+	void LoadQueryEmbeddings(py::array_t<float, py::array::c_style | py::array::forcecast> x)
+	{
+		if (x.ndim() != 2 || x.shape(0) != m_query_size)
+		{
+			throw std::runtime_error("Embeddings must be an array of shape [query_size, dim]");
+		}
+		m_query_embedding_size = (int)x.shape(1);
+		m_query_embeddings.assign(x.data(), x.data() + x.size());
+	}
 
-		for (int i = 0; i < 65; ++i)
-			count[i] = 0;
-		for (int y = 0; y < m_db_size; ++y)
-			m_rank[y] = 0;
-		for (int y = 0; y < m_db_size; ++y)
-			count[m_dist[y]] += 1;
-		total = 0;
-		old_count = 0;
-		for (int i = 0; i < 65; ++i)
+	// Two-stage retrieval: the first shortlist items ranked by the distance of hashes are re-ranked by the dot
+	// product of embeddings. Returns mAP over the re-ranked shortlist, and precision at each of the cutoffs averaged
+	// over queries. AP is normalized by the number of relevant items in the shortlist, the same as mAP over top_n.
+	py::tuple RerankMap(int shortlist, std::vector<int> cutoffs)
+	{
+		shortlist = ClampTopN(shortlist);
+		for (int k: cutoffs)
 		{
-			old_count = count[i];
-			count[i] = total;
-			total += old_count;
+			if (k < 1 || k > shortlist)
+			{
+				throw std::runtime_error("Cutoffs must be in range [1, shortlist]");
+			}
 		}
-		for (int y = 0; y < m_db_size; ++y)
+		CheckEmbeddings();
+
+		int n = (int)cutoffs.size();
+		std::vector<float> precision((size_t)m_query_size * n);
 		{
-			key = m_dist[y];
-			m_tmp[y] = count[key];
-			count[key] += 1;
+			py::gil_scoped_release release;
+			ForEachQuery([this, shortlist, &cutoffs, &precision, n](int q, RankingScratch& s)
+			{
+				RerankQuery(q, s, shortlist);
+				switch(m_lc)
+				{
+				case LC_equality:
+					RerankAP<LC_equality>(q, s, shortlist, cutoffs, precision.data() + (size_t)q * n);
+					break;
+				case LC_and:
+					RerankAP<LC_and>(q, s, shortlist, cutoffs, precision.data() + (size_t)q * n);
+					break;
+				case LC_weighted:
+					RerankAP<LC_weighted>(q, s, shortlist, cutoffs, precision.data() + (size_t)q * n);
+					break;
+				}
+			});
 		}
-		for (int y = 0; y < m_db_size; ++y)
-			m_rank[m_tmp[y]] = y;
 
-		return py::array_t<uint32_t>(
-            {m_db_size},
-            {sizeof(uint32_t)},
-            m_rank);
+		// Summation is done in the query order, so the result does not depend on the number of threads
+		py::array_t<float> mean_precision(n);
+		float* p = mean_precision.mutable_data();
+		for (int i = 0; i < n; ++i)
+		{
+			double sum = 0.0;
+			for (int q = 0; q < m_query_size; ++q)
+			{
+				sum += precision[(size_t)q * n + i];
+			}
+			p[i] = (float)(sum / m_query_size);
+		}
+		return py::make_tuple(SumInQueryOrder(m_ap), mean_precision);
 	}
 
-	float Map()
+	// Indices of the re-ranked shortlist of each query, array of shape [query_size, shortlist]
+	py::array_t<uint32_t> Rerank(int shortlist)
 	{
-		switch(m_lc)
+		shortlist = ClampTopN(shortlist);
+		CheckEmbeddings();
+		py::array_t<uint32_t> result({m_query_size, shortlist});
+		uint32_t* out = result.mutable_data();
 		{
-		case LC_equality:
-			return MapEqual();
-			break;
-		case LC_and:
-			return MapAnd();
-			break;
-    case LC_weighted:
-      return MapWeighted();
-      break;
+			py::gil_scoped_release release;
+			ForEachQuery([this, shortlist, out](int q, RankingScratch& s)
+			{
+				RerankQuery(q, s, shortlist);
+				std::copy(s.reranked.begin(), s.reranked.begin() + shortlist, out + (size_t)q * shortlist);
+			});
 		}
+		return result;
+	}
 
-		return 0.0f;
+	// Evaluation of a DB split into shards, each loaded to its own context, possibly in another process. Shards
+	// must follow in the DB order. mAP is merged exactly, the result is the same as of the whole DB in one context.
+	// 1. ShardHistograms of every shard are summed to the histograms of the whole DB.
+	// 2. For TB_index, ShardIndexAP of every shard gets the rank and cumulative gain that precede the items of each
+	//    bucket of the shard, and returns the sums of precisions at its relevant items within top_n.
+	// 3. MergeShards computes mAP from the summed histograms or the sums of precisions.
+	// Histograms are sparse: with weighted distances there are 65536 buckets, but a query has at most as many
+	// non-empty buckets as the shard has items.
+
+	// Number of histogram buckets, the largest possible distance plus one
+	int GetBuckets() const
+	{
+		return m_max_dist + 1;
 	}
 
-	void calc_hamming_dist(int x)
+	// Per-query histograms of the distances of all items of the shard, for count queries from first, all queries by
+	// default. Returns non-empty buckets in CSR layout: indptr of shape [count + 1], and bucket, total, relevant and
+	// gain sum of shape [indptr[-1]]. Buckets of query i are bucket[indptr[i]:indptr[i + 1]] in increasing order
+	py::tuple ShardHistograms(int first, int count)
 	{
-		switch(m_hs)
-		{
-		case HS32b:
+		count = CheckQueryRange(first, count);
+		int buckets = m_max_dist + 1;
+		std::vector<std::vector<int32_t> > bucket_q(count);
+		std::vector<std::vector<int32_t> > total_q(count);
+		std::vector<std::vector<int32_t> > relevant_q(count);
+		std::vector<std::vector<int64_t> > gain_sum_q(count);
 		{
-			uint32_t* __restrict queryhashes = reinterpret_cast<uint32_t*>(m_queryhashes);
-			uint32_t* __restrict dbhashes = reinterpret_cast<uint32_t*>(m_dbhashes);
-
-			for (int j = 0; j < m_db_size; ++j)
+			py::gil_scoped_release release;
+			ForEachQuery(first, count, [&](int q, RankingScratch& s)
 			{
-				m_dist[j] = hamming_distance32(dbhashes[j], queryhashes[x]);
-			}
+				switch(m_lc)
+				{
+				case LC_equality:
+					Histogram<LC_equality>(q, s, m_db_size, TB_index, false, -1);
+					break;
+				case LC_and:
+					Histogram<LC_and>(q, s, m_db_size, TB_index, false, -1);
+					break;
+				case LC_weighted:
+					Histogram<LC_weighted>(q, s, m_db_size, TB_index, false, -1);
+					break;
+				}
+				int i = q - first;
+				for (int b = 0; b < buckets; ++b)
+				{
+					if (s.total[b] != 0)
+					{
+						bucket_q[i].push_back(b);
+						total_q[i].push_back(s.total[b]);
+						relevant_q[i].push_back(s.relevant[b]);
+						gain_sum_q[i].push_back(s.gain_sum[b]);
+					}
+				}
+			});
+		}
 
-			break;
+		py::array_t<int64_t> indptr(count + 1);
+		int64_t* indptr_out = indptr.mutable_data();
+		indptr_out[0] = 0;
+		for (int i = 0; i < count; ++i)
+		{
+			indptr_out[i + 1] = indptr_out[i] + bucket_q[i].size();
 		}
-		case HS64b:
+		py::ssize_t nnz = indptr_out[count];
+		py::array_t<int32_t> bucket(nnz);
+		py::array_t<int32_t> total(nnz);
+		py::array_t<int32_t> relevant(nnz);
+		py::array_t<int64_t> gain_sum(nnz);
+		for (int i = 0; i < count; ++i)
 		{
-			uint64_t* __restrict queryhashes = reinterpret_cast<uint64_t*>(m_queryhashes);
-			uint64_t* __restrict dbhashes = reinterpret_cast<uint64_t*>(m_dbhashes);
+			std::copy(bucket_q[i].begin(), bucket_q[i].end(), bucket.mutable_data() + indptr_out[i]);
+			std::copy(total_q[i].begin(), total_q[i].end(), total.mutable_data() + indptr_out[i]);
+			std::copy(relevant_q[i].begin(), relevant_q[i].end(), relevant.mutable_data() + indptr_out[i]);
+			std::copy(gain_sum_q[i].begin(), gain_sum_q[i].end(), gain_sum.mutable_data() + indptr_out[i]);
+		}
+		return py::make_tuple(indptr, bucket, total, relevant, gain_sum);
+	}
 
-			for (int j = 0; j < m_db_size; ++j)
+	// Sums of precisions at relevant items of the shard, ranked with TB_index, and the number of these items, for
+	// count queries from first. indptr and bucket are the non-empty buckets returned by ShardHistograms. base_rank and
+	// base_gain of each of them are the number of items and their gain that are ranked before the items of the shard
+	// in that bucket: all items of preceding buckets, and items of the bucket in preceding shards. Only items within
+	// the global top_n are accounted.
+	py::tuple ShardIndexAP(py::array_t<int64_t, py::array::c_style | py::array::forcecast> indptr,
+		py::array_t<int32_t, py::array::c_style | py::array::forcecast> bucket,
+		py::array_t<int32_t, py::array::c_style | py::array::forcecast> base_rank,
+		py::array_t<int64_t, py::array::c_style | py::array::forcecast> base_gain, int top_n, int first)
+	{
+		if (indptr.ndim() != 1 || indptr.shape(0) < 1)
+		{
+			throw std::runtime_error("indptr must be an array of shape [count + 1]");
+		}
+		int count = CheckQueryRange(first, (int)indptr.shape(0) - 1);
+		const int64_t* ptr = indptr.data();
+		py::ssize_t nnz = ptr[count];
+		if (bucket.ndim() != 1 || bucket.shape(0) != nnz || base_rank.ndim() != 1 || base_rank.shape(0) != nnz
+			|| base_gain.ndim() != 1 || base_gain.shape(0) != nnz)
+		{
+			throw std::runtime_error("Buckets and bases must be arrays of shape [indptr[-1]]");
+		}
+		const int32_t* b = bucket.data();
+		for (py::ssize_t e = 0; e < nnz; ++e)
+		{
+			if (b[e] < 0 || b[e] > m_max_dist)
 			{
-				m_dist[j] = hamming_distance64(dbhashes[j], queryhashes[x]);
+				throw std::runtime_error("Bucket is out of range");
 			}
-			break;
 		}
+		py::array_t<int64_t> ap(count);
+		py::array_t<int32_t> relevant(count);
+		int64_t* ap_out = ap.mutable_data();
+		int32_t* relevant_out = relevant.mutable_data();
+		const int32_t* rank = base_rank.data();
+		const int64_t* gain = base_gain.data();
+		{
+			py::gil_scoped_release release;
+			ForEachQuery(first, count, [&](int q, RankingScratch& s)
+			{
+				int i = q - first;
+				// Buckets that are empty in the shard are never read
+				for (int64_t e = ptr[i]; e < ptr[i + 1]; ++e)
+				{
+					s.position[b[e]] = rank[e];
+					s.cumulative_gain[b[e]] = gain[e];
+				}
+				switch(m_lc)
+				{
+				case LC_equality:
+					ShardIndexAPQuery<LC_equality>(q, s, top_n, ap_out[i], relevant_out[i]);
+					break;
+				case LC_and:
+					ShardIndexAPQuery<LC_and>(q, s, top_n, ap_out[i], relevant_out[i]);
+					break;
+				case LC_weighted:
+					ShardIndexAPQuery<LC_weighted>(q, s, top_n, ap_out[i], relevant_out[i]);
+					break;
+				}
+			});
 		}
+		return py::make_tuple(ap, relevant);
 	}
 
-private:
-
-	float MapAnd()
+	// mAP of the whole DB of db_size items from the summed histograms of the shards, or, for TB_index, from the sums
+	// of ShardIndexAP results. Does not need Init. Returns mAP and AP of each query.
+	py::tuple MergeShards(int db_size, int top_n, int tb,
+		py::array_t<int32_t, py::array::c_style | py::array::forcecast> total,
+		py::array_t<int32_t, py::array::c_style | py::array::forcecast> relevant,
+		py::array_t<int64_t, py::array::c_style | py::array::forcecast> gain_sum,
+		py::array_t<int64_t, py::array::c_style | py::array::forcecast> index_ap,
+		py::array_t<int32_t, py::array::c_style | py::array::forcecast> index_relevant)
 	{
-		float map = 0;
-
-		float number_of_relative_docs;
+		int query_size = (int)total.shape(0);
+		int buckets = (int)total.shape(1);
+		top_n = top_n <= 0 || top_n > db_size ? db_size : top_n;
+		py::array_t<float> ap(query_size);
+		float* ap_out = ap.mutable_data();
 
-		for (int q =0; q < m_query_size; ++q)
+		if (tb == TB_average)
 		{
-			Sort(q);
-
-			for (int i =0; i < m_db_size; ++i)
+			m_harmonic.resize(db_size + 1);
+			m_harmonic[0] = 0.0;
+			for (int i = 1; i <= db_size; ++i)
+			{
+				m_harmonic[i] = m_harmonic[i - 1] + 1.0 / i;
+			}
+			RankingScratch s;
+			s.Resize(0, buckets);
+			for (int q = 0; q < query_size; ++q)
 			{
-				int index = m_rank[i];
-				m_relevance[i] =
-					((m_labels_queryLDW[q] & m_labels_dbLDW[index]) | (m_labels_queryHDW[q] & m_labels_dbHDW[index])) != 0;
+				std::copy(total.data(q, 0), total.data(q, 0) + buckets, s.total.begin());
+				std::copy(relevant.data(q, 0), relevant.data(q, 0) + buckets, s.relevant.begin());
+				std::copy(gain_sum.data(q, 0), gain_sum.data(q, 0) + buckets, s.gain_sum.begin());
+				// The same cutoff as Histogram sets
+				if (top_n == db_size)
+				{
+					s.cutoff_bucket = buckets - 1;
+					s.cutoff_count = s.total[buckets - 1];
+				}
+				else
+				{
+					SetCutoff(s, top_n);
+				}
+				ap_out[q] = APTieAveraged(s);
 			}
-			m_cumulative[0] = m_relevance[0];
-			for (int i = 1; i < m_db_size; ++i)
+		}
+		else
+		{
+			for (int q = 0; q < query_size; ++q)
 			{
-				m_cumulative[i] = m_relevance[i] + m_cumulative[i-1];
+				ap_out[q] = IndexOrderAP(index_ap.data()[q], index_relevant.data()[q]);
 			}
-			number_of_relative_docs = m_cumulative[m_db_size-1];
+		}
+
+		// Summation is done in the query order, the same as RunMap does
+		float map = 0.0f;
+		for (int q = 0; q < query_size; ++q)
+		{
+			map += ap_out[q];
+		}
+		map /= query_size;
+		return py::make_tuple(map, ap);
+	}
 
-			if (number_of_relative_docs != 0)
+	// First k items ranked for each query and their distances, arrays of shape [query_size, k]. k is limited by the
+	// DB size. Items at equal distance are ranked in the DB order, the same as Sort does
+	py::tuple TopK(int k)
+	{
+		k = ClampTopN(k);
+		py::array_t<uint32_t> indices({m_query_size, k});
+		py::array_t<uint16_t> distances({m_query_size, k});
+		uint32_t* indices_out = indices.mutable_data();
+		uint16_t* distances_out = distances.mutable_data();
+		{
+			py::gil_scoped_release release;
+			ForEachQuery([this, k, indices_out, distances_out](int q, RankingScratch& s)
 			{
-				for (int i = 0; i < m_db_size; ++i)
+				Sort(q, s, k);
+				for (int i = 0; i < k; ++i)
 				{
-					m_precision[i] = m_cumulative[i] / (i+1);
+					indices_out[(size_t)q * k + i] = s.rank[i];
+					distances_out[(size_t)q * k + i] = s.dist[s.rank[i]];
 				}
-				float ap = fdot(m_db_size, m_precision, m_relevance);
-				ap /= number_of_relative_docs;
-				map += ap;
-			}
+			});
 		}
+		return py::make_tuple(indices, distances);
+	}
 
-		map /= m_query_size;
+	py::array_t<uint32_t> Sort(int x, int top_n)
+	{
+		RankingScratch& s = m_scratch[0];
+		int size = Sort(x, s, top_n);
 
-		return map;
+		return py::array_t<uint32_t>(
+            {size},
+            {sizeof(uint32_t)},
+            s.rank.data());
 	}
 
+	// mAP over first top_n ranked items, all DB if top_n is 0.
+	// If radius is not negative, hash lookup within the radius is evaluated in the same pass, see RadiusMetrics
+	float Map(int top_n, int tb, int radius)
+	{
+		return RunMap(ClampTopN(top_n), tb, nullptr, radius);
+	}
 
-	float MapEqual()
+	// Metrics of the hash lookup within the radius given to the last Map or MapCurve call: every item within
+	// the radius is retrieved. Returns precision, recall and number of retrieved items, averaged over queries.
+	// Precision of a query that retrieves nothing is zero.
+	py::tuple RadiusMetrics() const
 	{
-		float map = 0.0f;
+		if (m_radius < 0)
+		{
+			throw std::runtime_error("Last mAP evaluation was done without radius");
+		}
+		// Summation is done in the query order, so the result does not depend on the number of threads
+		double precision = 0.0;
+		double recall = 0.0;
+		double candidates = 0.0;
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			precision += m_radius_precision[q];
+			recall += m_radius_recall[q];
+			candidates += m_radius_candidates[q];
+		}
+		return py::make_tuple(precision / m_query_size, recall / m_query_size, candidates / m_query_size);
+	}
 
-		float number_of_relative_docs;
+	// AP of each query of the last mAP evaluation
+	py::array_t<float> QueryAP() const
+	{
+		py::array_t<float> result(m_query_size);
+		memcpy(result.mutable_data(), m_ap, sizeof(float) * m_query_size);
+		return result;
+	}
 
-		for (int q =0; q < m_query_size; ++q)
+	// Same as Map, but also returns precision and recall averaged over queries, as an array of shape [n, 2].
+	// Rows are ranks from 1 to top_n, or the given cutoffs if there are any. Format is the same as the curve
+	// returned by calc_map.
+	py::tuple MapCurve(int top_n, int tb, std::vector<int> cutoffs, int radius)
+	{
+		top_n = ClampTopN(top_n);
+		if (cutoffs.empty())
 		{
-			Sort(q);
-
-			for (int i =0; i < m_db_size; ++i)
+			for (int k = 1; k <= top_n; ++k)
 			{
-				int index = m_rank[i];
-				m_relevance[i] =
-					((m_labels_query[q] == m_labels_db[index])) ? 1.0f : 0.0f;
+				cutoffs.push_back(k);
 			}
-			m_cumulative[0] = m_relevance[0];
-			for (int i = 1; i < m_db_size; ++i)
+		}
+		for (int k: cutoffs)
+		{
+			if (k < 1 || k > top_n)
 			{
-				m_cumulative[i] = m_relevance[i] + m_cumulative[i-1];
+				throw std::runtime_error("Cutoffs must be in range [1, top_n]");
 			}
-			number_of_relative_docs = m_cumulative[m_db_size-1];
+		}
 
-			if (number_of_relative_docs != 0)
-			{
-				for (int i = 0; i < m_db_size; ++i)
+		int n = (int)cutoffs.size();
+		float map;
+		std::vector<int64_t> precision_sum(n, 0);
+		std::vector<int64_t> recall_sum(n, 0);
+		{
+			py::gil_scoped_release release;
+
+			int length = *std::max_element(cutoffs.begin(), cutoffs.end());
+			for (auto& scratch: m_scratch)
+			{
+				scratch.cum_at_rank.resize(length);
+				scratch.precision_sum.assign(n, 0);
+				scratch.recall_sum.assign(n, 0);
+			}
+
+			map = RunMap(top_n, tb, &cutoffs, radius);
+
+			for (auto& scratch: m_scratch)
+			{
+				for (int i = 0; i < n; ++i)
+				{
+					precision_sum[i] += scratch.precision_sum[i];
+					recall_sum[i] += scratch.recall_sum[i];
+				}
+			}
+		}
+
+		float* curve = new float[2 * n];
+		for (int i = 0; i < n; ++i)
+		{
+			curve[2 * i + 0] = (float)(std::ldexp((double)precision_sum[i], -CurveFractionBits) / m_query_size);
+			curve[2 * i + 1] = (float)(std::ldexp((double)recall_sum[i], -CurveFractionBits) / m_query_size);
+		}
+		py::capsule owner(curve, [](void* p) { delete[] reinterpret_cast<float*>(p); });
+
+		return py::make_tuple(map, py::array_t<float>(
+            {n, 2},
+            {2 * sizeof(float), sizeof(float)},
+            curve,
+            owner));
+	}
+
+	void calc_hamming_dist(int x)
+	{
+		calc_hamming_dist(x, m_scratch[0]);
+	}
+
+	// Incremental rotation search. A rotation in the plane of two hash dimensions (Givens rotation) changes at most
+	// two bits of each hash. The full distance matrix and per-query histograms are kept, so a proposal only needs
+	// to visit the pairs where one of the two bits changed, and AP is recomputed from the histograms.
+	// AP is tie averaged (TB_average), as the rank inside of distance buckets is not tracked.
+
+	// Computes the distance matrix and histograms for the loaded hashes and labels. Returns mAP over top_n
+	float StartRotationSearch(int top_n)
+	{
+		if (m_dbhashes_owner)
+		{
+			throw std::runtime_error("Rotation search modifies DB hashes, they must be loaded with LoadDBHashes");
+		}
+		if (m_distance != DM_hamming)
+		{
+			throw std::runtime_error("Rotation search requires the hamming distance");
+		}
+		m_search_top_n = ClampTopN(top_n);
+		int buckets = m_bits + 1;
+		m_search_dist.resize((size_t)m_query_size * m_db_size);
+		m_search_total.resize((size_t)m_query_size * buckets);
+		m_search_relevant.resize((size_t)m_query_size * buckets);
+		m_search_gain_sum.resize((size_t)m_query_size * buckets);
+		m_search_ap.resize(m_query_size);
+		m_proposal_ap.resize(m_query_size);
+		m_db_pair.resize(m_db_size);
+		m_proposal_db_pair.resize(m_db_size);
+		m_query_pair.resize(m_query_size);
+		m_proposal_query_pair.resize(m_query_size);
+
+		{
+			py::gil_scoped_release release;
+
+			ForEachQuery([this, buckets](int q, RankingScratch& s)
+			{
+				switch(m_lc)
+				{
+				case LC_equality:
+					Histogram<LC_equality>(q, s, m_db_size, TB_average, false, -1);
+					break;
+				case LC_and:
+					Histogram<LC_and>(q, s, m_db_size, TB_average, false, -1);
+					break;
+				case LC_weighted:
+					Histogram<LC_weighted>(q, s, m_db_size, TB_average, false, -1);
+					break;
+				}
+				std::copy(s.dist.begin(), s.dist.end(), m_search_dist.begin() + (size_t)q * m_db_size);
+				std::copy(s.total.begin(), s.total.end(), m_search_total.begin() + (size_t)q * buckets);
+				std::copy(s.relevant.begin(), s.relevant.end(), m_search_relevant.begin() + (size_t)q * buckets);
+				std::copy(s.gain_sum.begin(), s.gain_sum.end(), m_search_gain_sum.begin() + (size_t)q * buckets);
+				SetCutoff(s, m_search_top_n);
+				m_search_ap[q] = APTieAveraged(s);
+			});
+		}
+		m_proposal_valid = false;
+
+		return SumInQueryOrder(m_search_ap);
+	}
+
+	// Evaluates rotation in the plane of dimensions a and b. db_bits and query_bits are the new values of bits a and
+	// b of every hash, arrays of shape [size, 2]. Returns mAP the rotation would give, nothing is changed until
+	// CommitProposal is called.
+	float ProposeColumns(int a, int b, py::array_t<uint8_t, py::array::c_style | py::array::forcecast> db_bits,
+		py::array_t<uint8_t, py::array::c_style | py::array::forcecast> query_bits)
+	{
+		if (m_search_ap.empty())
+		{
+			throw std::runtime_error("StartRotationSearch must be called first");
+		}
+		if (a < 0 || b < 0 || a >= m_bits || b >= m_bits || a == b)
+		{
+			throw std::runtime_error("Dimensions must be two different bits of the hash");
+		}
+		if (db_bits.ndim() != 2 || db_bits.shape(0) != m_db_size || db_bits.shape(1) != 2
+			|| query_bits.ndim() != 2 || query_bits.shape(0) != m_query_size || query_bits.shape(1) != 2)
+		{
+			throw std::runtime_error("Bits must be arrays of shape [db_size, 2] and [query_size, 2]");
+		}
+		m_proposal_a = a;
+		m_proposal_b = b;
+
+		// Bits a and b of each hash are packed to a two bit value, the distance changes by the difference of
+		// popcounts of xor of these values before and after the rotation
+		const uint8_t* new_db_bits = db_bits.data();
+		m_changed_db.clear();
+		for (int j = 0; j < m_db_size; ++j)
+		{
+			m_db_pair[j] = GetBit(m_dbhashes, j, a) | (GetBit(m_dbhashes, j, b) << 1);
+			m_proposal_db_pair[j] = (new_db_bits[2 * j] != 0) | ((new_db_bits[2 * j + 1] != 0) << 1);
+			if (m_db_pair[j] != m_proposal_db_pair[j])
+			{
+				m_changed_db.push_back(j);
+			}
+		}
+		const uint8_t* new_query_bits = query_bits.data();
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			m_query_pair[q] = GetBit(m_queryhashes, q, a) | (GetBit(m_queryhashes, q, b) << 1);
+			m_proposal_query_pair[q] = (new_query_bits[2 * q] != 0) | ((new_query_bits[2 * q + 1] != 0) << 1);
+		}
+
+		{
+			py::gil_scoped_release release;
+			UpdateSearch(false);
+		}
+		m_proposal_valid = true;
+
+		return SumInQueryOrder(m_proposal_ap);
+	}
+
+	// Applies the last proposal to the distance matrix, histograms and hashes
+	void CommitProposal()
+	{
+		if (!m_proposal_valid)
+		{
+			throw std::runtime_error("There is no proposal to commit");
+		}
+		{
+			py::gil_scoped_release release;
+			UpdateSearch(true);
+		}
+		for (int j: m_changed_db)
+		{
+			SetBit(m_dbhashes, j, m_proposal_a, m_proposal_db_pair[j] & 1);
+			SetBit(m_dbhashes, j, m_proposal_b, m_proposal_db_pair[j] >> 1);
+		}
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			SetBit(m_queryhashes, q, m_proposal_a, m_proposal_query_pair[q] & 1);
+			SetBit(m_queryhashes, q, m_proposal_b, m_proposal_query_pair[q] >> 1);
+		}
+		m_search_ap.swap(m_proposal_ap);
+		m_proposal_valid = false;
+	}
+
+private:
+	// Curve values are accumulated as fixed point integers, so that the sums do not depend on how queries are
+	// split between threads
+	enum { CurveFractionBits = 32 };
+
+	// AP with TB_index is summed as fixed point integers for the same reason. Terms are at most 255 (largest gain),
+	// so the sum fits 64 bits for up to 2^31 relevant items
+	enum { APFractionBits = 24 };
+
+	void Release()
+	{
+		// DB buffers that were borrowed from numpy arrays are released together with their owners
+		if (!m_dbhashes_owner)
+			delete[] m_dbhashes;
+		delete[] m_queryhashes;
+		if (!m_labels_db_owner)
+			delete[] m_labels_db;
+		delete[] m_labels_query;
+		if (!m_labels_db_bits_owner)
+			delete[] m_labels_db_bits;
+		delete[] m_labels_query_bits;
+		delete[] m_ap;
+
+		m_dbhashes = nullptr;
+		m_queryhashes = nullptr;
+		m_labels_db = nullptr;
+		m_labels_query = nullptr;
+		m_labels_db_bits = nullptr;
+		m_labels_query_bits = nullptr;
+		m_db_label_words = 0;
+		m_query_label_words = 0;
+		m_label_words = 0;
+		m_ap = nullptr;
+		m_dbhashes_owner = py::object();
+		m_labels_db_owner = py::object();
+		m_labels_db_bits_owner = py::object();
+		m_db_embeddings.clear();
+		m_query_embeddings.clear();
+		StopRotationSearch();
+	}
+
+	// Switches distance mode. The number of distance buckets changes, so the scratch buffers are resized
+	void SetDistance(DistanceMode distance, int max_dist)
+	{
+		m_distance = distance;
+		if (distance != DM_weighted)
+		{
+			m_weight_scale = 1;
+		}
+		if (max_dist != m_max_dist)
+		{
+			m_max_dist = max_dist;
+			SetThreadCount(m_thread_count);
+		}
+	}
+
+	// Hashes changed, the state of the rotation search is not valid anymore
+	void StopRotationSearch()
+	{
+		m_search_ap.clear();
+		m_proposal_valid = false;
+	}
+
+	float SumInQueryOrder(const float* ap) const
+	{
+		// Summation is done in the query order, so the result does not depend on the number of threads
+		float map = 0.0f;
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			map += ap[q];
+		}
+		return map / m_query_size;
+	}
+
+	float SumInQueryOrder(const std::vector<float>& ap) const
+	{
+		return SumInQueryOrder(ap.data());
+	}
+
+	void CheckEmbeddings() const
+	{
+		if (m_db_embeddings.empty() || m_query_embeddings.empty())
+		{
+			throw std::runtime_error("Embeddings of DB and queries must be loaded first");
+		}
+		if (m_embedding_size != m_query_embedding_size)
+		{
+			throw std::runtime_error("Embeddings of DB and queries have different size");
+		}
+	}
+
+	// Ranks the first shortlist items by the distance of hashes, then sorts them by the dot product of embeddings.
+	// Items with equal dot product keep the order of the hash ranking
+	void RerankQuery(int q, RankingScratch& s, int shortlist)
+	{
+		Sort(q, s, shortlist);
+		s.score.resize(shortlist);
+		s.order.resize(shortlist);
+		s.reranked.resize(shortlist);
+		float* query = m_query_embeddings.data() + (size_t)q * m_embedding_size;
+		for (int i = 0; i < shortlist; ++i)
+		{
+			s.score[i] = fdot(m_embedding_size, query, m_db_embeddings.data() + (size_t)s.rank[i] * m_embedding_size);
+			s.order[i] = i;
+		}
+		const float* score = s.score.data();
+		std::stable_sort(s.order.begin(), s.order.end(), [score](uint32_t a, uint32_t b)
+		{
+			return score[a] > score[b];
+		});
+		for (int i = 0; i < shortlist; ++i)
+		{
+			s.reranked[i] = s.rank[s.order[i]];
+		}
+	}
+
+	// position and cumulative_gain of s are set to the bases of the non-empty buckets of the query by ShardIndexAP
+	template<int LC>
+	void ShardIndexAPQuery(int q, RankingScratch& s, int top_n, int64_t& ap, int32_t& relevant)
+	{
+		calc_hamming_dist(q, s);
+		const uint16_t* __restrict dist = s.dist.data();
+		int32_t* __restrict position = s.position.data();
+		int64_t* __restrict cumulative_gain = s.cumulative_gain.data();
+
+		ap = 0;
+		relevant = 0;
+		for (int j = 0; j < m_db_size; ++j)
+		{
+			uint16_t d = dist[j];
+			if (position[d] >= top_n)
+			{
+				continue;
+			}
+			position[d] += 1;
+			uint8_t g = Gain<LC>(q, j);
+			if (g > 0)
+			{
+				cumulative_gain[d] += g;
+				ap += PrecisionTerm(cumulative_gain[d], position[d]);
+				relevant += 1;
+			}
+		}
+	}
+
+	// AP of the re-ranked shortlist, weighted by ACG for weighted comparison, and precision at the cutoffs
+	template<int LC>
+	void RerankAP(int q, RankingScratch& s, int shortlist, const std::vector<int>& cutoffs, float* precision)
+	{
+		double ap = 0.0;
+		int64_t cumulative_gain = 0;
+		int32_t relevant = 0;
+		for (int i = 0; i < shortlist; ++i)
+		{
+			uint8_t g = Gain<LC>(q, s.reranked[i]);
+			if (g > 0)
+			{
+				cumulative_gain += g;
+				relevant += 1;
+				ap += (double)cumulative_gain / (i + 1);
+			}
+			for (size_t c = 0; c < cutoffs.size(); ++c)
+			{
+				if (cutoffs[c] == i + 1)
+				{
+					precision[c] = (float)relevant / (i + 1);
+				}
+			}
+		}
+		m_ap[q] = relevant == 0 ? 0.0f : (float)(ap / relevant);
+	}
+
+	bool GetBit(const uint8_t* hashes, int j, int k) const
+	{
+		switch(m_hs)
+		{
+		case HS32b:
+			return (reinterpret_cast<const uint32_t*>(hashes)[j] >> k) & 1;
+		case HS64b:
+			return (reinterpret_cast<const uint64_t*>(hashes)[j] >> k) & 1;
+		default:
+			return (reinterpret_cast<const uint64_t*>(hashes)[(size_t)j * m_words + k / 64] >> (k % 64)) & 1;
+		}
+	}
+
+	void SetBit(uint8_t* hashes, int j, int k, bool value)
+	{
+		switch(m_hs)
+		{
+		case HS32b:
+		{
+			uint32_t& word = reinterpret_cast<uint32_t*>(hashes)[j];
+			word = (word & ~(uint32_t(1) << k)) | (uint32_t(value) << k);
+			break;
+		}
+		case HS64b:
+		{
+			uint64_t& word = reinterpret_cast<uint64_t*>(hashes)[j];
+			word = (word & ~(uint64_t(1) << k)) | (uint64_t(value) << k);
+			break;
+		}
+		default:
+		{
+			uint64_t& word = reinterpret_cast<uint64_t*>(hashes)[(size_t)j * m_words + k / 64];
+			word = (word & ~(uint64_t(1) << (k % 64))) | (uint64_t(value) << (k % 64));
+			break;
+		}
+		}
+	}
+
+	// Finds the bucket where the first top_n ranked items end, from the total counts only
+	void SetCutoff(RankingScratch& s, int top_n)
+	{
+		int32_t offset = 0;
+		int cutoff = 0;
+		while (offset + s.total[cutoff] < top_n)
+		{
+			offset += s.total[cutoff];
+			++cutoff;
+		}
+		s.cutoff_bucket = cutoff;
+		s.cutoff_count = top_n - offset;
+	}
+
+	void UpdateSearch(bool commit)
+	{
+		switch(m_lc)
+		{
+		case LC_equality:
+			ForEachQuery([this, commit](int q, RankingScratch& s) { UpdateSearchQuery<LC_equality>(q, s, commit); });
+			break;
+		case LC_and:
+			ForEachQuery([this, commit](int q, RankingScratch& s) { UpdateSearchQuery<LC_and>(q, s, commit); });
+			break;
+		case LC_weighted:
+			ForEachQuery([this, commit](int q, RankingScratch& s) { UpdateSearchQuery<LC_weighted>(q, s, commit); });
+			break;
+		}
+	}
+
+	// Moves the pairs affected by the proposal between buckets of the histograms of the query. If the query bits
+	// do not change, only DB items with changed bits are visited. The result goes to m_proposal_ap, and, if commit
+	// is set, to the distance matrix and histograms.
+	template<int LC>
+	void UpdateSearchQuery(int q, RankingScratch& s, bool commit)
+	{
+		uint8_t query_pair = m_query_pair[q];
+		uint8_t proposal_query_pair = m_proposal_query_pair[q];
+		if (query_pair == proposal_query_pair && m_changed_db.empty())
+		{
+			m_proposal_ap[q] = m_search_ap[q];
+			return;
+		}
+
+		int buckets = m_bits + 1;
+		int32_t* __restrict total = s.total.data();
+		int32_t* __restrict relevant = s.relevant.data();
+		int64_t* __restrict gain_sum = s.gain_sum.data();
+		uint16_t* __restrict dist = m_search_dist.data() + (size_t)q * m_db_size;
+		std::copy(m_search_total.begin() + (size_t)q * buckets, m_search_total.begin() + (size_t)(q + 1) * buckets, total);
+		std::copy(m_search_relevant.begin() + (size_t)q * buckets, m_search_relevant.begin() + (size_t)(q + 1) * buckets, relevant);
+		std::copy(m_search_gain_sum.begin() + (size_t)q * buckets, m_search_gain_sum.begin() + (size_t)(q + 1) * buckets, gain_sum);
+
+		auto update = [&](int j)
+		{
+			int delta = popcount32(proposal_query_pair ^ m_proposal_db_pair[j]) - popcount32(query_pair ^ m_db_pair[j]);
+			if (delta == 0)
+			{
+				return;
+			}
+			int d = dist[j];
+			int new_d = d + delta;
+			total[d] -= 1;
+			total[new_d] += 1;
+			uint8_t g = Gain<LC>(q, j);
+			if (g > 0)
+			{
+				relevant[d] -= 1;
+				relevant[new_d] += 1;
+				gain_sum[d] -= g;
+				gain_sum[new_d] += g;
+			}
+			if (commit)
+			{
+				dist[j] = (uint16_t)new_d;
+			}
+		};
+
+		if (query_pair != proposal_query_pair)
+		{
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				update(j);
+			}
+		}
+		else
+		{
+			for (int j: m_changed_db)
+			{
+				update(j);
+			}
+		}
+
+		SetCutoff(s, m_search_top_n);
+		m_proposal_ap[q] = APTieAveraged(s);
+
+		if (commit)
+		{
+			std::copy(total, total + buckets, m_search_total.begin() + (size_t)q * buckets);
+			std::copy(relevant, relevant + buckets, m_search_relevant.begin() + (size_t)q * buckets);
+			std::copy(gain_sum, gain_sum + buckets, m_search_gain_sum.begin() + (size_t)q * buckets);
+		}
+	}
+
+	// Points buffer to the data of x starting at the given element, instead of the buffer allocated at init.
+	// x is kept alive by the owner reference while the buffer is in use
+	template<typename P>
+	static void Borrow(P& buffer, py::object& owner, const py::array& x, size_t offset)
+	{
+		if (!owner)
+		{
+			delete[] buffer;
+		}
+		typedef typename std::remove_reference<decltype(*buffer)>::type T;
+		buffer = const_cast<T*>(static_cast<const T*>(x.data())) + offset;
+		owner = x;
+	}
+
+	int ClampTopN(int top_n) const
+	{
+		return top_n <= 0 || top_n > m_db_size ? m_db_size : top_n;
+	}
+
+	float RunMap(int top_n, int tb, const std::vector<int>* cutoffs, int radius)
+	{
+		if (m_distance == DM_asymmetric && radius >= 0)
+		{
+			throw std::runtime_error("Lookup radius is not defined for the asymmetric distance");
+		}
+		m_radius = radius;
+		// Hamming radius in terms of the weighted key: everything up to the last key of the bucket of the radius
+		if (radius >= 0)
+		{
+			radius = std::min(std::min(radius, m_bits) * m_weight_scale + m_weight_scale - 1, m_max_dist);
+		}
+		ForEachQuery([this, top_n, tb, cutoffs, radius](int q, RankingScratch& s)
+		{
+			bool curve = cutoffs != nullptr;
+			switch(m_lc)
+			{
+			case LC_equality:
+				Histogram<LC_equality>(q, s, top_n, tb, curve, radius);
+				break;
+			case LC_and:
+				Histogram<LC_and>(q, s, top_n, tb, curve, radius);
+				break;
+			case LC_weighted:
+				Histogram<LC_weighted>(q, s, top_n, tb, curve, radius);
+				break;
+			}
+			m_ap[q] = tb == TB_average ? APTieAveraged(s) : APIndexOrder(s, curve);
+			if (radius >= 0)
+			{
+				m_radius_precision[q] = s.radius_total > 0 ? (float)s.radius_relevant / s.radius_total : 0.0f;
+				m_radius_recall[q] = s.total_relevant > 0 ? (float)s.radius_relevant / s.total_relevant : 0.0f;
+				m_radius_candidates[q] = s.radius_total;
+			}
+			if (curve)
+			{
+				if (tb == TB_average)
+				{
+					ExpectedRelevantAtRank(s);
+				}
+				AccumulateCurve(s, *cutoffs);
+			}
+		});
+
+		// Summation is done in the query order, so the result does not depend on the number of threads
+		float map = 0.0f;
+		for (int q = 0; q < m_query_size; ++q)
+		{
+			map += m_ap[q];
+		}
+		map /= m_query_size;
+
+		return map;
+	}
+
+	// Expected number of relevant items at every rank when ties are ordered randomly
+	void ExpectedRelevantAtRank(RankingScratch& s)
+	{
+		int length = (int)s.cum_at_rank.size();
+		int32_t offset = 0;
+		int32_t relevant_offset = 0;
+		for (int i = 0; i <= s.cutoff_bucket && offset < length; ++i)
+		{
+			int32_t t = s.total[i];
+			double r = s.relevant[i];
+			for (int k = 1; k <= t && offset + k <= length; ++k)
+			{
+				s.cum_at_rank[offset + k - 1] = relevant_offset + r * k / t;
+			}
+			offset += t;
+			relevant_offset += s.relevant[i];
+		}
+	}
+
+	void AccumulateCurve(RankingScratch& s, const std::vector<int>& cutoffs)
+	{
+		if (s.total_relevant == 0)
+		{
+			return;
+		}
+		for (size_t i = 0; i < cutoffs.size(); ++i)
+		{
+			double cumulative = s.cum_at_rank[cutoffs[i] - 1];
+			s.precision_sum[i] += std::llround(std::ldexp(cumulative / cutoffs[i], CurveFractionBits));
+			s.recall_sum[i] += std::llround(std::ldexp(cumulative / s.total_relevant, CurveFractionBits));
+		}
+	}
+
+	// Splits the query set between m_thread_count workers. Each worker has its own scratch buffers.
+	template<typename F>
+	void ForEachQuery(F f)
+	{
+		ForEachQuery(0, m_query_size, f);
+	}
+
+	// The same for count queries from first
+	template<typename F>
+	void ForEachQuery(int first, int count, F f)
+	{
+		ParallelFor(count, m_thread_count, [this, first, &f](int i, int t)
+		{
+			f(first + i, m_scratch[t]);
+		});
+	}
+
+	// Number of queries in range of count queries from first, the rest of the queries if count is negative
+	int CheckQueryRange(int first, int count) const
+	{
+		if (count < 0)
+		{
+			count = m_query_size - first;
+		}
+		if (first < 0 || count < 0 || first + count > m_query_size)
+		{
+			throw std::runtime_error("Query range is out of the query set");
+		}
+		return count;
+	}
+
+	// Counting sort by hamming distance. Only first top_n positions of the rank are materialized
+	int Sort(int x, RankingScratch& s, int top_n)
+	{
+		calc_hamming_dist(x, s);
+
+		if (top_n <= 0 || top_n > m_db_size)
+		{
+			top_n = m_db_size;
+		}
+
+		uint16_t* __restrict m_dist = s.dist.data();
+		uint32_t* __restrict m_rank = s.rank.data();
+		int32_t* __restrict count = s.total.data();
+		int32_t total;
+		int32_t old_count;
+
+		for (int i = 0; i <= m_max_dist; ++i)
+			count[i] = 0;
+		for (int y = 0; y < m_db_size; ++y)
+			count[m_dist[y]] += 1;
+		total = 0;
+		old_count = 0;
+		for (int i = 0; i <= m_max_dist; ++i)
+		{
+			old_count = count[i];
+			count[i] = total;
+			total += old_count;
+		}
+		for (int y = 0; y < m_db_size; ++y)
+		{
+			int32_t position = count[m_dist[y]]++;
+			if (position < top_n)
+			{
+				m_rank[position] = y;
+			}
+		}
+		return top_n;
+	}
+
+	void calc_hamming_dist(int x, RankingScratch& s)
+	{
+		uint16_t* __restrict m_dist = s.dist.data();
+
+		if (m_distance != DM_hamming)
+		{
+			calc_table_dist(x, s);
+			return;
+		}
+
+		switch(m_hs)
+		{
+		case HS32b:
+		{
+			uint32_t* __restrict queryhashes = reinterpret_cast<uint32_t*>(m_queryhashes);
+			uint32_t* __restrict dbhashes = reinterpret_cast<uint32_t*>(m_dbhashes);
+
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				m_dist[j] = hamming_distance32(dbhashes[j], queryhashes[x]);
+			}
+
+			break;
+		}
+		case HS64b:
+		{
+			uint64_t* __restrict queryhashes = reinterpret_cast<uint64_t*>(m_queryhashes);
+			uint64_t* __restrict dbhashes = reinterpret_cast<uint64_t*>(m_dbhashes);
+
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				m_dist[j] = hamming_distance64(dbhashes[j], queryhashes[x]);
+			}
+			break;
+		}
+		case HSNw:
+		{
+			uint64_t* __restrict queryhashes = reinterpret_cast<uint64_t*>(m_queryhashes) + (size_t)x * m_words;
+			uint64_t* __restrict dbhashes = reinterpret_cast<uint64_t*>(m_dbhashes);
+
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				m_dist[j] = hamming_distanceN(dbhashes + (size_t)j * m_words, queryhashes, m_words);
+			}
+			break;
+		}
+		}
+	}
+
+	// Distance as a sum of the costs of the query bits that differ from the DB bits, with a lookup table per byte
+	void calc_table_dist(int x, RankingScratch& s)
+	{
+		int bytes = (m_bits + 7) / 8;
+		size_t stride = m_hs == HS32b ? 4 : 8 * (size_t)m_words;
+		s.lut.resize((size_t)bytes * 256);
+		uint16_t* __restrict lut = s.lut.data();
+		const uint16_t* __restrict costs = m_query_costs.data() + (size_t)x * m_bits;
+
+		// Entry of a byte value differs from the entry of the value without its lowest set bit by the cost of
+		// that bit: it is added if the bit mismatches the query sign and subtracted otherwise
+		for (int k = 0; k < bytes; ++k)
+		{
+			uint16_t* __restrict table = lut + k * 256;
+			int delta[8];
+			table[0] = 0;
+			for (int t = 0; t < 8 && 8 * k + t < m_bits; ++t)
+			{
+				int i = 8 * k + t;
+				bool sign = GetBit(m_queryhashes, x, i);
+				table[0] += sign ? costs[i] : 0;
+				delta[t] = sign ? -costs[i] : costs[i];
+			}
+			for (int t = 0; t < 8; ++t)
+			{
+				if (8 * k + t >= m_bits)
+				{
+					delta[t] = 0;
+				}
+			}
+			for (int v = 1; v < 256; ++v)
+			{
+				int t = 0;
+				while (((v >> t) & 1) == 0)
+				{
+					++t;
+				}
+				table[v] = (uint16_t)(table[v & (v - 1)] + delta[t]);
+			}
+		}
+
+		uint16_t* __restrict m_dist = s.dist.data();
+		for (int j = 0; j < m_db_size; ++j)
+		{
+			const uint8_t* __restrict hash = m_dbhashes + j * stride;
+			uint16_t d = 0;
+			for (int k = 0; k < bytes; ++k)
+			{
+				d += lut[k * 256 + hash[k]];
+			}
+			m_dist[j] = d;
+		}
+	}
+
+	template<int LC>
+	uint8_t Gain(int q, int j)
+	{
+		switch(LC)
+		{
+		case LC_equality:
+			return m_labels_query[q] == m_labels_db[j];
+		case LC_and:
+		{
+			uint64_t common = 0;
+			for (int k = 0; k < m_label_words; ++k)
+			{
+				common |= m_labels_query_bits[(size_t)k * m_query_size + q] & m_labels_db_bits[(size_t)k * m_db_size + j];
+			}
+			return common != 0;
+		}
+		case LC_weighted:
+		{
+			int common = 0;
+			for (int k = 0; k < m_label_words; ++k)
+			{
+				common += (int)popcount64(m_labels_query_bits[(size_t)k * m_query_size + q] & m_labels_db_bits[(size_t)k * m_db_size + j]);
+			}
+			return (uint8_t)std::min(common, 255);
+		}
+		}
+		return 0;
+	}
+
+	void SetDBLabelWords(int words)
+	{
+		m_db_label_words = words;
+		m_label_words = std::min(m_db_label_words, m_query_label_words);
+	}
+
+	// Computes distances to the query and fills per-distance histograms of total count, relevant count and gain.
+	// Gain is 0/1 for equality and "and" comparison and number of common tags for weighted comparison.
+	// Only the first top_n ranked items are accounted: buckets past the cutoff bucket are left empty, and the
+	// labels of items there are never touched. For TB_index the cutoff bucket is cut in the DB order, for TB_average
+	// it is kept whole and cut when the AP is computed.
+	// If radius is not negative, number of items and relevant items within the radius are counted as well.
+	template<int LC>
+	void Histogram(int q, RankingScratch& s, int top_n, int tb, bool count_all_relevant, int radius)
+	{
+		calc_hamming_dist(q, s);
+
+		const uint16_t* __restrict dist = s.dist.data();
+		uint8_t* __restrict gain = s.gain.data();
+		int32_t* __restrict total = s.total.data();
+		int32_t* __restrict relevant = s.relevant.data();
+		int64_t* __restrict gain_sum = s.gain_sum.data();
+		int32_t* __restrict position = s.position.data();
+
+		for (int i = 0; i <= m_max_dist; ++i)
+		{
+			total[i] = 0;
+			relevant[i] = 0;
+			gain_sum[i] = 0;
+		}
+
+		if (top_n == m_db_size)
+		{
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				uint8_t g = Gain<LC>(q, j);
+				uint16_t d = dist[j];
+				gain[j] = g;
+				total[d] += 1;
+				relevant[d] += g > 0;
+				gain_sum[d] += g;
+			}
+			s.cutoff_bucket = m_max_dist;
+			s.cutoff_count = total[m_max_dist];
+			s.total_relevant = 0;
+			s.radius_total = 0;
+			s.radius_relevant = 0;
+			for (int i = 0; i <= m_max_dist; ++i)
+			{
+				s.total_relevant += relevant[i];
+				if (i <= radius)
 				{
-					m_precision[i] = m_cumulative[i] / (i+1);
+					s.radius_total += total[i];
+					s.radius_relevant += relevant[i];
 				}
+			}
+			return;
+		}
+
+		for (int j = 0; j < m_db_size; ++j)
+		{
+			total[dist[j]] += 1;
+		}
+
+		int32_t offset = 0;
+		int cutoff = 0;
+		while (offset + total[cutoff] < top_n)
+		{
+			offset += total[cutoff];
+			++cutoff;
+		}
+		s.cutoff_bucket = cutoff;
+		s.cutoff_count = top_n - offset;
+
+		int32_t limit = tb == TB_average ? total[cutoff] : s.cutoff_count;
+		int32_t remaining = offset + limit;
+		position[cutoff] = 0;
+
+		for (int j = 0; j < m_db_size && remaining > 0; ++j)
+		{
+			uint16_t d = dist[j];
+			if (d > cutoff)
+			{
+				continue;
+			}
+			if (d == cutoff && position[cutoff]++ >= limit)
+			{
+				gain[j] = 0;
+				continue;
+			}
+			uint8_t g = Gain<LC>(q, j);
+			gain[j] = g;
+			relevant[d] += g > 0;
+			gain_sum[d] += g;
+			--remaining;
+		}
 
-				float ap = fdot(m_db_size, m_precision, m_relevance);
-				ap /= number_of_relative_docs;
-				map += ap;
+		// Recall needs the number of relevant items in the whole DB. The radius may reach past the cutoff bucket,
+		// so relevant items within it are counted in the same pass
+		s.total_relevant = 0;
+		s.radius_total = 0;
+		s.radius_relevant = 0;
+		if (count_all_relevant || radius >= 0)
+		{
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				bool is_relevant = Gain<LC>(q, j) > 0;
+				s.total_relevant += is_relevant;
+				s.radius_relevant += is_relevant && dist[j] <= radius;
+			}
+			for (int i = 0; i <= std::min(radius, m_max_dist); ++i)
+			{
+				s.radius_total += total[i];
 			}
 		}
+	}
 
-		map /= m_query_size;
+	// AP with stable ranking: inside of a distance bucket items keep the DB order.
+	// Rank and cumulative gain of an item are the bucket offsets plus the count of preceding items of the same
+	// bucket, so they are obtained in one pass in the DB order without building the rank permutation.
+	// If curve is set, the number of relevant items at each rank is stored to cum_at_rank.
+	float APIndexOrder(RankingScratch& s, bool curve)
+	{
+		const uint16_t* __restrict dist = s.dist.data();
+		const uint8_t* __restrict gain = s.gain.data();
+		int32_t* __restrict position = s.position.data();
+		int64_t* __restrict cumulative_gain = s.cumulative_gain.data();
+
+		int32_t number_of_relative_docs = 0;
+		int32_t offset = 0;
+		int64_t gain_offset = 0;
+		for (int i = 0; i <= s.cutoff_bucket; ++i)
+		{
+			position[i] = offset;
+			cumulative_gain[i] = gain_offset;
+			offset += s.total[i];
+			gain_offset += s.gain_sum[i];
+			number_of_relative_docs += s.relevant[i];
+		}
 
-		return map;
+		int length = (int)s.cum_at_rank.size();
+		double* __restrict cum_at_rank = s.cum_at_rank.data();
+		if (curve)
+		{
+			std::fill(cum_at_rank, cum_at_rank + length, 0.0);
+		}
+
+		if (number_of_relative_docs == 0)
+		{
+			return 0.0f;
+		}
+
+		int64_t ap = 0;
+		int32_t remaining = number_of_relative_docs;
+		for (int j = 0; j < m_db_size && remaining > 0; ++j)
+		{
+			uint16_t d = dist[j];
+			if (d > s.cutoff_bucket)
+			{
+				continue;
+			}
+			position[d] += 1;
+			uint8_t g = gain[j];
+			if (g > 0)
+			{
+				cumulative_gain[d] += g;
+				ap += PrecisionTerm(cumulative_gain[d], position[d]);
+				--remaining;
+				if (curve && position[d] <= length)
+				{
+					cum_at_rank[position[d] - 1] = 1.0;
+				}
+			}
+		}
+
+		if (curve)
+		{
+			for (int k = 1; k < length; ++k)
+			{
+				cum_at_rank[k] += cum_at_rank[k - 1];
+			}
+		}
+
+		return IndexOrderAP(ap, number_of_relative_docs);
+	}
+
+	// Precision (weighted by ACG) at a relevant item as a fixed point number. Sums of these terms do not depend on
+	// the order of summation, so the sum of a DB split into shards is the same as of the whole DB
+	static int64_t PrecisionTerm(int64_t cumulative_gain, int32_t position)
+	{
+		return std::llround(std::ldexp((double)cumulative_gain / position, APFractionBits));
+	}
+
+	static float IndexOrderAP(int64_t ap, int32_t number_of_relative_docs)
+	{
+		return number_of_relative_docs == 0 ? 0.0f : (float)(std::ldexp((double)ap, -APFractionBits) / number_of_relative_docs);
+	}
+
+	// Expected sum of precisions (weighted by ACG) at relevant items of a bucket, when r relevant items with gain sum g
+	// are randomly placed among t items of the bucket, that follows T items with gain sum G. Only the first m
+	// positions of the bucket are summed.
+	// The item at i-th position is relevant with probability r/t and the expected cumulative gain at it is
+	// G + g / r + (i - 1) (r - 1) (g / r) / (t - 1). Sum over i of these terms divided by (T + i) reduces to
+	// harmonic numbers.
+	double ExpectedPrecisionSum(int32_t t, int32_t r, double g, int32_t m, int32_t T, double G)
+	{
+		if (r == 0)
+		{
+			return 0.0;
+		}
+		double a = G + g / r;
+		double b = t > 1 ? (r - 1) * (g / r) / (t - 1) : 0.0;
+		return (double)r / t * (b * m + (a - b * (T + 1)) * (m_harmonic[T + m] - m_harmonic[T]));
 	}
 
-  int get_mir_relavance(uint32_t query, uint32_t sample)
-  {
-    uint32_t same = query & sample;
-    return (uint8_t) popcount32(same);
-  }
-
-  float MapWeighted()
-  {
-    float map = 0.0f;
-
-    for (int q = 0; q < m_query_size; q++)
-    {
-      Sort(q);
-      int relCount = 0;
-      float ap = 0.0f;
-      for (int p = 0; p < m_db_size; p ++)
-      {
-        int index = m_rank[p];
-        uint8_t m_rel = get_mir_relavance(m_labels_query[q],m_labels_db[index]);
-
-        if (m_rel > 0)
-        {
-          relCount++;
-          float acg = m_rel;
-          for (int n = p-1;n >= 0; n--)
-          {
-            index = m_rank[n];
-            acg += get_mir_relavance(m_labels_query[q],m_labels_db[index]);
-          }
-          acg /= (p+1);
-
-          ap += acg;
-        }
-      }
-      if (relCount > 0)
-      {
-        ap /= relCount;
-        map += ap;
-      }
-   }
-
-    map /= m_query_size;
-    return map;
-
-  }
+	// AP averaged over all orderings inside of distance buckets. Computed from the histograms only.
+	// If the cutoff bucket gets into top_n only partially, the number x of relevant items that get there follows
+	// the hypergeometric distribution, and the expectation of AP is summed over it.
+	float APTieAveraged(RankingScratch& s)
+	{
+		int32_t number_of_relative_docs = 0;
+		int32_t offset = 0;
+		int64_t gain_offset = 0;
+		double ap = 0.0;
+
+		for (int i = 0; i < s.cutoff_bucket; ++i)
+		{
+			ap += ExpectedPrecisionSum(s.total[i], s.relevant[i], (double)s.gain_sum[i], s.total[i], offset, (double)gain_offset);
+			number_of_relative_docs += s.relevant[i];
+			offset += s.total[i];
+			gain_offset += s.gain_sum[i];
+		}
+
+		int32_t t = s.total[s.cutoff_bucket];
+		int32_t r = s.relevant[s.cutoff_bucket];
+		int64_t g = s.gain_sum[s.cutoff_bucket];
+		int32_t m = s.cutoff_count;
+
+		if (r == 0 || m == t)
+		{
+			ap += ExpectedPrecisionSum(t, r, (double)g, m, offset, (double)gain_offset);
+			number_of_relative_docs += r;
+			return number_of_relative_docs == 0 ? 0.0f : (float)(ap / number_of_relative_docs);
+		}
+
+		// Relevant items among the first m of the cutoff bucket have the same mean gain as all relevant items of it
+		double mean_gain = (double)g / r;
+		int32_t x_min = std::max(0, m - (t - r));
+		int32_t x_max = std::min(r, m);
+		double p = std::exp(std::lgamma(r + 1.0) - std::lgamma(x_min + 1.0) - std::lgamma(r - x_min + 1.0)
+			+ std::lgamma(t - r + 1.0) - std::lgamma(m - x_min + 1.0) - std::lgamma(t - r - m + x_min + 1.0)
+			- std::lgamma(t + 1.0) + std::lgamma(m + 1.0) + std::lgamma(t - m + 1.0));
+
+		double expected_ap = 0.0;
+		for (int32_t x = x_min; x <= x_max; ++x)
+		{
+			if (number_of_relative_docs + x > 0)
+			{
+				double sum = ap + ExpectedPrecisionSum(m, x, mean_gain * x, m, offset, (double)gain_offset);
+				expected_ap += p * sum / (number_of_relative_docs + x);
+			}
+			p *= (double)(r - x) * (m - x) / ((x + 1.0) * (t - r - m + x + 1.0));
+		}
+
+		return (float)expected_ap;
+	}
 
 	HashStorage m_hs;
 	LabelComparing m_lc;
+	int m_bits;
+	int m_words;
 	int m_db_size;
 	int m_query_size;
+	int m_thread_count;
 	uint8_t* __restrict m_dbhashes;
 	uint8_t* __restrict m_queryhashes;
-	uint8_t* __restrict m_dist;
-	uint32_t* __restrict m_rank;
-	uint32_t* __restrict m_tmp;
 	uint32_t* __restrict m_labels_db;
 	uint32_t* __restrict m_labels_query;
-	uint64_t* __restrict m_labels_dbLDW;
-	uint64_t* __restrict m_labels_dbHDW;
-	uint64_t* __restrict m_labels_queryLDW;
-	uint64_t* __restrict m_labels_queryHDW;
-	float* __restrict m_relevance;
-	float* __restrict m_cumulative;
-	float* __restrict m_precision;
+	// Label bitsets, word k of item j is at k * size + j. Gain is computed over the words that both have
+	uint64_t* __restrict m_labels_db_bits;
+	uint64_t* __restrict m_labels_query_bits;
+	int m_db_label_words;
+	int m_query_label_words;
+	int m_label_words;
+	py::object m_dbhashes_owner;
+	py::object m_labels_db_owner;
+	py::object m_labels_db_bits_owner;
+	float* __restrict m_ap;
+	std::vector<float> m_radius_precision;
+	std::vector<float> m_radius_recall;
+	std::vector<int32_t> m_radius_candidates;
+	int m_radius;
+
+	// Asymmetric and weighted distance: cost of each differing bit of each query, of shape [query_size, bits].
+	// Signs are kept in the query hashes. m_max_dist is the largest distance, that is the number of distance
+	// buckets minus one. m_weight_scale is the number of weighted distance levels per hamming distance unit
+	DistanceMode m_distance;
+	int m_max_dist;
+	int m_weight_scale;
+	std::vector<uint16_t> m_query_costs;
+
+	// Real-valued embeddings for re-ranking, of shape [size, dim]
+	int m_embedding_size;
+	int m_query_embedding_size;
+	std::vector<float> m_db_embeddings;
+	std::vector<float> m_query_embeddings;
+
+	// State of the incremental rotation search: distance matrix, per-query histograms and AP, and the last proposal
+	int m_search_top_n;
+	std::vector<uint16_t> m_search_dist;
+	std::vector<int32_t> m_search_total;
+	std::vector<int32_t> m_search_relevant;
+	std::vector<int64_t> m_search_gain_sum;
+	std::vector<float> m_search_ap;
+	int m_proposal_a;
+	int m_proposal_b;
+	bool m_proposal_valid;
+	std::vector<uint8_t> m_db_pair;
+	std::vector<uint8_t> m_proposal_db_pair;
+	std::vector<uint8_t> m_query_pair;
+	std::vector<uint8_t> m_proposal_query_pair;
+	std::vector<int32_t> m_changed_db;
+	std::vector<float> m_proposal_ap;
+
+	std::vector<double> m_harmonic;
+	std::vector<RankingScratch> m_scratch;
+};
+
+// Multi-index hashing, M. Norouzi, A. Punjani, D. J. Fleet, "Fast Search in Hamming Space with Multi-Index Hashing".
+// Codes are split into m disjoint substrings, each substring is indexed by its own table. If a code is within
+// distance r from the query, at least one of its substrings is within distance r / m from the corresponding
+// substring of the query, so only buckets close to the query need to be probed instead of scanning the whole DB.
+class MultiIndexHashing
+{
+public:
+	MultiIndexHashing(): m_bits(0), m_words(0), m_substrings(0), m_db_size(0), m_thread_count(1)
+	{
+		m_thread_count = std::max((int)std::thread::hardware_concurrency(), 1);
+	}
+
+	void Init(int bits, int substrings)
+	{
+		if (bits <= 0 || substrings <= 0 || substrings > bits)
+		{
+			throw std::runtime_error("Number of substrings must be in range [1, bits]");
+		}
+		if ((bits + substrings - 1) / substrings > 32)
+		{
+			throw std::runtime_error("Substrings must not be longer than 32 bits");
+		}
+		m_bits = bits;
+		m_words = (bits + 63) / 64;
+		m_substrings = substrings;
+		m_db_size = 0;
+		m_codes.clear();
+		m_tables.assign(substrings, Table());
+
+		int begin = 0;
+		for (int i = 0; i < substrings; ++i)
+		{
+			m_tables[i].begin = begin;
+			m_tables[i].length = bits / substrings + (i < bits % substrings ? 1 : 0);
+			begin += m_tables[i].length;
+		}
+
+		SetThreadCount(m_thread_count);
+	}
+
+	void SetThreadCount(int thread_count)
+	{
+		m_thread_count = std::max(thread_count, 1);
+		m_scratch.resize(m_thread_count);
+		for (auto& scratch: m_scratch)
+		{
+			scratch.visited.assign(m_db_size, 0);
+			scratch.stamp = 0;
+			scratch.buckets.resize(m_bits + 1);
+		}
+	}
+
+	int GetThreadCount() const
+	{
+		return m_thread_count;
+	}
+
+	// Packs DB hashes and builds the tables. Inside of a bucket items are kept in the DB order
+	void Build(py::array_t<float, py::array::c_style> x)
+	{
+		if (m_substrings == 0)
+		{
+			throw std::runtime_error("Init must be called first");
+		}
+		if (x.unchecked<2>().shape(1) > m_bits)
+		{
+			throw std::runtime_error("Hash length exceeds the hash size provided at init");
+		}
+		m_db_size = (int)x.unchecked<2>().shape(0);
+		m_codes.resize((size_t)m_db_size * m_words);
+		to_words_hashes(x, m_codes.data(), m_words);
+
+		std::vector<std::pair<uint32_t, int32_t> > items(m_db_size);
+		for (auto& table: m_tables)
+		{
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				items[j] = std::make_pair(Substring(Code(j), table), j);
+			}
+			std::sort(items.begin(), items.end());
+
+			table.keys.clear();
+			table.offsets.clear();
+			table.ids.resize(m_db_size);
+			for (int j = 0; j < m_db_size; ++j)
+			{
+				if (j == 0 || items[j].first != items[j - 1].first)
+				{
+					table.keys.push_back(items[j].first);
+					table.offsets.push_back(j);
+				}
+				table.ids[j] = items[j].second;
+			}
+			table.offsets.push_back(m_db_size);
+		}
+
+		SetThreadCount(m_thread_count);
+	}
+
+	// Exact k nearest neighbours of each query. Returns indices and distances of shape [queries, k], neighbours
+	// are ordered by distance and then by index, same as the linear scan followed by a stable sort would give
+	py::tuple KNN(py::array_t<float, py::array::c_style> x, int k)
+	{
+		int query_size = LoadQueries(x);
+		k = std::min(std::max(k, 0), m_db_size);
+
+		int32_t* indices = new int32_t[(size_t)query_size * k];
+		uint16_t* distances = new uint16_t[(size_t)query_size * k];
+		{
+			py::gil_scoped_release release;
+
+			ParallelFor(query_size, m_thread_count, [this, k, indices, distances](int q, int t)
+			{
+				MIHScratch& s = m_scratch[t];
+				Search(q, s, k, -1);
+
+				int n = 0;
+				for (int d = 0; d <= m_bits && n < k; ++d)
+				{
+					std::vector<int32_t>& bucket = s.buckets[d];
+					std::sort(bucket.begin(), bucket.end());
+					for (size_t i = 0; i < bucket.size() && n < k; ++i, ++n)
+					{
+						indices[(size_t)q * k + n] = bucket[i];
+						distances[(size_t)q * k + n] = (uint16_t)d;
+					}
+				}
+			});
+		}
+
+		py::capsule indices_owner(indices, [](void* p) { delete[] reinterpret_cast<int32_t*>(p); });
+		py::capsule distances_owner(distances, [](void* p) { delete[] reinterpret_cast<uint16_t*>(p); });
+
+		return py::make_tuple(
+			py::array_t<int32_t>({query_size, k}, {k * sizeof(int32_t), sizeof(int32_t)}, indices, indices_owner),
+			py::array_t<uint16_t>({query_size, k}, {k * sizeof(uint16_t), sizeof(uint16_t)}, distances, distances_owner));
+	}
+
+	// All codes within distance r from each query. Returns (indptr, indices, dist) in CSR layout: neighbours of
+	// query x are indices[indptr[x]:indptr[x + 1]] in increasing order, same as _hamming.calc_hamming_dist_radius
+	py::tuple RadiusSearch(py::array_t<float, py::array::c_style> x, int r)
+	{
+		if (r < 0)
+		{
+			throw std::runtime_error("Radius must not be negative");
+		}
+		int query_size = LoadQueries(x);
+
+		std::vector<std::vector<std::pair<int32_t, uint16_t> > > result(query_size);
+		{
+			py::gil_scoped_release release;
+
+			ParallelFor(query_size, m_thread_count, [this, r, &result](int q, int t)
+			{
+				MIHScratch& s = m_scratch[t];
+				Search(q, s, 0, r);
+
+				std::vector<std::pair<int32_t, uint16_t> >& neighbours = result[q];
+				for (int d = 0; d <= std::min(r, m_bits); ++d)
+				{
+					for (int32_t j: s.buckets[d])
+					{
+						neighbours.push_back(std::make_pair(j, (uint16_t)d));
+					}
+				}
+				std::sort(neighbours.begin(), neighbours.end());
+			});
+		}
+
+		py::array_t<int64_t> indptr(query_size + 1);
+		int64_t* indptr_v = indptr.mutable_data();
+		indptr_v[0] = 0;
+		for (int q = 0; q < query_size; ++q)
+		{
+			indptr_v[q + 1] = indptr_v[q] + (int64_t)result[q].size();
+		}
+
+		py::array_t<int32_t> indices(indptr_v[query_size]);
+		py::array_t<uint16_t> distances(indptr_v[query_size]);
+		int32_t* indices_v = indices.mutable_data();
+		uint16_t* distances_v = distances.mutable_data();
+		for (int q = 0; q < query_size; ++q)
+		{
+			for (size_t i = 0; i < result[q].size(); ++i)
+			{
+				indices_v[indptr_v[q] + i] = result[q][i].first;
+				distances_v[indptr_v[q] + i] = result[q][i].second;
+			}
+		}
+
+		return py::make_tuple(indptr, indices, distances);
+	}
+
+private:
+	struct Table
+	{
+		int begin;
+		int length;
+		// Sorted distinct substring values, bucket i holds ids[offsets[i]:offsets[i + 1]]
+		std::vector<uint32_t> keys;
+		std::vector<int32_t> offsets;
+		std::vector<int32_t> ids;
+	};
+
+	struct MIHScratch
+	{
+		// Items are marked visited with the stamp of the current query, so the array is never cleared
+		std::vector<uint32_t> visited;
+		uint32_t stamp;
+		// Found items by their distance to the query
+		std::vector<std::vector<int32_t> > buckets;
+	};
+
+	const uint64_t* Code(int j) const
+	{
+		return m_codes.data() + (size_t)j * m_words;
+	}
+
+	static uint32_t Substring(const uint64_t* code, const Table& table)
+	{
+		int word = table.begin / 64;
+		int offset = table.begin % 64;
+		uint64_t value = code[word] >> offset;
+		if (offset + table.length > 64)
+		{
+			value |= code[word + 1] << (64 - offset);
+		}
+		return (uint32_t)(value & ((uint64_t(1) << table.length) - 1));
+	}
+
+	int LoadQueries(py::array_t<float, py::array::c_style> x)
+	{
+		if (x.unchecked<2>().shape(1) > m_bits)
+		{
+			throw std::runtime_error("Hash length exceeds the hash size provided at init");
+		}
+		int query_size = (int)x.unchecked<2>().shape(0);
+		m_queries.resize((size_t)query_size * m_words);
+		to_words_hashes(x, m_queries.data(), m_words);
+		return query_size;
+	}
+
+	// Probes buckets at growing substring radius. After substring i was probed at radius s, all codes within
+	// distance m * s + i are found: a code that is missed differs in at least s + 1 bits in substrings up to i and in
+	// at least s bits in the rest. Stops when k codes are guaranteed, or, if r >= 0, when radius r is covered.
+	void Search(int q, MIHScratch& s, int k, int r)
+	{
+		const uint64_t* query = m_queries.data() + (size_t)q * m_words;
+
+		if (++s.stamp == 0)
+		{
+			std::fill(s.visited.begin(), s.visited.end(), 0);
+			s.stamp = 1;
+		}
+		for (auto& bucket: s.buckets)
+		{
+			bucket.clear();
+		}
+
+		int max_length = m_tables[0].length;
+		for (int radius = 0; radius <= max_length; ++radius)
+		{
+			// For codes that are far from everything in the DB, the number of buckets to probe grows
+			// combinatorially. Once it exceeds the DB size the rest is found faster by the linear scan
+			double probes = 0.0;
+			for (const Table& table: m_tables)
+			{
+				probes += Binomial(table.length, radius);
+			}
+			if (probes > m_db_size)
+			{
+				for (int j = 0; j < m_db_size; ++j)
+				{
+					if (s.visited[j] != s.stamp)
+					{
+						s.buckets[hamming_distanceN(Code(j), query, m_words)].push_back(j);
+					}
+				}
+				return;
+			}
+
+			for (int i = 0; i < m_substrings; ++i)
+			{
+				const Table& table = m_tables[i];
+				if (radius <= table.length)
+				{
+					uint32_t key = Substring(query, table);
+					if (radius == 0)
+					{
+						Probe(key, table, query, s);
+					}
+					else
+					{
+						// Enumerates all masks of table.length bits with radius bits set (Gosper's hack)
+						uint64_t limit = uint64_t(1) << table.length;
+						for (uint64_t mask = (uint64_t(1) << radius) - 1; mask < limit;)
+						{
+							Probe(key ^ (uint32_t)mask, table, query, s);
+							uint64_t c = mask & (~mask + 1);
+							uint64_t next = mask + c;
+							mask = (((next ^ mask) >> 2) / c) | next;
+						}
+					}
+				}
+
+				int covered = m_substrings * radius + i;
+				if (r >= 0)
+				{
+					if (covered >= r)
+					{
+						return;
+					}
+				}
+				else
+				{
+					int found = 0;
+					for (int d = 0; d <= std::min(covered, m_bits); ++d)
+					{
+						found += (int)s.buckets[d].size();
+					}
+					if (found >= k)
+					{
+						return;
+					}
+				}
+			}
+		}
+	}
+
+	static double Binomial(int n, int k)
+	{
+		if (k > n)
+		{
+			return 0.0;
+		}
+		double result = 1.0;
+		for (int i = 1; i <= k; ++i)
+		{
+			result = result * (n - k + i) / i;
+		}
+		return result;
+	}
+
+	void Probe(uint32_t key, const Table& table, const uint64_t* query, MIHScratch& s)
+	{
+		auto it = std::lower_bound(table.keys.begin(), table.keys.end(), key);
+		if (it == table.keys.end() || *it != key)
+		{
+			return;
+		}
+		size_t bucket = it - table.keys.begin();
+		for (int32_t i = table.offsets[bucket]; i < table.offsets[bucket + 1]; ++i)
+		{
+			int32_t j = table.ids[i];
+			if (s.visited[j] != s.stamp)
+			{
+				s.visited[j] = s.stamp;
+				s.buckets[hamming_distanceN(Code(j), query, m_words)].push_back(j);
+			}
+		}
+	}
+
+	int m_bits;
+	int m_words;
+	int m_substrings;
+	int m_db_size;
+	int m_thread_count;
+	std::vector<uint64_t> m_codes;
+	std::vector<uint64_t> m_queries;
+	std::vector<Table> m_tables;
+	std::vector<MIHScratch> m_scratch;
 };
 
 
@@ -503,18 +2485,48 @@ PYBIND11_MODULE(_hashranking, m) {
 
 	py::class_<HashRankingContext>(m, "HashRankingContext")
 		.def(py::init())
-		.def("Init", &HashRankingContext::Init)
+		.def("Init", &HashRankingContext::Init, py::arg("db_size"), py::arg("query_size"), py::arg("hs"), py::arg("lc"), py::arg("bits") = 0)
 		.def("LoadQueryHashes", &HashRankingContext::LoadQueryHashes)
 		.def("LoadDBHashes", &HashRankingContext::LoadDBHashes)
+		.def("LoadQueryFloats", &HashRankingContext::LoadQueryFloats)
+		.def("SetBitWeights", &HashRankingContext::SetBitWeights)
+		.def("LoadDBEmbeddings", &HashRankingContext::LoadDBEmbeddings)
+		.def("LoadQueryEmbeddings", &HashRankingContext::LoadQueryEmbeddings)
+		.def("RerankMap", &HashRankingContext::RerankMap, py::arg("shortlist"), py::arg("cutoffs") = std::vector<int>())
+		.def("Rerank", &HashRankingContext::Rerank, py::arg("shortlist"))
+		.def("GetBuckets", &HashRankingContext::GetBuckets)
+		.def("ShardHistograms", &HashRankingContext::ShardHistograms, py::arg("first") = 0, py::arg("count") = -1)
+		.def("ShardIndexAP", &HashRankingContext::ShardIndexAP, py::arg("indptr"), py::arg("bucket"), py::arg("base_rank"),
+			py::arg("base_gain"), py::arg("top_n") = 0, py::arg("first") = 0)
+		.def("MergeShards", &HashRankingContext::MergeShards, py::arg("db_size"), py::arg("top_n"), py::arg("tb"),
+			py::arg("total"), py::arg("relevant"), py::arg("gain_sum"), py::arg("index_ap"), py::arg("index_relevant"))
+		.def("TopK", &HashRankingContext::TopK, py::arg("k"))
 		.def("LoadQueryLabels", &HashRankingContext::LoadQueryLabels)
 		.def("LoadDBLabels", &HashRankingContext::LoadDBLabels)
-		.def("LoadQueryLabelsLDW", &HashRankingContext::LoadQueryLabelsLDW)
-		.def("LoadDBLabelsLDW", &HashRankingContext::LoadDBLabelsLDW)
-		.def("LoadQueryLabelsHDW", &HashRankingContext::LoadQueryLabelsHDW)
-		.def("LoadDBLabelsHDW", &HashRankingContext::LoadDBLabelsHDW)
-		.def("calc_hamming_dist", &HashRankingContext::calc_hamming_dist)
-		.def("Sort", &HashRankingContext::Sort)
-		.def("Map", &HashRankingContext::Map);
+		.def("LoadQueryLabelBits", &HashRankingContext::LoadQueryLabelBits)
+		.def("LoadDBLabelBits", &HashRankingContext::LoadDBLabelBits)
+		.def("LoadDBPacked", &HashRankingContext::LoadDBPacked, py::arg("x").noconvert())
+		.def("LoadDBLabelsPacked", &HashRankingContext::LoadDBLabelsPacked)
+		.def("SetThreadCount", &HashRankingContext::SetThreadCount)
+		.def("GetThreadCount", &HashRankingContext::GetThreadCount)
+		.def("calc_hamming_dist", (void (HashRankingContext::*)(int)) &HashRankingContext::calc_hamming_dist)
+		.def("Sort", (py::array_t<uint32_t> (HashRankingContext::*)(int, int)) &HashRankingContext::Sort, py::arg("x"), py::arg("top_n") = 0)
+		.def("Map", &HashRankingContext::Map, py::arg("top_n") = 0, py::arg("tb") = (int)HashRankingContext::TB_index, py::arg("radius") = -1, py::call_guard<py::gil_scoped_release>())
+		.def("MapCurve", &HashRankingContext::MapCurve, py::arg("top_n") = 0, py::arg("tb") = (int)HashRankingContext::TB_index, py::arg("cutoffs") = std::vector<int>(), py::arg("radius") = -1)
+		.def("RadiusMetrics", &HashRankingContext::RadiusMetrics)
+		.def("QueryAP", &HashRankingContext::QueryAP)
+		.def("StartRotationSearch", &HashRankingContext::StartRotationSearch, py::arg("top_n") = 0)
+		.def("ProposeColumns", &HashRankingContext::ProposeColumns, py::arg("a"), py::arg("b"), py::arg("db_bits"), py::arg("query_bits"))
+		.def("CommitProposal", &HashRankingContext::CommitProposal);
+
+	py::class_<MultiIndexHashing>(m, "MultiIndexHashing")
+		.def(py::init())
+		.def("Init", &MultiIndexHashing::Init, py::arg("bits"), py::arg("substrings"))
+		.def("Build", &MultiIndexHashing::Build)
+		.def("SetThreadCount", &MultiIndexHashing::SetThreadCount)
+		.def("GetThreadCount", &MultiIndexHashing::GetThreadCount)
+		.def("KNN", &MultiIndexHashing::KNN, py::arg("queries"), py::arg("k"))
+		.def("RadiusSearch", &MultiIndexHashing::RadiusSearch, py::arg("queries"), py::arg("r"));
 
 	//m.def("add_circle_filled", &AddCircleFilled, py::arg("centre"), py::arg("radius"), py::arg("col"), py::arg("num_segments") = 12);
 }
@@ -127,8 +127,8 @@ definitions = {
 }
 
 extra_compile_args = {
-    'darwin': [],
-    'posix': ['-O3', '-funroll-loops', '-march=native', '-mfpmath=sse'],
+    'darwin': ['-fvisibility=hidden'],
+    'posix': ['-O3', '-funroll-loops', '-march=native', '-mfpmath=sse', '-pthread', '-fvisibility=hidden'],
     'win32': ['/MT', '/GL', '/GR-'],
 }
 
@@ -138,12 +138,18 @@ extra_compile_cpp_args = {
     'win32': [],
 }
 
+extra_link_args = {
+    'darwin': [],
+    'posix': ['-pthread'],
+    'win32': [],
+}
+
 extension = Extension("_hashranking",
                              ['hashranking.cpp'],
                              define_macros = definitions[target_os],
                              include_dirs=["pybind11/include"],
                              extra_compile_args=extra_compile_args[target_os],
-                             extra_link_args=[],
+                             extra_link_args=extra_link_args[target_os],
                              libraries = [])
 
 extension.extra_compile_cpp_args = extra_compile_cpp_args[target_os]
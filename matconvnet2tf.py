@@ -37,7 +37,7 @@ class MatConvNet2TF:
         if input is None:
             input_shape = tuple(data['meta'].inputs.size[:3])
             input_shape = (None,) + input_shape
-            self.input = tf.placeholder('float32', input_shape)
+            self.input = tf.placeholder('uint8', input_shape)
         else:
             self.input = input
 
@@ -56,7 +56,8 @@ class MatConvNet2TF:
             'dagnn.SoftMax': self._softmax_layer,
         }
 
-        current = self.input - self.mean
+        # Input is a batch of uint8 images, as BatchProvider returns them
+        current = tf.cast(self.input, tf.float32) - self.mean
         current2 = self.input_latent
 
         latent_started = False
@@ -16,29 +16,219 @@
 import numpy as np
 
 from utils.hamming import calc_hamming_rank
+from utils.label_bitsets import relevance
+from utils.label_bitsets import relevance_pairs
+from utils.label_bitsets import to_bitsets
 from utils.timer import timer
 
 import pyximport
 pyximport.install(setup_args={'include_dirs': np.get_include()})
 import _mean_average_precision
+from _mean_average_precision import MapContext
+from _mean_average_precision import prepare_labels
 has_cython = True
 
 
 #@timer
-def compute_map(hashes_train, hashes_test, labels_train, labels_test, top_n=0, and_mode=False, force_slow=False,weighted_mode = False):
-    """Compute MAP for given set of hashes and labels"""
-    order = calc_hamming_rank(hashes_train, hashes_test)
+def compute_map(hashes_train, hashes_test, labels_train, labels_test, top_n=0, and_mode=False, force_slow=False,weighted_mode = False, chunk_size=1000):
+    """Compute MAP for given set of hashes and labels.
+    Queries are processed in chunks of chunk_size, so that the distance and order matrices never take more than
+    chunk_size x N. chunk_size of 0 processes all queries at once"""
+    Q = hashes_test.shape[0]
+    if chunk_size <= 0:
+        chunk_size = Q
+
     if has_cython and not force_slow:
-        print(order.shape,labels_train.shape,labels_test.shape)
-        return _mean_average_precision.calc_map(order, labels_train, labels_test, top_n, and_mode,weighted_mode)
+        labels_train_p = _mean_average_precision.prepare_labels(labels_train, and_mode, weighted_mode)
+
+    map = 0.0
+    curve = None
+    for begin in range(0, Q, chunk_size):
+        end = min(begin + chunk_size, Q)
+        order = calc_hamming_rank(hashes_train, hashes_test[begin:end])
+        if has_cython and not force_slow:
+            labels_test_p = _mean_average_precision.prepare_labels(labels_test[begin:end], and_mode, weighted_mode)
+            chunk_map, chunk_curve = _mean_average_precision.calc_map_prepared(order, labels_train_p, labels_test_p, top_n, and_mode, weighted_mode)
+        else:
+            #print("Warning. Using slow \"compute_map\"")
+            s = __compute_s(labels_train, labels_test[begin:end], and_mode)
+            chunk_map, chunk_curve = __calc_map(order, np.transpose(s), top_n)
+        del order
+
+        # Chunk results are averaged over the chunk queries, so weight them by the chunk size
+        map += chunk_map * (end - begin)
+        if chunk_curve is not None:
+            curve = chunk_curve * (end - begin) if curve is None else curve + chunk_curve * (end - begin)
+
+    map /= Q
+    if curve is not None:
+        curve /= Q
+    return float(map), curve
+
+#@timer
+def compute_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode=False,weighted_mode = False, average_ties=False, top_n=0, curve=False, cutoffs=None, radius=None, asymmetric=False, bit_weights=None):
+    """Compute MAP using native HashRankingContext. If average_ties is set, AP is averaged over all orderings of
+    items with equal hamming distance, otherwise they are ranked in the DB order. top_n limits the ranking to the
+    first top_n items, 0 means all.
+    If curve is set, returns tuple of MAP and precision/recall curve, the same as compute_map does. The curve has a
+    row for every rank up to top_n or for every rank in cutoffs.
+    If radius is set, hash lookup within the hamming radius is evaluated in the same pass, and a tuple of its
+    precision, recall and mean number of retrieved items is appended to the result.
+    If asymmetric is set, queries are not binarized: DB items are ranked by the sum of magnitudes of query components
+    whose sign differs from the DB bit, which is the same as ranking by the inner product with the binary DB hash.
+    Radius is not defined in this mode.
+    If bit_weights is set, items at equal hamming distance are ranked by weighted hamming distance, the sum of weights
+    of the differing bits. Weights are an array of shape [bits], for example from learn_bit_weights, an array of shape
+    [queries, bits], or 'margin' to use magnitudes of the query components"""
+    return _mean_average_precision.calc_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode,weighted_mode, average_ties, top_n, curve, cutoffs, radius, asymmetric, bit_weights)
+
+
+def compute_rank_fast(hashes_train, hashes_test, top_n=0, asymmetric=False, bit_weights=None):
+    """Rank DB items for each query using native HashRankingContext. Returns indices of the first top_n items, all if
+    top_n is 0, in the same order as calc_hamming_rank gives. See compute_map_fast for asymmetric and bit_weights"""
+    return _mean_average_precision.calc_rank_fast(hashes_train, hashes_test, top_n, asymmetric, bit_weights)
+
+
+def compute_map_rerank(hashes_train, hashes_test, labels_train, labels_test, shortlist=100, cutoffs=None, and_mode=False,
+                       weighted_mode=False, embeddings_train=None, embeddings_test=None, asymmetric=False, bit_weights=None):
+    """Two-stage retrieval using native HashRankingContext: the first shortlist items of the hash ranking are
+    re-ranked by the dot product of real-valued embeddings. Embeddings are the hashes themselves, as gen_hashes
+    outputs them before binarization, unless given. Hash ranking options are the same as of compute_map_fast.
+    Returns MAP over the re-ranked shortlist and array of precision at each of the cutoffs, [shortlist] by default.
+    AP is normalized by the number of relevant items in the shortlist, the same as compute_map_fast with top_n"""
+    return _mean_average_precision.calc_map_rerank(hashes_train, hashes_test, labels_train, labels_test, and_mode, weighted_mode, shortlist, cutoffs, embeddings_train, embeddings_test, asymmetric, bit_weights)
+
+
+def compute_rerank(hashes_train, hashes_test, shortlist=100, embeddings_train=None, embeddings_test=None, asymmetric=False, bit_weights=None):
+    """Indices of the re-ranked shortlist of each query, see compute_map_rerank"""
+    return _mean_average_precision.calc_rerank(hashes_train, hashes_test, shortlist, embeddings_train, embeddings_test, asymmetric, bit_weights)
+
+
+def learn_bit_weights(hashes, labels, and_mode=False, pairs=100000, seed=None):
+    """Learn weights of bits for compute_map_fast from training hashes and labels. The weight of a bit is the log
+    likelihood ratio of the pair being similar when the bit agrees vs when it differs, logit(p) - logit(q), where p
+    and q are the probabilities that the bit agrees for similar and for dissimilar pairs. Probabilities are estimated
+    on random pairs. Weights of bits that are not informative are zero"""
+    rng = np.random.RandomState(seed)
+    bits = np.asarray(hashes) > 0
+    labels = to_bitsets(labels) if and_mode else np.asarray(labels).reshape(-1)
+    i = rng.randint(bits.shape[0], size=pairs)
+    j = rng.randint(bits.shape[0], size=pairs)
+    if and_mode:
+        similar = relevance_pairs(labels[i], labels[j])
     else:
-        #print("Warning. Using slow \"compute_map\"")
-        s = __compute_s(labels_train, labels_test, and_mode)
-        return __calc_map(order, np.transpose(s), top_n)
+        similar = labels[i] == labels[j]
+    agree = bits[i] == bits[j]
+
+    # Laplace smoothing keeps the logits finite
+    p = (np.sum(agree[similar], axis=0) + 1.0) / (np.count_nonzero(similar) + 2.0)
+    q = (np.sum(agree[~similar], axis=0) + 1.0) / (np.count_nonzero(~similar) + 2.0)
+    weights = np.log(p / (1.0 - p)) - np.log(q / (1.0 - q))
+    return np.maximum(weights, 0.0).astype(np.float32)
+
 
 #@timer
-def compute_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode=False,weighted_mode = False):
-    return _mean_average_precision.calc_map_fast(hashes_train, hashes_test, labels_train, labels_test, and_mode,weighted_mode)
+def compute_map_packed(db, hashes_test, labels_test, and_mode=False, weighted_mode=False, average_ties=False, top_n=0, curve=False, cutoffs=None, radius=None, asymmetric=False, bit_weights=None):
+    """Same as compute_map_fast, but DB hashes and labels are taken from utils.hash_file.HashFile, that is memory-mapped
+    into HashRankingContext without a copy"""
+    return _mean_average_precision.calc_map_packed(db, hashes_test, labels_test, and_mode, weighted_mode, average_ties, top_n, curve, cutoffs, radius, asymmetric, bit_weights)
+
+
+def stratified_query_sample(labels_test, sample_size, seed=None):
+    """Draw indices of sample_size queries, stratified by label. Each label gets a share of the sample proportional
+    to its frequency, labels that are too rare to get a query on their own are pooled into one stratum.
+    Returns indices and stratum of each index, strata are numbered from 0. Raises ValueError if sample_size is less
+    than the number of strata, that each need a query"""
+    rng = np.random.RandomState(seed)
+    labels_test = np.asarray(labels_test)
+    if labels_test.dtype == np.uint64 and labels_test.ndim == 2:
+        # Label bitsets, each distinct set of tags is a label
+        _, inverse, counts = np.unique(labels_test, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+    else:
+        _, inverse, counts = np.unique(labels_test.reshape(-1), return_inverse=True, return_counts=True)
+    Q = inverse.shape[0]
+    sample_size = min(sample_size, Q)
+
+    rare = counts * sample_size < Q
+    if np.any(rare):
+        strata = np.cumsum(~rare) - 1
+        strata[rare] = np.count_nonzero(~rare)
+        inverse = strata[inverse]
+        counts = np.bincount(inverse)
+
+    if counts.shape[0] > sample_size:
+        raise ValueError("Sample size {0} is less than the number of strata {1}".format(sample_size, counts.shape[0]))
+
+    # Largest remainder allocation, every stratum gets at least one query. Queries given to strata below their quota
+    # are taken back from the strata that are the most above their quota, so the sample keeps its size
+    quota = counts * sample_size / Q
+    allocation = np.maximum(np.floor(quota).astype(np.int64), 1)
+    remainder = sample_size - np.sum(allocation)
+    if remainder > 0:
+        allocation[np.argsort(allocation - quota, kind='stable')[:remainder]] += 1
+    while remainder < 0:
+        allocation[np.argmin(np.where(allocation > 1, quota - allocation, np.inf))] -= 1
+        remainder += 1
+
+    indices = []
+    strata = []
+    for h in range(counts.shape[0]):
+        members = np.flatnonzero(inverse == h)
+        indices.append(np.sort(rng.choice(members, allocation[h], replace=False)))
+        strata.append(np.full(allocation[h], h, dtype=np.int64))
+    return np.concatenate(indices), np.concatenate(strata), counts
+
+
+def __stratified_bootstrap(values, strata, counts, confidence, bootstrap, rng):
+    """Stratified mean of values and its percentile bootstrap confidence interval. Values are resampled within
+    each stratum, and the strata are weighted by their share of the query set"""
+    weights = counts / np.sum(counts)
+    mean = 0.0
+    resampled = np.zeros(bootstrap)
+    for h in range(counts.shape[0]):
+        v = values[strata == h]
+        mean += weights[h] * np.mean(v)
+        resampled += weights[h] * np.mean(v[rng.randint(v.shape[0], size=(bootstrap, v.shape[0]))], axis=1)
+    alpha = (1.0 - confidence) / 2.0
+    low, high = np.percentile(resampled, [100.0 * alpha, 100.0 * (1.0 - alpha)])
+    return float(mean), float(low), float(high)
+
+
+def __sample_ap(sample, hashes, labels_train, labels_test, and_mode, weighted_mode, average_ties, top_n):
+    labels_test = np.asarray(labels_test)[sample]
+    context = MapContext(labels_train, labels_test, and_mode, weighted_mode)
+    result = []
+    for hashes_train, hashes_test in hashes:
+        context.map(hashes_train, np.asarray(hashes_test)[sample], average_ties=average_ties, top_n=top_n)
+        result.append(context.query_ap().astype(np.float64))
+    return result
+
+
+def estimate_map(hashes_train, hashes_test, labels_train, labels_test, sample_size=500, and_mode=False,
+                 weighted_mode=False, average_ties=False, top_n=0, confidence=0.95, bootstrap=1000, seed=None):
+    """Estimate MAP from a stratified sample of sample_size queries, see stratified_query_sample.
+    Returns estimate of MAP and lower and upper bounds of its bootstrap confidence interval"""
+    rng = np.random.RandomState(seed)
+    sample, strata, counts = stratified_query_sample(labels_test, sample_size, rng.randint(2 ** 31 - 1))
+    ap, = __sample_ap(sample, [(hashes_train, hashes_test)], labels_train, labels_test, and_mode, weighted_mode,
+                      average_ties, top_n)
+    return __stratified_bootstrap(ap, strata, counts, confidence, bootstrap, rng)
+
+
+def compare_map(hashes_train_a, hashes_test_a, hashes_train_b, hashes_test_b, labels_train, labels_test,
+                sample_size=500, and_mode=False, weighted_mode=False, average_ties=False, top_n=0, confidence=0.95,
+                bootstrap=1000, seed=None):
+    """Paired comparison of two sets of hashes of the same items. Both are evaluated on the same stratified sample
+    of queries, and the difference of AP is bootstrapped per query, which gives much narrower interval than
+    comparison of two independent estimates.
+    Returns estimate of MAP(b) - MAP(a) and lower and upper bounds of its bootstrap confidence interval. b is better
+    with the given confidence if the lower bound is positive"""
+    rng = np.random.RandomState(seed)
+    sample, strata, counts = stratified_query_sample(labels_test, sample_size, rng.randint(2 ** 31 - 1))
+    ap_a, ap_b = __sample_ap(sample, [(hashes_train_a, hashes_test_a), (hashes_train_b, hashes_test_b)],
+                             labels_train, labels_test, and_mode, weighted_mode, average_ties, top_n)
+    return __stratified_bootstrap(ap_b - ap_a, strata, counts, confidence, bootstrap, rng)
 
 
 #@timer
@@ -47,7 +237,7 @@ def __compute_s(train_l, test_l, and_mode):
     The output is binary matrix of size n_train x n_test
     """
     if and_mode:
-        return np.bitwise_and(train_l, np.transpose(test_l)).astype(dtype=np.bool)
+        return relevance(train_l, test_l)
     else:
         return np.equal(train_l, np.transpose(test_l))
 
@@ -66,7 +256,7 @@ def __calc_map(order, s, top_n):
         total_number_of_relevant_documents = np.sum(s[q].astype(np.float32))
         relevance = s[q, order[q, :top_n]].astype(np.float32)
         cumulative = np.cumsum(relevance)
-        number_of_relative_docs = cumulative[-1:]
+        number_of_relative_docs = cumulative[-1]
         if number_of_relative_docs != 0:
             precision = cumulative / pos
             recall = cumulative / total_number_of_relevant_documents
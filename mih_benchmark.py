@@ -0,0 +1,85 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmark of multi-index hashing against the linear scan. Checks that both return the same neighbours."""
+
+import time
+import numpy as np
+from hashranking import hamming
+from utils.hamming import _hamming
+
+DB_SIZE = 1000000
+QUERY_SIZE = 100
+BITS = 64
+SUBSTRINGS = 4
+CLUSTERS = 1000
+NOISE = 0.1
+K = 10
+RADIUS = 4
+
+
+def gen_hashes(centers, count):
+    """Codes scattered around cluster centers, each bit is flipped with probability NOISE"""
+    hashes = centers[np.random.randint(0, centers.shape[0], count)]
+    flip = np.random.rand(count, BITS) < NOISE
+    return np.where(flip, -hashes, hashes).astype(np.float32)
+
+
+def main():
+    np.random.seed(0)
+    centers = np.random.rand(CLUSTERS, BITS).astype(np.float32) - 0.5
+    db = gen_hashes(centers, DB_SIZE)
+    queries = gen_hashes(centers, QUERY_SIZE)
+
+    start = time.time()
+    mih = hamming.MultiIndexHashing()
+    mih.Init(BITS, SUBSTRINGS)
+    mih.Build(db)
+    print("MIH build: %.3f s" % (time.time() - start))
+
+    start = time.time()
+    indices, distances = mih.KNN(queries, K)
+    mih_knn_time = time.time() - start
+
+    hr = hamming.HashRankingContext()
+    hr.Init(DB_SIZE, QUERY_SIZE, 2 if BITS > 64 else (1 if BITS > 32 else 0), 0, BITS)
+    hr.LoadQueryHashes(queries)
+    hr.LoadDBHashes(db)
+
+    start = time.time()
+    linear_indices = np.stack([hr.Sort(q, K) for q in range(QUERY_SIZE)])
+    linear_knn_time = time.time() - start
+
+    print("%d-NN, MIH: %.3f s, linear scan: %.3f s, speedup: %.1fx" %
+          (K, mih_knn_time, linear_knn_time, linear_knn_time / mih_knn_time))
+    print("Passed!" if (indices == linear_indices).all() else "Failed!")
+
+    start = time.time()
+    indptr, neighbours, dist = mih.RadiusSearch(queries, RADIUS)
+    mih_radius_time = time.time() - start
+
+    start = time.time()
+    linear_indptr, linear_neighbours, linear_dist = _hamming.calc_hamming_dist_radius(queries, db, RADIUS)
+    linear_radius_time = time.time() - start
+
+    print("r=%d neighbours, MIH: %.3f s, linear scan: %.3f s, speedup: %.1fx, mean candidates: %.1f" %
+          (RADIUS, mih_radius_time, linear_radius_time, linear_radius_time / mih_radius_time,
+           indptr[-1] / float(QUERY_SIZE)))
+    passed = (indptr == linear_indptr).all() and (neighbours == linear_neighbours).all()
+    passed = passed and (dist == linear_dist).all()
+    print("Passed!" if passed else "Failed!")
+
+
+if __name__ == '__main__':
+    main()
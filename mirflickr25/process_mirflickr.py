@@ -3,6 +3,11 @@ from functools import reduce
 import shutil
 import glob
 import random
+import os
+import sys
+# Scripts run from their own directory, utils are in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.label_bitsets import from_tags, words_for
 #import ipdb
 def num_to_key(num):
     return './mirflickr/im{}.jpg'.format(num)
@@ -18,7 +23,7 @@ for i,labelFile in enumerate(labelFiles):
         images = inF.readlines()
         images = [i.strip() for i in images]
     for image in images:
-        meta_db[num_to_key(image)].append(1<<i)
+        meta_db[num_to_key(image)].append(i)
 
 
 imgs = img_files
@@ -30,10 +35,8 @@ db = training
 def make_pkl(samples,fname):
     data = []
     for sample in samples:
-
-        label = 0
-        for l in meta_db[sample]:
-            label |= l
+        # Label bitsets of the tags of the sample
+        label = from_tags([meta_db[sample]], words_for(len(labelFiles)))[0]
 
         data.append((label,sample))
         
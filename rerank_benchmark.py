@@ -0,0 +1,58 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Accuracy and latency of two-stage retrieval for different shortlist sizes: hamming ranking, then re-ranking of
+the shortlist by the dot product of the real-valued embeddings."""
+
+import time
+import numpy as np
+from mean_average_precision import compute_map_fast
+from mean_average_precision import compute_map_rerank
+
+DB_SIZE = 100000
+QUERY_SIZE = 1000
+BITS = 48
+CLASSES = 100
+NOISE = 1.0
+TOP_K = 50
+SHORTLISTS = [50, 100, 200, 500, 1000, 5000]
+
+
+def gen_embeddings(centers, count):
+    labels = np.random.randint(0, centers.shape[0], count)
+    embeddings = centers[labels] + np.random.normal(scale=NOISE, size=(count, BITS))
+    return embeddings.astype(np.float32), labels.reshape(-1, 1)
+
+
+def main():
+    np.random.seed(0)
+    centers = np.random.normal(size=(CLASSES, BITS))
+    db, labels_db = gen_embeddings(centers, DB_SIZE)
+    queries, labels_q = gen_embeddings(centers, QUERY_SIZE)
+
+    start = time.time()
+    map_hamming = compute_map_fast(db, queries, labels_db, labels_q, top_n=TOP_K)
+    print("Hamming only, mAP@%d: %f, %.3f s" % (TOP_K, map_hamming, time.time() - start))
+
+    for shortlist in SHORTLISTS:
+        start = time.time()
+        # mAP over the re-ranked shortlist, and precision at TOP_K
+        map_rerank, precision = compute_map_rerank(db, queries, labels_db, labels_q, shortlist=shortlist,
+                                                   cutoffs=[min(TOP_K, shortlist)])
+        print("Shortlist %d, mAP: %f, precision@%d: %f, %.3f s" %
+              (shortlist, map_rerank, min(TOP_K, shortlist), precision[0], time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Search of a rotation of the hash space that improves MAP"""
+
+import ctypes
+import multiprocessing
+import numpy as np
+from mean_average_precision import MapContext
+from mean_average_precision import prepare_labels
+from utils.random_rotation import random_rotation
+
+
+# State of the process that evaluates candidates of random_rotation_search, set by _init_worker
+_worker = {}
+
+
+def _share(array):
+    """Copy array to shared memory, that is passed to the pool processes without pickling of the data"""
+    array = np.ascontiguousarray(array)
+    raw = multiprocessing.RawArray(ctypes.c_uint8, max(array.nbytes, 1))
+    np.frombuffer(raw, dtype=array.dtype, count=array.size).reshape(array.shape)[...] = array
+    return raw, array.dtype.str, array.shape
+
+
+def _view(shared):
+    raw, dtype, shape = shared
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _init_worker(H_db, H_q, labels_db, labels_q, and_mode, weighted_mode, top_n, thread_count=None):
+    _worker['H_db'] = _view(H_db)
+    _worker['H_q'] = _view(H_q)
+    _worker['context'] = MapContext(_view(labels_db), _view(labels_q), and_mode, weighted_mode, prepared=True,
+                                    thread_count=thread_count)
+    _worker['top_n'] = top_n
+
+
+def _base_rotation(alpha, size):
+    I = np.eye(size, dtype=np.float32)
+    I[0:2, 0:2] = [[np.cos(alpha), -np.sin(alpha)], [np.sin(alpha), np.cos(alpha)]]
+    return I
+
+
+def _evaluate_candidates(task):
+    """Return the best of candidate rotations, that are generated from the given seeds. Each candidate is R
+    followed by rotation of the given angle in a random plane"""
+    R, step, seeds = task
+    H_db = _worker['H_db']
+    H_q = _worker['H_q']
+    size = R.shape[0]
+    best = (-1.0, None)
+    for seed in seeds:
+        rng = np.random.RandomState(seed)
+        rBasis = random_rotation(size, rng).astype(np.float32)
+        s = step if rng.uniform() > 0.5 else -step
+        deltaR = np.matmul(rBasis.T, np.matmul(_base_rotation(s, size), rBasis))
+        newR = np.matmul(R, deltaR)
+        mapd = _worker['context'].map(np.matmul(H_db, newR), np.matmul(H_q, newR), top_n=_worker['top_n'])
+        if mapd > best[0]:
+            best = (mapd, newR)
+    return best
+
+
+def random_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=False, weighted_mode=False, top_n=0,
+                           steps=800, population=8, max_angle=1.0, processes=None, seed=None, R=None):
+    """Greedy search of rotation R, such that sign(H R) gives better MAP on the given DB and query sets.
+    On each step population candidates are made by rotation of the current R by an angle in a random plane, and
+    the best of them is kept if it improves MAP. The angle is annealed from max_angle to zero.
+    Candidates are evaluated by a pool of processes, all cores by default, that share H and labels in shared
+    memory. Candidates are generated from seeds drawn from the seed of the search, and the first best one is taken,
+    so the result does not depend on the number of processes. Returns R and MAP after the search"""
+    rng = np.random.RandomState(seed)
+    H_db = np.asarray(H_db, dtype=np.float32)
+    H_q = np.asarray(H_q, dtype=np.float32)
+    hash_size = H_db.shape[1]
+    R = np.eye(hash_size, hash_size, dtype=np.float32) if R is None else np.asarray(R, dtype=np.float32)
+
+    context = MapContext(labels_db, labels_q, and_mode, weighted_mode)
+    mapd0 = context.map(np.matmul(H_db, R), np.matmul(H_q, R), top_n=top_n)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, population))
+
+    labels_db = _share(prepare_labels(labels_db, and_mode, weighted_mode))
+    labels_q = _share(prepare_labels(labels_q, and_mode, weighted_mode))
+    init_args = (_share(H_db), _share(H_q), labels_db, labels_q, and_mode, weighted_mode, top_n)
+
+    if processes > 1:
+        # The cores are split between the processes, so that they do not run a ranking thread per core each
+        thread_count = max(1, multiprocessing.cpu_count() // processes)
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=init_args + (thread_count,))
+        evaluate = pool.map
+    else:
+        _init_worker(*init_args)
+        evaluate = lambda f, tasks: [f(t) for t in tasks]
+
+    try:
+        for i in range(steps):
+            step = max_angle * (steps - i) / steps
+            seeds = rng.randint(2 ** 31 - 1, size=population)
+            tasks = [(R, step, chunk) for chunk in np.array_split(seeds, processes)]
+
+            updated = False
+            for mapd1, newR in evaluate(_evaluate_candidates, tasks):
+                if mapd1 > mapd0:
+                    R = newR
+                    mapd0 = mapd1
+                    updated = True
+            if updated:
+                print("++++++++++++++ %f ++++++++++++++++" % mapd0)
+    finally:
+        if processes > 1:
+            pool.close()
+            pool.join()
+        else:
+            _worker.clear()
+
+    return R, mapd0
+
+
+def givens_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=False, weighted_mode=False, top_n=0,
+                           steps=20000, max_angle=1.0, seed=None):
+    """Greedy search of rotation R, such that sign(H R) gives better MAP on the given DB and query sets.
+    Each step proposes a rotation in the plane of two random dimensions (Givens rotation) and keeps it if MAP
+    improves. Such rotation changes only two bits of each hash, so it is evaluated incrementally, by visiting only
+    the pairs where one of the bits changed. The angle is annealed from max_angle to zero. MAP is tie averaged.
+    Returns R and MAP after the search"""
+    rng = np.random.RandomState(seed)
+    H_db = np.array(H_db, dtype=np.float32)
+    H_q = np.array(H_q, dtype=np.float32)
+    hash_size = H_db.shape[1]
+    R = np.eye(hash_size, hash_size, dtype=np.float32)
+
+    context = MapContext(labels_db, labels_q, and_mode, weighted_mode)
+    mapd0 = context.start_rotation_search(H_db, H_q, top_n)
+
+    for i in range(steps):
+        alpha = max_angle * (steps - i) / steps * rng.uniform(-1.0, 1.0)
+        a, b = rng.choice(hash_size, 2, replace=False)
+        G = np.array([[np.cos(alpha), -np.sin(alpha)], [np.sin(alpha), np.cos(alpha)]], dtype=np.float32)
+
+        columns_db = np.matmul(H_db[:, [a, b]], G)
+        columns_q = np.matmul(H_q[:, [a, b]], G)
+        mapd1 = context.propose_rotation(a, b, columns_db > 0, columns_q > 0)
+
+        if mapd1 > mapd0:
+            context.commit_rotation()
+            H_db[:, [a, b]] = columns_db
+            H_q[:, [a, b]] = columns_q
+            R[:, [a, b]] = np.matmul(R[:, [a, b]], G)
+            mapd0 = mapd1
+
+    return R, mapd0
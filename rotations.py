@@ -7,9 +7,7 @@ from pprint import pformat
 from shutil import copyfile
 from mean_average_precision import compute_map
 from mean_average_precision import compute_map_fast
-from utils.random_rotation import random_rotation
-from random import random
-import threading
+from rotation_search import random_rotation_search
 import numpy as np
 
 from evaluate_performance import evaluate
@@ -17,15 +15,6 @@ from evaluate_performance import evaluate
 import bimpy
 
 
-def GetBaseRotation(alpha, size):
-    alphas = np.sin(alpha)
-    alphac = np.cos(alpha)
-    flat_rotation = np.array([[alphac, -alphas], [alphas, alphac]])
-    I = np.eye(size)
-    I[0:2, 0:2] = flat_rotation
-    return I.astype(np.float32)
-
-
 ctx = bimpy.Context()
 
 ctx.init(1200, 1200, "ITQ")
@@ -195,7 +184,7 @@ def doRotation():
     l_db = l_train
     b_db = b_train
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train
         , l_train
@@ -209,7 +198,7 @@ def doRotation():
 
     print("Test on train: %f" % map_test)
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train
         , l_test
@@ -232,7 +221,7 @@ def doRotation():
 
     print("After rotation:")
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train_r
         , l_train
@@ -246,7 +235,7 @@ def doRotation():
 
     print("Test on train: %f" % map_test)
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train_r
         , l_test
@@ -268,7 +257,7 @@ def doRotation():
 
     print("After rotation2:")
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train_r
         , l_train
@@ -282,7 +271,7 @@ def doRotation():
 
     print("Test on train: %f" % map_test)
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train_r
         , l_test
@@ -307,50 +296,7 @@ def doRotation():
     labels_db = labels_original[idx_db, :]
     H_db =  H_original[idx_db, :]
 
-    mapd0, _ = compute_map(H_db, H_q, labels_db, labels_q, and_mode=True, force_slow=False)
-    step = 1.0
-    R = R.astype(np.float32)
-
-    worker_count = 1
-    steps = int(800 / worker_count)
-    results = [(0, np.eye(hash_size, hash_size, dtype=np.float32)) for i in range(worker_count)]
-
-    for i in range(steps):
-        step = (steps - i) / steps
-
-        def ComputeNewValue(w):
-            rBasis = random_rotation(HASH_SIZE).astype(np.float32)
-            if random() > 0.5:
-                s = step
-            else:
-                s = -step
-
-            deltaR = np.matmul(rBasis.T, np.matmul(GetBaseRotation(s, HASH_SIZE), rBasis))
-            newR = np.matmul(R, deltaR)
-            rotated_data = np.matmul(H_db, newR)
-            rotated_data_q = np.matmul(H_q, newR)
-            mapd1 = compute_map_fast(rotated_data, rotated_data_q, labels_db, labels_q, and_mode=True)
-            results[w] = (mapd1, newR)
-
-        threads = []
-        for w in range(worker_count):
-            t = threading.Thread(target=ComputeNewValue, args=(w, ))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        updated = False
-        for w in range(worker_count):
-            print("%f " % results[w][0], end='')
-            if results[w][0] > mapd0:
-                R = results[w][1]
-                mapd0 = results[w][0]
-                updated = True
-        print("")
-        if updated:
-            print("++++++++++++++ %f ++++++++++++++++" % mapd0)
+    R, mapd0 = random_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=True, R=R.astype(np.float32))
 
     b_train = b_train_o
     l_train = l_train_o
@@ -365,7 +311,7 @@ def doRotation():
 
     print("Brute force rotation:")
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train_r
         , l_test
@@ -389,7 +335,7 @@ def doRotation():
     l_db = l_train
     b_db = b_train
 
-    _, map_test, _ = evaluate(
+    _, map_test, _, _ = evaluate(
           l_train
         , b_train
         , l_test
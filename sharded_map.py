@@ -0,0 +1,235 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Evaluation of a DB that is split into shards of hash files, each held by its own worker process.
+
+Shards return per-query distance histograms, that are merged into the exact MAP and top-k lists of the whole DB.
+Results are the same as of compute_map_packed with all hashes in one file.
+"""
+
+import multiprocessing
+import traceback
+import numpy as np
+import mean_average_precision  # builds _mean_average_precision with pyximport
+from _mean_average_precision import packed_context
+from hashranking import hamming
+from utils.hash_file import HashFile
+from utils.hash_file import save_hashes
+
+# Queries are evaluated in chunks of at most this many histogram buckets in total. With bit weights there are 65536
+# buckets per query, so dense histograms of all queries at once would take gigabytes
+CHUNK_BUCKETS = 1 << 22
+
+
+def save_shards(pattern, hashes, labels, shards, bitset_labels=False):
+    """Split hashes and labels into shards of about equal size, that follow in the DB order, and write them with
+    save_hashes. pattern is formatted with the shard index. Returns paths of the shards"""
+    labels = np.asarray(labels)
+    bounds = np.linspace(0, hashes.shape[0], shards + 1).astype(np.int64)
+    paths = []
+    for i in range(shards):
+        path = pattern.format(i)
+        save_hashes(path, hashes[bounds[i]:bounds[i + 1]], labels[bounds[i]:bounds[i + 1]], bitset_labels)
+        paths.append(path)
+    return paths
+
+
+def _shard_worker(conn, path, and_mode, weighted_mode):
+    """Serve requests of ShardedDB for one shard. The context is kept between requests, so the distances
+    are computed once for the histograms and TB_index AP"""
+    db = HashFile(path)
+    hr = None
+    conn.send(('ok', db.count))
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            command, args = request[0], request[1:]
+            if command == 'queries':
+                hashes_test, labels_test, asymmetric, bit_weights = args
+                hr = packed_context(db, hashes_test, labels_test, and_mode, weighted_mode, asymmetric, bit_weights)
+                result = hr.GetBuckets()
+            elif command == 'histograms':
+                first, count = args
+                result = hr.ShardHistograms(first, count)
+            elif command == 'index_ap':
+                indptr, bucket, base_rank, base_gain, top_n, first = args
+                result = hr.ShardIndexAP(indptr, bucket, base_rank, base_gain, top_n, first)
+            elif command == 'top_k':
+                result = hr.TopK(args[0])
+            else:
+                raise ValueError("Unknown command: {0}".format(command))
+            conn.send(('ok', result))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class ShardedDB:
+    """DB of hash files written by save_hashes (or save_shards), that follow in the DB order. Each shard is memory-mapped
+    by its own worker process, so no process holds the whole DB"""
+    def __init__(self, paths, and_mode=False, weighted_mode=False):
+        self.and_mode = and_mode
+        self.weighted_mode = weighted_mode
+        self.__connections = []
+        self.__processes = []
+        for path in paths:
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child, path, and_mode, weighted_mode))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.__connections.append(parent)
+            self.__processes.append(process)
+        self.counts = self.__gather()
+        self.offsets = np.cumsum([0] + self.counts)[:-1]
+        self.count = int(sum(self.counts))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for conn in self.__connections:
+            conn.send(None)
+            conn.close()
+        for process in self.__processes:
+            process.join()
+        self.__connections = []
+        self.__processes = []
+
+    def __gather(self):
+        results = []
+        for conn in self.__connections:
+            status, result = conn.recv()
+            if status != 'ok':
+                raise RuntimeError("Shard worker failed:\n" + result)
+            results.append(result)
+        return results
+
+    def __broadcast(self, *request):
+        for conn in self.__connections:
+            conn.send(request)
+        return self.__gather()
+
+    def __scatter(self, requests):
+        for conn, request in zip(self.__connections, requests):
+            conn.send(request)
+        return self.__gather()
+
+    def __load_queries(self, hashes_test, labels_test, asymmetric, bit_weights):
+        hashes_test = np.ascontiguousarray(hashes_test, dtype=np.float32)
+        return max(self.__broadcast('queries', hashes_test, labels_test, asymmetric, bit_weights))
+
+    def map(self, hashes_test, labels_test, average_ties=False, top_n=0, asymmetric=False, bit_weights=None):
+        """MAP of the queries over the whole DB, the same as compute_map_fast returns"""
+        buckets = self.__load_queries(hashes_test, labels_test, asymmetric, bit_weights)
+        top_n = self.count if top_n <= 0 or top_n > self.count else top_n
+        query_size = hashes_test.shape[0]
+        chunk = max(1, CHUNK_BUCKETS // buckets)
+        merge = hamming.HashRankingContext()
+
+        ap = np.zeros(query_size, dtype=np.float32)
+        for first in range(0, query_size, chunk):
+            count = min(chunk, query_size - first)
+            histograms = self.__broadcast('histograms', first, count)
+            # Non-empty buckets of all shards, as (query, bucket, shard) entries
+            query = np.concatenate([np.repeat(np.arange(count), np.diff(h[0])) for h in histograms])
+            bucket = np.concatenate([h[1] for h in histograms])
+            shard = np.concatenate([np.full(h[1].shape[0], i) for i, h in enumerate(histograms)])
+            total = np.concatenate([h[2] for h in histograms])
+            relevant = np.concatenate([h[3] for h in histograms])
+            gain_sum = np.concatenate([h[4] for h in histograms])
+
+            index_ap = np.zeros(count, dtype=np.int64)
+            index_relevant = np.zeros(count, dtype=np.int32)
+            if average_ties:
+                flat = query * buckets + bucket
+                dense = [np.bincount(flat, weights=v, minlength=count * buckets).astype(v.dtype).reshape(count, buckets)
+                         for v in (total, relevant, gain_sum)]
+            else:
+                # Items of a bucket are ranked after all items of preceding buckets, and after the items of the bucket
+                # in preceding shards. Exclusive sums over the entries in that order, restarted at each query
+                order = np.lexsort((shard, bucket, query))
+                start = np.searchsorted(query[order], np.arange(count))
+                bases = []
+                for v in (total, gain_sum):
+                    v = v[order].astype(np.int64)
+                    exclusive = np.cumsum(v) - v
+                    base = np.empty_like(exclusive)
+                    base[order] = exclusive - exclusive[np.minimum(start, v.shape[0] - 1)][query[order]]
+                    bases.append(base)
+                bounds = np.cumsum([0] + [h[1].shape[0] for h in histograms])
+                requests = []
+                for i, h in enumerate(histograms):
+                    part = slice(bounds[i], bounds[i + 1])
+                    requests.append(('index_ap', h[0], h[1], bases[0][part].astype(np.int32), bases[1][part],
+                                     top_n, first))
+                for a, r in self.__scatter(requests):
+                    index_ap += a
+                    index_relevant += r
+                # Histograms are not used for TB_index
+                dense = [np.zeros([count, 1], dtype=t) for t in (np.int32, np.int32, np.int64)]
+
+            _, ap[first:first + count] = merge.MergeShards(self.count, top_n, 1 if average_ties else 0,
+                                                           dense[0], dense[1], dense[2], index_ap, index_relevant)
+
+        # Single precision sum in the query order, the same as MergeShards and compute_map_fast do
+        return float(np.add.accumulate(ap, dtype=np.float32)[-1] / np.float32(query_size))
+
+    def top_k(self, hashes_test, k, asymmetric=False, bit_weights=None):
+        """First k items of the whole DB ranked for each query and their distances, arrays of shape [queries, k].
+        Items at equal distance are ranked in the DB order"""
+        self.__load_queries(hashes_test, None, asymmetric, bit_weights)
+        results = self.__broadcast('top_k', k)
+        indices = np.concatenate([r[0].astype(np.int64) + offset for r, offset in zip(results, self.offsets)], axis=1)
+        distances = np.concatenate([r[1] for r in results], axis=1)
+        order = np.lexsort((indices, distances), axis=1)[:, :k]
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+# For testing
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from mean_average_precision import compute_map_fast
+    from mean_average_precision import learn_bit_weights
+
+    rng = np.random.RandomState(0)
+    hashes_db = rng.randn(3000, 32).astype(np.float32)
+    hashes_test = rng.randn(300, 32).astype(np.float32)
+    labels_db = rng.randint(0, 10, size=(3000, 1))
+    labels_test = rng.randint(0, 10, size=(300, 1))
+    tags_db = rng.randint(0, 2 ** 10, size=3000)
+    tags_test = rng.randint(0, 2 ** 10, size=300)
+    bit_weights = learn_bit_weights(hashes_db, labels_db, seed=0)
+
+    directory = tempfile.mkdtemp()
+    cases = [(labels_db, labels_test, False), (tags_db, tags_test, True)]
+    for l_db, l_test, weighted_mode in cases:
+        paths = save_shards(os.path.join(directory, 'shard{0}.bin'), hashes_db, l_db, 3)
+        with ShardedDB(paths, weighted_mode=weighted_mode) as db:
+            for kw in [{}, dict(top_n=100), dict(asymmetric=True), dict(bit_weights=bit_weights),
+                       dict(bit_weights='margin', top_n=100)]:
+                for average_ties in [False, True]:
+                    expected = compute_map_fast(hashes_db, hashes_test, l_db, l_test, weighted_mode=weighted_mode,
+                                                average_ties=average_ties, **kw)
+                    passed = expected == db.map(hashes_test, l_test, average_ties=average_ties, **kw)
+                    print("Passed!" if passed else "Failed!")
+        for path in paths:
+            os.remove(path)
+    os.rmdir(directory)
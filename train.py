@@ -17,20 +17,12 @@ import constructor
 import loss_functions
 from evaluate_performance import evaluate
 from gen_hashes import gen_hashes
+from utils.label_bitsets import relevance
+from utils.label_bitsets import to_bitsets
 from mean_average_precision import compute_map
 from mean_average_precision import compute_map_fast
-from utils.random_rotation import random_rotation
-from random import random
-import threading
-
-
-def GetBaseRotation(alpha, size):
-    alphas = np.sin(alpha)
-    alphac = np.cos(alpha)
-    flat_rotation = np.array([[alphac, -alphas], [alphas, alphac]])
-    I = np.eye(size)
-    I[0:2, 0:2] = flat_rotation
-    return I.astype(np.float32)
+from rotation_search import givens_rotation_search
+from rotation_search import random_rotation_search
 
 
 class Train:
@@ -48,6 +40,10 @@ class Train:
         self.b_test = None
         self.and_mode = False
         self.top_n = 0
+        self.lookup_radius = 2
+        self.givens_search_steps = 0
+        self.search_population = 8
+        self.search_seed = None
         self.FAcc =0
 
         log_main = logging.getLogger()
@@ -72,7 +68,13 @@ class Train:
                 self.total_epoch_count = 0
                 self.dataset = None
                 self.top_n = 0
+                self.lookup_radius = 2
+                self.givens_search_steps = 0
+                self.search_population = 8
+                self.search_seed = None
                 self.freeze = False
+                self.decode_processes = 0
+                self.data_seed = None
 
         cfg = Cfg()
         self.cfg = cfg
@@ -89,6 +91,10 @@ class Train:
         self.directory = directory
 
         self.top_n = cfg.top_n
+        self.lookup_radius = cfg.lookup_radius
+        self.givens_search_steps = cfg.givens_search_steps
+        self.search_population = cfg.search_population
+        self.search_seed = cfg.search_seed
 
         logging.info("Starting {0}...".format(name))
 
@@ -187,7 +193,8 @@ class Train:
 
             num_examples_per_epoch_for_train = len(items_train)
             lmdb_file = './data/mirf' if cfg.dataset == 'mirflickr' else None
-            bp = batch_provider.BatchProvider(cfg.batch_size, items_train, cycled=True, imagenet=cfg.dataset == "imagenet",lmdb_file=lmdb_file)
+            bp = batch_provider.BatchProvider(cfg.batch_size, items_train, cycled=True, imagenet=cfg.dataset == "imagenet",lmdb_file=lmdb_file,
+                                              processes=cfg.decode_processes, seed=cfg.data_seed)
 
             num_batches_per_epoch = num_examples_per_epoch_for_train / cfg.batch_size
             decay_steps = int(num_batches_per_epoch * cfg.number_of_epochs_per_decay)
@@ -241,6 +248,12 @@ class Train:
             if lc is not None:
                 saver.restore(session, lc)
                 start_step = session.run(global_step)
+                state = self.LoadBatchesState(directory, lc)
+                if state is not None:
+                    bp.set_state(state)
+                    logger.info("Continuing from epoch {0}, batch {1}".format(state["epoch"], state["position"]))
+                else:
+                    logger.warning("No batch provider state for {0}, starting from the first batch".format(lc))
 
             batches = bp.get_batches()
 
@@ -254,14 +267,13 @@ class Train:
 
                 labels = feed_dict["labels"]
 
-                if self.and_mode == 1:
-                    labels = np.asarray(labels, np.object)
+                if self.and_mode == 1 or self.and_mode == 2:
+                    labels = to_bitsets(labels)
                 else:
                     labels = np.asarray(labels, np.uint32)
 
                 if self.and_mode == 1 or self.and_mode == 2:
-                    mask = np.bitwise_and(np.reshape(labels, [cfg.batch_size, 1]),
-                                          np.reshape(labels, [1, cfg.batch_size])).astype(dtype=np.bool)
+                    mask = relevance(labels, labels)
                 else:
                     mask = np.equal(np.reshape(labels, [cfg.batch_size, 1]), np.reshape(labels, [1, cfg.batch_size]))
 
@@ -290,22 +302,40 @@ class Train:
 
                 if (i % 2000 == 0) and i != 0:
                     self.TestAndSaveCheckpoint(model, session, items_train, items_test, items_db, cfg.hash_size,
-                                               directory, embedding_conf, saver, global_step, feed_dict)
+                                               directory, embedding_conf, saver, global_step, feed_dict, bp.get_state())
 
             self.TestAndSaveCheckpoint(model, session, items_train, items_test, items_db, cfg.hash_size,
-                                       directory, embedding_conf, saver, global_step)
+                                       directory, embedding_conf, saver, global_step, batches_state=bp.get_state())
 
         self.RotationSSH(directory)
         self.RotationITQ(directory)
         self.RotationSITQ(directory)
         self.RotationRandomSearch(directory)
+        if self.givens_search_steps > 0:
+            self.RotationGivensSearch(directory)
 
         with open(os.path.join(directory, "Done.txt"), "a") as file:
             file.write("\n")
 
+    def LoadBatchesState(self, directory, checkpoint):
+        """State of the batch provider saved with the checkpoint, None if there is no state for that checkpoint"""
+        path = os.path.join(directory, "batches_state.pkl")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as pkl:
+            saved = pickle.load(pkl)
+        if saved["checkpoint"] != os.path.basename(checkpoint):
+            return None
+        return saved["state"]
+
     def TestAndSaveCheckpoint(self, model, session, items_train, items_test, items_db, hash_size,
-                              directory, embedding_conf, saver, global_step, feed_dict=None):
-        saver.save(session, os.path.join(directory, "checkpoint"), global_step)
+                              directory, embedding_conf, saver, global_step, feed_dict=None, batches_state=None):
+        checkpoint = saver.save(session, os.path.join(directory, "checkpoint"), global_step)
+
+        # Position of the batch provider, so that a restart continues with the next batch
+        if batches_state is not None:
+            with open(os.path.join(directory, "batches_state.pkl"), 'wb') as pkl:
+                pickle.dump({"checkpoint": os.path.basename(checkpoint), "state": batches_state}, pkl)
 
         if feed_dict is not None:
             file = open(os.path.join(directory, embedding_conf.metadata_path), "w")
@@ -315,19 +345,17 @@ class Train:
 
         self.logger.info("Start generating hashes")
 
-        longints = self.and_mode == 1
-
         lmdb_file = "./data/mirf" if self.cfg.dataset == "mirflickr" else None
 
         self.l_train, self.b_train = gen_hashes(model.t_images, model.prob, model.t_labels,
-                                                model.output, session, items_train, hash_size, longints=longints, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
+                                                model.output, session, items_train, hash_size, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
 
         self.l_test, self.b_test = gen_hashes(model.t_images, model.prob, model.t_labels,
-                                              model.output, session, items_test, hash_size, 1, longints=longints, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
+                                              model.output, session, items_test, hash_size, 1, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
 
         if len(items_db) > 0:
             self.l_db, self.b_db = gen_hashes(model.t_images, model.prob, model.t_labels,
-                                              model.output, session, items_db, hash_size, longints=longints, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
+                                              model.output, session, items_db, hash_size, imagenet=self.cfg.dataset == "imagenet",lmdb_file = lmdb_file)
         else:
             self.l_db, self.b_db = self.l_train, self.b_train
 
@@ -351,8 +379,7 @@ class Train:
             H = H[idx,:]
 
         if self.and_mode == 1 or self.and_mode == 2:
-            S = np.bitwise_and(np.reshape(labels, [size, 1]),
-                               np.reshape(labels, [1, size])).astype(dtype=np.bool)
+            S = relevance(labels, labels)
         else:
             S = np.equal(np.reshape(labels, [size, 1]), np.reshape(labels, [1, size]))
 
@@ -417,8 +444,7 @@ class Train:
             H = H[idx,:]
 
         if self.and_mode == 1 or self.and_mode == 2:
-            S = np.bitwise_and(np.reshape(labels, [size, 1]),
-                               np.reshape(labels, [1, size])).astype(dtype=np.bool)
+            S = relevance(labels, labels)
         else:
             S = np.equal(np.reshape(labels, [size, 1]), np.reshape(labels, [1, size]))
 
@@ -441,14 +467,14 @@ class Train:
         self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "SITQ")
         return
 
-    def RotationRandomSearch(self, directory):
-        self.logger.info("Starting RandomSearch rotations")
+    def SearchSets(self):
+        """DB and query sets sampled from train set, on which rotation searches are evaluated"""
         labels = np.array(self.l_train)
         H = self.b_train.astype(np.float32)
 
         size = labels.shape[0]
 
-        idx = np.random.permutation(size)
+        idx = np.random.RandomState(self.search_seed).permutation(size)
 
         labels_q = labels
         labels_db = labels
@@ -472,63 +498,44 @@ class Train:
 
         print("DB size: %d Query set size: %d" % (H_db.shape[0], H_q.shape[0]))
 
-        R = np.eye(self.cfg.hash_size, self.cfg.hash_size, dtype=np.float32)
+        return H_db, H_q, labels_db, labels_q
+
+    def RotationRandomSearch(self, directory):
+        self.logger.info("Starting RandomSearch rotations")
+        H_db, H_q, labels_db, labels_q = self.SearchSets()
 
-        mapd0 = compute_map_fast(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode==1, weighted_mode = self.and_mode == 2)
-        step = 1.0
+        R, mapd = random_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode == 1,
+                                         weighted_mode=self.and_mode == 2, top_n=self.top_n,
+                                         population=self.search_population, seed=self.search_seed)
 
-        worker_count = 1
-        steps = int(800 / worker_count)
-        results = [(0, np.eye(self.cfg.hash_size, self.cfg.hash_size, dtype=np.float32)) for i in range(worker_count)]
+        b_train_r = np.matmul(self.b_train, R)
+        b_test_r = np.matmul(self.b_test, R)
+        b_db_r = np.matmul(self.b_db, R)
+        self.logger.info("Finished rotations")
 
-        for i in range(steps):
-            step = (steps - i) / steps
+        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "RandomSearch")
+        return
 
-            def ComputeNewValue(w):
-                rBasis = random_rotation(self.cfg.hash_size).astype(np.float32)
-                if random() > 0.5:
-                    s = step
-                else:
-                    s = -step
-
-                deltaR = np.matmul(rBasis.T, np.matmul(GetBaseRotation(s, self.cfg.hash_size), rBasis))
-                newR = np.matmul(R, deltaR)
-                rotated_data = np.matmul(H_db, newR)
-                rotated_data_q = np.matmul(H_q, newR)
-                mapd1 = compute_map_fast(rotated_data, rotated_data_q, labels_db, labels_q, and_mode=self.and_mode==1,weighted_mode = self.and_mode == 2)
-                results[w] = (mapd1, newR)
-
-            threads = []
-            for w in range(worker_count):
-                t = threading.Thread(target=ComputeNewValue, args=(w,))
-                threads.append(t)
-                t.start()
-
-            for t in threads:
-                t.join()
-
-            updated = False
-            for w in range(worker_count):
-                #print("%f " % results[w][0], end='')
-                if results[w][0] > mapd0:
-                    R = results[w][1]
-                    mapd0 = results[w][0]
-                    updated = True
-            print("")
-            if updated:
-                print("++++++++++++++ %f ++++++++++++++++" % mapd0)
+    def RotationGivensSearch(self, directory):
+        self.logger.info("Starting GivensSearch rotations")
+        H_db, H_q, labels_db, labels_q = self.SearchSets()
+
+        R, mapd = givens_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode == 1,
+                                         weighted_mode=self.and_mode == 2, top_n=self.top_n,
+                                         steps=self.givens_search_steps)
+        print("++++++++++++++ %f ++++++++++++++++" % mapd)
 
         b_train_r = np.matmul(self.b_train, R)
         b_test_r = np.matmul(self.b_test, R)
         b_db_r = np.matmul(self.b_db, R)
         self.logger.info("Finished rotations")
 
-        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "RandomSearch")
+        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "GivensSearch")
         return
 
     def eval(self, directory, l_train, b_train, l_test, b_test, l_db, b_db, prefix="No rotation"):
         self.logger.info("Starting evaluation")
-        map_train, map_test, curve = evaluate(
+        map_train, map_test, curve, radius_metrics = evaluate(
               l_train
             , b_train
             , l_test
@@ -537,10 +544,13 @@ class Train:
             , b_db
             , top_n=self.top_n
             , and_mode=self.and_mode == 1
-            , force_slow=self.and_mode == 1
-            , weighted_mode = self.and_mode == 2)
+            , weighted_mode = self.and_mode == 2
+            , radius=self.lookup_radius)
 
         report_string = prefix + ": Test on train: {0}; Test on test: {1}".format(map_train, map_test)
+        if radius_metrics is not None:
+            report_string += "; Lookup within radius {0}: precision: {1}; recall: {2}; mean candidates: {3}".format(
+                self.lookup_radius, *radius_metrics)
 
         with open(os.path.join(directory, "results.txt"), "a") as file:
             file.write(report_string + "\n")
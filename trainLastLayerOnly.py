@@ -17,21 +17,13 @@ import constructor
 import loss_functions
 from evaluate_performance import evaluate
 from gen_hashes import gen_hashes
+from utils.label_bitsets import relevance
+from utils.label_bitsets import to_bitsets
 from mean_average_precision import compute_map
 from mean_average_precision import compute_map_fast
+from rotation_search import givens_rotation_search
+from rotation_search import random_rotation_search
 from triplet_gen import gen_triplets
-from utils.random_rotation import random_rotation
-from random import random
-import threading
-
-
-def GetBaseRotation(alpha, size):
-    alphas = np.sin(alpha)
-    alphac = np.cos(alpha)
-    flat_rotation = np.array([[alphac, -alphas], [alphas, alphac]])
-    I = np.eye(size)
-    I[0:2, 0:2] = flat_rotation
-    return I.astype(np.float32)
 
 
 class Train:
@@ -49,8 +41,11 @@ class Train:
         self.b_test = None
         self.and_mode = False
         self.top_n = 0
+        self.lookup_radius = 2
+        self.givens_search_steps = 0
+        self.search_population = 8
+        self.search_seed = None
         self.FAcc = 0
-        self.longints = False
         self.BatchProviderConstructor = None
 
         log_main = logging.getLogger()
@@ -75,7 +70,12 @@ class Train:
                 self.total_epoch_count = 0
                 self.dataset = None
                 self.top_n = 0
+                self.lookup_radius = 2
+                self.givens_search_steps = 0
+                self.search_population = 8
+                self.search_seed = None
                 self.freeze = False
+                self.decode_processes = 0
 
         cfg = Cfg()
         self.cfg = cfg
@@ -92,6 +92,10 @@ class Train:
         self.directory = directory
 
         self.top_n = cfg.top_n
+        self.lookup_radius = cfg.lookup_radius
+        self.givens_search_steps = cfg.givens_search_steps
+        self.search_population = cfg.search_population
+        self.search_seed = cfg.search_seed
 
         logging.info("Starting {0}...".format(name))
 
@@ -154,10 +158,10 @@ class Train:
             items_db = []
             self.and_mode = samples_comparison_method[data_dict[cfg.dataset][3]]
             self.top_n = data_dict[cfg.dataset][4]
-            self.longints = self.and_mode == 1
 
             def construct_batch_provider(items, cycled, batch_size=cfg.batch_size):
-                return batch_provider.BatchProvider(batch_size, items, cycled=cycled, lmdb_file=lmdb_file)
+                return batch_provider.BatchProvider(batch_size, items, cycled=cycled, lmdb_file=lmdb_file,
+                                                    processes=cfg.decode_processes)
 
             self.BatchProviderConstructor = construct_batch_provider
 
@@ -261,22 +265,27 @@ class Train:
 
 
             l_pregen, b_pregen = gen_hashes(model.t_images, model.prob, model.net['pool5'], session, items_train,
-                                          self.BatchProviderConstructor, longints=self.longints)
+                                          self.BatchProviderConstructor)
             l_pregen2, b_pregen2 = gen_hashes(model.t_images, model.prob, model.net['pool5'], session, items_train,
-                                          self.BatchProviderConstructor, longints=self.longints)
+                                          self.BatchProviderConstructor)
             l_pregen3, b_pregen3 = gen_hashes(model.t_images, model.prob, model.net['pool5'], session, items_train,
-                                          self.BatchProviderConstructor, longints=self.longints)
+                                          self.BatchProviderConstructor)
+
+            # Label bitsets are kept whole, class labels are taken out of [count, 1] array
+            def label(l, x):
+                return l[x] if self.and_mode else l[x][0]
 
-            items_pregen = [(l_pregen[x][0], b_pregen[x]) for x in range(l_pregen.shape[0])]
-            items_pregen += [(l_pregen2[x][0], b_pregen2[x]) for x in range(l_pregen2.shape[0])]
-            items_pregen += [(l_pregen3[x][0], b_pregen3[x]) for x in range(l_pregen3.shape[0])]
+            items_pregen = [(label(l_pregen, x), b_pregen[x]) for x in range(l_pregen.shape[0])]
+            items_pregen += [(label(l_pregen2, x), b_pregen2[x]) for x in range(l_pregen2.shape[0])]
+            items_pregen += [(label(l_pregen3, x), b_pregen3[x]) for x in range(l_pregen3.shape[0])]
 
             bp = self.BatchProviderConstructor(items_pregen, True, batch_size= 3 * cfg.batch_size // 4)
             batches = bp.get_batches()
 
             batch = next(batches)
             hard_triplets_l = batch["labels"][:cfg.batch_size // 4]
-            hard_triplets_im = batch["images"][:cfg.batch_size // 4]
+            # Copy, as the batch buffer is reused for the next batches
+            hard_triplets_im = np.array(batch["images"][:cfg.batch_size // 4])
 
             for i in range(start_step, int(cfg.total_epoch_count * num_batches_per_epoch)):
                 feed_dict = next(batches)
@@ -285,14 +294,14 @@ class Train:
                 images = feed_dict["images"]
 
                 labels = hard_triplets_l + labels
-                images = hard_triplets_im + images
+                images = np.concatenate([hard_triplets_im, images])
 
-                if self.and_mode == 1:
-                    labels = np.asarray(labels, np.object)
+                if self.and_mode == 1 or self.and_mode == 2:
+                    labels = to_bitsets(labels)
                 else:
                     labels = np.asarray(labels, np.uint32)
 
-                indices_q, indices_p, indices_n = gen_triplets(np.reshape(labels, [-1]), self.and_mode, triplet_count)
+                indices_q, indices_p, indices_n = gen_triplets(labels if self.and_mode else np.reshape(labels, [-1]), self.and_mode, triplet_count)
 
                 summary, _, E = session.run(
                     [merged, fcn_train_step, model.E],
@@ -357,6 +366,8 @@ class Train:
         self.RotationITQ(directory)
         self.RotationSITQ(directory)
         self.RotationRandomSearch(directory)
+        if self.givens_search_steps > 0:
+            self.RotationGivensSearch(directory)
 
         with open(os.path.join(directory, "Done.txt"), "a") as file:
             file.write("\n")
@@ -374,14 +385,14 @@ class Train:
         self.logger.info("Start generating hashes")
 
         self.l_train, self.b_train = gen_hashes(model.t_images, model.prob,
-                                                model.output, session, items_train, self.BatchProviderConstructor, longints=self.longints)
+                                                model.output, session, items_train, self.BatchProviderConstructor)
 
         self.l_test, self.b_test = gen_hashes(model.t_images, model.prob,
-                                              model.output, session, items_test, self.BatchProviderConstructor, longints=self.longints)
+                                              model.output, session, items_test, self.BatchProviderConstructor)
 
         if len(items_db) > 0:
             self.l_db, self.b_db = gen_hashes(model.t_images, model.prob,
-                                              model.output, session, items_db, self.BatchProviderConstructor, longints=self.longints)
+                                              model.output, session, items_db, self.BatchProviderConstructor)
         else:
             self.l_db, self.b_db = self.l_train, self.b_train
 
@@ -405,8 +416,7 @@ class Train:
             H = H[idx,:]
 
         if self.and_mode == 1 or self.and_mode == 2:
-            S = np.bitwise_and(np.reshape(labels, [size, 1]),
-                               np.reshape(labels, [1, size])).astype(dtype=np.bool)
+            S = relevance(labels, labels)
         else:
             S = np.equal(np.reshape(labels, [size, 1]), np.reshape(labels, [1, size]))
 
@@ -471,8 +481,7 @@ class Train:
             H = H[idx,:]
 
         if self.and_mode == 1 or self.and_mode == 2:
-            S = np.bitwise_and(np.reshape(labels, [size, 1]),
-                               np.reshape(labels, [1, size])).astype(dtype=np.bool)
+            S = relevance(labels, labels)
         else:
             S = np.equal(np.reshape(labels, [size, 1]), np.reshape(labels, [1, size]))
 
@@ -495,14 +504,14 @@ class Train:
         self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "SITQ")
         return
 
-    def RotationRandomSearch(self, directory):
-        self.logger.info("Starting RandomSearch rotations")
+    def SearchSets(self):
+        """DB and query sets sampled from train set, on which rotation searches are evaluated"""
         labels = np.array(self.l_train)
         H = self.b_train.astype(np.float32)
 
         size = labels.shape[0]
 
-        idx = np.random.permutation(size)
+        idx = np.random.RandomState(self.search_seed).permutation(size)
 
         labels_q = labels
         labels_db = labels
@@ -526,63 +535,44 @@ class Train:
 
         print("DB size: %d Query set size: %d" % (H_db.shape[0], H_q.shape[0]))
 
-        R = np.eye(self.cfg.hash_size, self.cfg.hash_size, dtype=np.float32)
+        return H_db, H_q, labels_db, labels_q
+
+    def RotationRandomSearch(self, directory):
+        self.logger.info("Starting RandomSearch rotations")
+        H_db, H_q, labels_db, labels_q = self.SearchSets()
 
-        mapd0 = compute_map_fast(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode == 1, weighted_mode = self.and_mode == 2)
-        step = 1.0
+        R, mapd = random_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode == 1,
+                                         weighted_mode=self.and_mode == 2, top_n=self.top_n,
+                                         population=self.search_population, seed=self.search_seed)
 
-        worker_count = 1
-        steps = int(800 / worker_count)
-        results = [(0, np.eye(self.cfg.hash_size, self.cfg.hash_size, dtype=np.float32)) for i in range(worker_count)]
+        b_train_r = np.matmul(self.b_train, R)
+        b_test_r = np.matmul(self.b_test, R)
+        b_db_r = np.matmul(self.b_db, R)
+        self.logger.info("Finished rotations")
 
-        for i in range(steps):
-            step = (steps - i) / steps
+        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "RandomSearch")
+        return
 
-            def ComputeNewValue(w):
-                rBasis = random_rotation(self.cfg.hash_size).astype(np.float32)
-                if random() > 0.5:
-                    s = step
-                else:
-                    s = -step
-
-                deltaR = np.matmul(rBasis.T, np.matmul(GetBaseRotation(s, self.cfg.hash_size), rBasis))
-                newR = np.matmul(R, deltaR)
-                rotated_data = np.matmul(H_db, newR)
-                rotated_data_q = np.matmul(H_q, newR)
-                mapd1 = compute_map_fast(rotated_data, rotated_data_q, labels_db, labels_q, and_mode=self.and_mode == 1,weighted_mode = self.and_mode == 2)
-                results[w] = (mapd1, newR)
-
-            threads = []
-            for w in range(worker_count):
-                t = threading.Thread(target=ComputeNewValue, args=(w,))
-                threads.append(t)
-                t.start()
-
-            for t in threads:
-                t.join()
-
-            updated = False
-            for w in range(worker_count):
-                #print("%f " % results[w][0], end='')
-                if results[w][0] > mapd0:
-                    R = results[w][1]
-                    mapd0 = results[w][0]
-                    updated = True
-            print("")
-            if updated:
-                print("++++++++++++++ %f ++++++++++++++++" % mapd0)
+    def RotationGivensSearch(self, directory):
+        self.logger.info("Starting GivensSearch rotations")
+        H_db, H_q, labels_db, labels_q = self.SearchSets()
+
+        R, mapd = givens_rotation_search(H_db, H_q, labels_db, labels_q, and_mode=self.and_mode == 1,
+                                         weighted_mode=self.and_mode == 2, top_n=self.top_n,
+                                         steps=self.givens_search_steps)
+        print("++++++++++++++ %f ++++++++++++++++" % mapd)
 
         b_train_r = np.matmul(self.b_train, R)
         b_test_r = np.matmul(self.b_test, R)
         b_db_r = np.matmul(self.b_db, R)
         self.logger.info("Finished rotations")
 
-        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "RandomSearch")
+        self.eval(directory, self.l_train, b_train_r, self.l_test, b_test_r, self.l_db, b_db_r, "GivensSearch")
         return
 
     def eval(self, directory, l_train, b_train, l_test, b_test, l_db, b_db, prefix="No rotation"):
         self.logger.info("Starting evaluation")
-        map_train, map_test, curve = evaluate(
+        map_train, map_test, curve, radius_metrics = evaluate(
               l_train
             , b_train
             , l_test
@@ -591,10 +581,13 @@ class Train:
             , b_db
             , top_n=self.top_n
             , and_mode=self.and_mode == 1
-            , force_slow=True
-            , weighted_mode = self.and_mode == 2)
+            , weighted_mode = self.and_mode == 2
+            , radius=self.lookup_radius)
 
         report_string = prefix + ": Test on train: {0}; Test on test: {1}".format(map_train, map_test)
+        if radius_metrics is not None:
+            report_string += "; Lookup within radius {0}: precision: {1}; recall: {2}; mean candidates: {3}".format(
+                self.lookup_radius, *radius_metrics)
 
         with open(os.path.join(directory, "results.txt"), "a") as file:
             file.write(report_string + "\n")
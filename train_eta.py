@@ -15,6 +15,8 @@ import constructor
 import loss_functions
 from evaluate_performance import evaluate
 from gen_hashes import gen_hashes
+from utils.label_bitsets import relevance
+from utils.label_bitsets import to_bitsets
 
 import matplotlib.pyplot as plt
 
@@ -242,13 +244,12 @@ class Train:
                 labels = feed_dict["labels"]
 
                 if self.and_mode:
-                    labels = np.asarray(labels, np.object)
+                    labels = to_bitsets(labels)
                 else:
                     labels = np.asarray(labels, np.uint32)
 
                 if self.and_mode:
-                    mask = np.bitwise_and(np.reshape(labels, [cfg.batch_size, 1]),
-                                          np.reshape(labels, [1, cfg.batch_size])).astype(dtype=np.bool)
+                    mask = relevance(labels, labels)
                 else:
                     mask = np.equal(np.reshape(labels, [cfg.batch_size, 1]), np.reshape(labels, [1, cfg.batch_size]))
 
@@ -335,17 +336,15 @@ class Train:
 
         self.logger.info("Start generating hashes")
 
-        longints = self.and_mode
-
         self.l_train, self.b_train = gen_hashes(model.t_images, model.t_labels,
-                                       model.output, session, items_train, hash_size, longints=longints, imagenet=self.cfg.dataset == "imagenet")
+                                       model.output, session, items_train, hash_size, imagenet=self.cfg.dataset == "imagenet")
 
         self.l_test, self.b_test = gen_hashes(model.t_images, model.t_labels,
-                                       model.output, session, items_test, hash_size, 1, longints=longints, imagenet=self.cfg.dataset == "imagenet")
+                                       model.output, session, items_test, hash_size, 1, imagenet=self.cfg.dataset == "imagenet")
 
         if len(items_db) > 0:
             self.l_db, self.b_db = gen_hashes(model.t_images, model.t_labels,
-                                       model.output, session, items_db, hash_size, longints=longints, imagenet=self.cfg.dataset == "imagenet")
+                                       model.output, session, items_db, hash_size, imagenet=self.cfg.dataset == "imagenet")
         else:
             self.l_db, self.b_db = self.l_train, self.b_train
 
@@ -369,8 +368,7 @@ class Train:
             H = H[idx,:]
 
         if self.and_mode:
-            S = np.bitwise_and(np.reshape(labels, [size, 1]),
-                               np.reshape(labels, [1, size])).astype(dtype=np.bool)
+            S = relevance(labels, labels)
         else:
             S = np.equal(np.reshape(labels, [size, 1]), np.reshape(labels, [1, size]))
 
@@ -390,7 +388,7 @@ class Train:
 
     def eval(self, directory, l_train, b_train, l_test, b_test, l_db, b_db, eta=None):
         self.logger.info("Starting evaluation")
-        map_train, map_test, curve = evaluate(
+        map_train, map_test, curve, _ = evaluate(
               l_train
             , b_train
             , l_test
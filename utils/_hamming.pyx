@@ -17,6 +17,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
 
 #cdef extern from "intrin.h":
 #    np.uint32_t __popcnt(np.uint32_t value);
@@ -24,108 +25,209 @@ cimport cython
 cdef extern int __builtin_popcount(unsigned int) nogil
 cdef extern int __builtin_popcountll(unsigned long long) nogil
 
-cdef inline np.int8_t __hamming_distance32(np.uint32_t x, np.uint32_t y):
-    cdef np.uint32_t val = x ^ y
-    return __builtin_popcount(val)
+# Tile sizes of the blocked kernels. A tile of DB_BLOCK_WORDS packed words of the second set is kept in L1
+# while a block of QUERY_BLOCK rows of the first set is compared against it
+cdef enum:
+    QUERY_BLOCK = 32
+    DB_BLOCK_WORDS = 2048
+
+ctypedef fused dist_t:
+    np.uint8_t
+    np.uint16_t
 
-cdef inline np.int8_t __hamming_distance64(np.uint64_t x, np.uint64_t y):
-    cdef np.uint64_t val = x ^ y
-    return __builtin_popcountll(val)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef np.uint32_t[::1] __to_int32_hashes(np.ndarray[np.float32_t, ndim=2] p):
+@cython.cdivision(True)
+cdef np.uint64_t[:, ::1] __to_words_hashes(np.ndarray[np.float32_t, ndim=2] p, np.intp_t words):
     cdef np.intp_t w = p.shape[1]
     cdef np.intp_t h = p.shape[0]
-    cdef np.uint32_t output = 0
-    cdef np.uint32_t power = 1
     cdef np.float32_t[:, ::1] p_v = p;
+    cdef np.intp_t x, y
 
-    cdef np.uint32_t[::1] out = np.zeros(h, dtype=np.uint32)
+    cdef np.uint64_t[:, ::1] out = np.zeros([h, words], dtype=np.uint64)
     for x in range(h):
-        output = 0
-        power = 1
         for y in range(w):
-            output += power if p_v[x, y] > 0.0 else 0
-            power *= 2
-        out[x] = output
+            if p_v[x, y] > 0.0:
+                out[x, y // 64] |= (<np.uint64_t>1) << (y % 64)
     return out
 
 
+cdef inline np.intp_t __db_block(np.intp_t words) noexcept nogil:
+    return DB_BLOCK_WORDS // words if words < DB_BLOCK_WORDS else 1
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef np.uint64_t[::1] __to_int64_hashes(np.ndarray[np.float32_t, ndim=2] p):
-    cdef np.intp_t w = p.shape[1]
-    cdef np.intp_t h = p.shape[0]
-    cdef np.uint64_t output = 0
-    cdef np.uint64_t power = 1
-    cdef np.float32_t[:, ::1] p_v = p;
+@cython.cdivision(True)
+cdef void __hamming_tiled(const np.uint64_t[:, ::1] p1, const np.uint64_t[:, ::1] p2, dist_t[:, ::1] out) noexcept nogil:
+    cdef np.intp_t l1 = p1.shape[0]
+    cdef np.intp_t l2 = p2.shape[0]
+    cdef np.intp_t words = p1.shape[1]
+    cdef np.intp_t db_block = __db_block(words)
+    cdef np.intp_t blocks2 = (l2 + db_block - 1) // db_block
+    cdef np.intp_t blocks = (l1 + QUERY_BLOCK - 1) // QUERY_BLOCK * blocks2
+    cdef np.intp_t tile, x, y, k, x0, x1, y0, y1
+    cdef int d
+
+    for tile in prange(blocks, schedule='dynamic'):
+        x0 = tile // blocks2 * QUERY_BLOCK
+        y0 = tile % blocks2 * db_block
+        x1 = min(x0 + QUERY_BLOCK, l1)
+        y1 = min(y0 + db_block, l2)
+        if words == 1:
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    out[x, y] = <dist_t>__builtin_popcountll(p1[x, 0] ^ p2[y, 0])
+        else:
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    d = 0
+                    for k in range(words):
+                        d = d + __builtin_popcountll(p1[x, k] ^ p2[y, k])
+                    out[x, y] = <dist_t>d
 
-    cdef np.uint64_t[::1] out = np.zeros(h, dtype=np.uint64)
-    for x in range(h):
-        output = 0
-        power = 1
-        for y in range(w):
-            if p_v[x, y] > 0.0:
-                output += power
-            power *= 2
-        out[x] = output
-    return out
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def calc_hamming_dist(b1, b2):
-    """Compute the hamming distance between every pair of data points represented in each row of b1 and b2"""
-    cdef np.uint32_t[::1] p1 = __to_int32_hashes(b1)
-    cdef np.uint32_t[::1] p2 = __to_int32_hashes(b2)
-
+@cython.cdivision(True)
+cdef void __hamming_radius(const np.uint64_t[:, ::1] p1, const np.uint64_t[:, ::1] p2, int radius,
+                           np.int64_t[::1] pos, np.int32_t[::1] indices, dist_t[::1] dists, bint fill) noexcept nogil:
+    """Walks pairs within the radius. Counts them per row of p1 into pos, or, if fill is set,
+    writes them starting at pos. Blocks of rows of p1 are owned by a single thread, so the rows are filled in order"""
     cdef np.intp_t l1 = p1.shape[0]
     cdef np.intp_t l2 = p2.shape[0]
+    cdef np.intp_t words = p1.shape[1]
+    cdef np.intp_t db_block = __db_block(words)
+    cdef np.intp_t blocks1 = (l1 + QUERY_BLOCK - 1) // QUERY_BLOCK
+    cdef np.intp_t blocks2 = (l2 + db_block - 1) // db_block
+    cdef np.intp_t block, block2, x, y, k, x0, x1, y0, y1
+    cdef int d
 
-    cdef np.ndarray[np.int8_t, ndim=2] out = np.zeros([l1, l2], dtype=np.int8)
-    cdef np.int8_t[:, ::1] out_v = out;
+    for block in prange(blocks1, schedule='dynamic'):
+        x0 = block * QUERY_BLOCK
+        x1 = min(x0 + QUERY_BLOCK, l1)
+        for block2 in range(blocks2):
+            y0 = block2 * db_block
+            y1 = min(y0 + db_block, l2)
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    if words == 1:
+                        d = __builtin_popcountll(p1[x, 0] ^ p2[y, 0])
+                    else:
+                        d = 0
+                        for k in range(words):
+                            d = d + __builtin_popcountll(p1[x, k] ^ p2[y, k])
+                    if d <= radius:
+                        if fill:
+                            indices[pos[x]] = <np.int32_t>y
+                            dists[pos[x]] = <dist_t>d
+                        pos[x] = pos[x] + 1
 
-    cdef np.int8_t d = 0
-    cdef np.int8_t dist = 0
-    cdef np.uint32_t val = 0
 
-    for x in range(l1):
-        for y in range(l2):
-            out_v[x, y] = __hamming_distance32(p1[x], p2[y])
+def pack_hashes(b):
+    """Pack signs of the rows of b into 64bit words. Returns uint64 array of shape [rows, (bits + 63) // 64]"""
+    b = np.ascontiguousarray(b, dtype=np.float32)
+    return np.asarray(__to_words_hashes(b, (b.shape[1] + 63) // 64))
+
 
+def calc_hamming_dist_packed(p1, p2, bits):
+    """Compute the hamming distance between every pair of packed hashes in rows of p1 and p2.
+    Output is uint8 for hashes shorter than 256 bits and uint16 otherwise"""
+    cdef const np.uint64_t[:, ::1] p1_v = np.ascontiguousarray(p1, dtype=np.uint64)
+    cdef const np.uint64_t[:, ::1] p2_v = np.ascontiguousarray(p2, dtype=np.uint64)
+    cdef np.uint8_t[:, ::1] out8
+    cdef np.uint16_t[:, ::1] out16
+
+    if p1_v.shape[1] != p2_v.shape[1]:
+        raise ValueError("Hashes have different number of words")
+
+    if bits < 256:
+        out = np.empty([p1_v.shape[0], p2_v.shape[0]], dtype=np.uint8)
+        out8 = out
+        __hamming_tiled(p1_v, p2_v, out8)
+    else:
+        out = np.empty([p1_v.shape[0], p2_v.shape[0]], dtype=np.uint16)
+        out16 = out
+        __hamming_tiled(p1_v, p2_v, out16)
     return out
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def calc_hamming_dist64(b1, b2):
+
+def calc_hamming_dist_radius_packed(p1, p2, bits, int radius):
+    """Find all pairs of packed hashes in rows of p1 and p2 with hamming distance not greater than radius.
+    Returns (indptr, indices, dist) in CSR layout: neighbours of row x of p1 are indices[indptr[x]:indptr[x + 1]]
+    in increasing order, their distances are dist[indptr[x]:indptr[x + 1]]"""
+    cdef const np.uint64_t[:, ::1] p1_v = np.ascontiguousarray(p1, dtype=np.uint64)
+    cdef const np.uint64_t[:, ::1] p2_v = np.ascontiguousarray(p2, dtype=np.uint64)
+    cdef np.int64_t[::1] pos
+    cdef np.int32_t[::1] indices_v
+    cdef np.uint8_t[::1] dist8
+    cdef np.uint16_t[::1] dist16
+
+    if p1_v.shape[1] != p2_v.shape[1]:
+        raise ValueError("Hashes have different number of words")
+
+    dist_type = np.uint8 if bits < 256 else np.uint16
+    indices = np.zeros([0], dtype=np.int32)
+    dist = np.zeros([0], dtype=dist_type)
+
+    count = np.zeros([p1_v.shape[0]], dtype=np.int64)
+    pos = count
+    indices_v = indices
+    if bits < 256:
+        dist8 = dist
+        __hamming_radius(p1_v, p2_v, radius, pos, indices_v, dist8, False)
+    else:
+        dist16 = dist
+        __hamming_radius(p1_v, p2_v, radius, pos, indices_v, dist16, False)
+
+    indptr = np.zeros([p1_v.shape[0] + 1], dtype=np.int64)
+    np.cumsum(count, out=indptr[1:])
+    pos = indptr[:-1].copy()
+
+    indices = np.empty([indptr[-1]], dtype=np.int32)
+    dist = np.empty([indptr[-1]], dtype=dist_type)
+
+    indices_v = indices
+    if bits < 256:
+        dist8 = dist
+        __hamming_radius(p1_v, p2_v, radius, pos, indices_v, dist8, True)
+    else:
+        dist16 = dist
+        __hamming_radius(p1_v, p2_v, radius, pos, indices_v, dist16, True)
+
+    return indptr, indices, dist
+
+
+def calc_hamming_dist(b1, b2):
     """Compute the hamming distance between every pair of data points represented in each row of b1 and b2"""
-    cdef np.uint64_t[::1] p1 = __to_int64_hashes(b1)
-    cdef np.uint64_t[::1] p2 = __to_int64_hashes(b2)
+    return calc_hamming_dist_packed(pack_hashes(b1), pack_hashes(b2), b1.shape[1])
 
-    cdef np.intp_t l1 = p1.shape[0]
-    cdef np.intp_t l2 = p2.shape[0]
 
-    cdef np.ndarray[np.int8_t, ndim=2] out = np.zeros([l1, l2], dtype=np.int8)
-    cdef np.int8_t[:, ::1] out_v = out;
+# Hashes of any length are packed to 64 bit words, kept for compatibility
+calc_hamming_dist64 = calc_hamming_dist
 
-    for x in range(l1):
-        for y in range(l2):
-            out_v[x, y] = __hamming_distance64(p1[x], p2[y])
 
-    return out
+def calc_hamming_dist_radius(b1, b2, radius):
+    """Same as calc_hamming_dist_radius_packed, but takes unpacked hashes"""
+    return calc_hamming_dist_radius_packed(pack_hashes(b1), pack_hashes(b2), b1.shape[1], radius)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def sort(a):
-    cdef np.int8_t[:, ::1] a_v = a;
+def sort(dist_t[:, ::1] a, bits=None):
+    """Counting sort of the rows of distance matrix returned by calc_hamming_dist. bits is the hash length, that
+    bounds the distances, if not given, it is taken from the largest distance"""
     cdef np.intp_t l1 = a.shape[0]
     cdef np.intp_t l2 = a.shape[1]
+    if bits is None:
+        bits = np.asarray(a).max() if a.size > 0 else 0
+    cdef np.intp_t buckets = bits + 1
 
-    cdef np.int32_t[65] count
+    cdef np.int32_t[::1] count = np.zeros([buckets], dtype=np.int32)
     cdef np.int32_t total
     cdef np.int32_t old_count
-    cdef np.int8_t key
+    cdef dist_t key
 
     cdef np.ndarray[np.int32_t, ndim=2] out = np.zeros([l1, l2], dtype=np.int32)
     cdef np.int32_t[:, ::1] out_v = out;
@@ -133,19 +235,19 @@ def sort(a):
     cdef np.int32_t[::1] tmp = np.zeros([l2], dtype=np.int32)
 
     for x in range(l1):
-        for i in range(65):
+        for i in range(buckets):
             count[i] = 0
         for y in range(l2):
-            count[a_v[x, y]] += 1
+            count[a[x, y]] += 1
         total = 0
         old_count = 0
-        for i in range(65):
+        for i in range(buckets):
             old_count = count[i]
             count[i] = total
             total += old_count
 
         for y in range(l2):
-            key = a_v[x, y]
+            key = a[x, y]
             tmp[y] = count[key]
             count[key] += 1
 
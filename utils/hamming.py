@@ -31,8 +31,8 @@ has_cython = True
 #@timer
 def calc_hamming_dist(b1, b2):
     """Compute the hamming distance between every pair of data points represented in each row of b1 and b2"""
-    p1 = np.sign(b1).astype(np.int8)
-    p2 = np.sign(b2).astype(np.int8)
+    p1 = np.sign(b1).astype(np.int8 if b1.shape[1] < 64 else np.int16)
+    p2 = np.sign(b2).astype(np.int8 if b2.shape[1] < 64 else np.int16)
 
     r = p1.shape[1]
     d = (r - np.matmul(p1, np.transpose(p2))) // 2
@@ -43,12 +43,9 @@ def calc_hamming_dist(b1, b2):
 def calc_hamming_rank(b1, b2, force_slow=False):
     """Return rank of pairs. Takes vector of hashes b1 and b2 and returns correspondence rank of b1 to b2
     """
-    if has_cython and b1.shape[1] < 33 and not force_slow:
-        dist_h = _hamming.calc_hamming_dist64(b2, b1)
-        return _hamming.sort(dist_h)
-    elif has_cython and b1.shape[1] < 65 and not force_slow:
-        dist_h = _hamming.calc_hamming_dist64(b2, b1)
-        return _hamming.sort(dist_h)
+    if has_cython and not force_slow:
+        dist_h = _hamming.calc_hamming_dist(b2, b1)
+        return _hamming.sort(dist_h, b1.shape[1])
     else:
         print("Warning. Using slow \"calc_hamming_dist\"")
         dist_h = calc_hamming_dist(b2, b1)
@@ -77,3 +74,33 @@ if __name__ == '__main__':
     d2 = calc_hamming_rank(b1, b2, force_slow=True)
 
     print("Passed!" if (d1 == d2).all() else "Failed!")
+
+    b1 = np.random.rand(300, 120).astype(np.float32) - 0.5
+    b2 = np.random.rand(400, 120).astype(np.float32) - 0.5
+
+    d1_ = _hamming.calc_hamming_dist(b2, b1)
+    d2_ = calc_hamming_dist(b2, b1)
+    print("Passed!" if (d1_ == d2_).all() else "Failed!")
+
+    d1 = calc_hamming_rank(b1, b2)
+    d2 = calc_hamming_rank(b1, b2, force_slow=True)
+
+    print("Passed!" if (d1 == d2).all() else "Failed!")
+
+    b1 = np.random.rand(300, 300).astype(np.float32) - 0.5
+    b2 = np.random.rand(400, 300).astype(np.float32) - 0.5
+
+    d1_ = _hamming.calc_hamming_dist(b2, b1)
+    d2_ = calc_hamming_dist(b2, b1)
+    print("Passed!" if (d1_ == d2_).all() else "Failed!")
+
+    for bits, radius in [(48, 18), (300, 140)]:
+        b1 = np.random.rand(300, bits).astype(np.float32) - 0.5
+        b2 = np.random.rand(400, bits).astype(np.float32) - 0.5
+
+        indptr, indices, dist = _hamming.calc_hamming_dist_radius(b2, b1, radius)
+        d2_ = calc_hamming_dist(b2, b1)
+        rows, cols = np.nonzero(d2_ <= radius)
+        passed = (np.diff(indptr) == np.bincount(rows, minlength=d2_.shape[0])).all()
+        passed = passed and (indices == cols).all() and (dist == d2_[rows, cols]).all()
+        print("Passed!" if passed else "Failed!")
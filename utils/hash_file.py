@@ -0,0 +1,121 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Binary file of packed hashes and labels, that is memory-mapped on reading.
+
+All numbers are little-endian. The file starts with a header of HEADER_SIZE bytes:
+    magic        8 bytes, b'SDSHHASH'
+    version      uint32
+    bits         uint32, length of hashes
+    count        uint64, number of hashes
+    label_width  uint32, bytes of label per hash: 0 - no labels, 4 - uint32 labels, 8 * W - bitsets of W 64bit words
+The header is followed by hashes, uint64 array of shape [count, (bits + 63) // 64]. Bit i of a hash is bit i % 64 of
+word i // 64, the same packing that HashRankingContext uses. Labels start at the next offset aligned to 64 bytes.
+uint32 labels are an array of shape [count], bitsets are stored word-major, as an array of shape [W, count].
+"""
+
+import struct
+import numpy as np
+
+try:
+    from utils.hamming import _hamming
+    from utils.label_bitsets import to_bitsets
+except:
+    from hamming import _hamming
+    from label_bitsets import to_bitsets
+
+MAGIC = b'SDSHHASH'
+VERSION = 1
+HEADER_SIZE = 64
+ALIGNMENT = 64
+
+_header = struct.Struct('<8sIIQI')
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_hashes(path, hashes, labels=None, bitset_labels=False):
+    """Pack hashes and write them to path together with labels. Hashes are an array of shape [count, bits], bits
+    are set for positive values. If bitset_labels is set, labels are bitsets of utils.label_bitsets or integers of
+    any length, otherwise they are uint32 class labels or tags"""
+    packed = _hamming.pack_hashes(hashes).astype('<u8')
+    count = packed.shape[0]
+
+    if labels is None:
+        labels_data = None
+        label_width = 0
+    elif bitset_labels:
+        labels_data = to_bitsets(labels).T.astype('<u8')
+        label_width = 8 * labels_data.shape[0]
+    else:
+        labels_data = np.asarray(labels).reshape(-1).astype('<u4')
+        label_width = 4
+
+    if labels_data is not None and labels_data.shape[-1] != count:
+        raise ValueError("Number of labels does not match number of hashes")
+
+    with open(path, 'wb') as f:
+        header = _header.pack(MAGIC, VERSION, hashes.shape[1], count, label_width)
+        f.write(header + b'\0' * (HEADER_SIZE - len(header)))
+        f.write(packed.tobytes())
+        if labels_data is not None:
+            f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+            f.write(labels_data.tobytes())
+
+
+class HashFile:
+    """Hashes and labels of a file written by save_hashes. Arrays are read-only views of the memory-mapped file,
+    so opening does not depend on the size of the file and the pages are shared between processes"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not a hash file".format(path))
+        _, version, bits, count, label_width = _header.unpack_from(header)
+        if version != VERSION:
+            raise ValueError("Unsupported hash file version {0}".format(version))
+
+        self.bits = bits
+        self.count = count
+        self.words = (bits + 63) // 64
+        self.label_width = label_width
+
+        self.hashes = self.__map(path, '<u8', HEADER_SIZE, (count, self.words))
+
+        labels_offset = _aligned(HEADER_SIZE + 8 * count * self.words)
+        if label_width == 0:
+            self.labels = None
+        elif label_width == 4:
+            self.labels = self.__map(path, '<u4', labels_offset, (count,))
+        elif label_width % 8 == 0:
+            self.labels = self.__map(path, '<u8', labels_offset, (label_width // 8, count))
+        else:
+            raise ValueError("Unsupported label width {0}".format(label_width))
+
+    @property
+    def bitset_labels(self):
+        return self.label_width % 8 == 0 and self.label_width > 0
+
+    @staticmethod
+    def __map(path, dtype, offset, shape):
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    def unpack(self):
+        """Return hashes as float32 array of shape [count, bits] of +1 and -1"""
+        bits = np.unpackbits(self.hashes.view(np.uint8).reshape(self.count, -1), axis=1, bitorder='little')
+        return bits[:, :self.bits].astype(np.float32) * 2.0 - 1.0
@@ -0,0 +1,91 @@
+# Copyright 2018 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Multi-label bitsets: labels of items are an uint64 array of shape [count, words], tag t is bit t % 64 of
+word t // 64. Items are relevant to each other if they share a tag. The number of words is fixed per dataset, so
+the labels are batched and compared as plain arrays, for any number of tags.
+"""
+
+import numpy as np
+
+
+def words_for(tags):
+    """Number of words of bitsets of the given number of tags"""
+    return max(1, (tags + 63) // 64)
+
+
+def from_tags(tag_lists, words):
+    """Bitsets of shape [len(tag_lists), words] from lists of tag indices of each item"""
+    out = np.zeros([len(tag_lists), words], dtype=np.uint64)
+    lengths = [len(tags) for tags in tag_lists]
+    if sum(lengths) == 0:
+        return out
+    tags = np.concatenate([np.asarray(t, dtype=np.int64).reshape(-1) for t in tag_lists])
+    if tags.min() < 0 or tags.max() >= 64 * words:
+        raise ValueError("Tags must be in range [0, {0})".format(64 * words))
+    rows = np.repeat(np.arange(len(tag_lists)), lengths)
+    np.bitwise_or.at(out, (rows, tags // 64), np.left_shift(np.uint64(1), (tags % 64).astype(np.uint64)))
+    return out
+
+
+def to_tags(bitset):
+    """Indices of the tags set in a bitset of shape [words]"""
+    bits = np.unpackbits(np.asarray(bitset, dtype='<u8').view(np.uint8), bitorder='little')
+    return np.flatnonzero(bits)
+
+
+def to_bitsets(labels, words=None):
+    """Convert labels to bitsets of the given number of words, by default as many as the labels take. Labels are
+    bitsets, an array of shape [count, words], or tag masks, unsigned integers of shape [count] or [count, 1],
+    including Python ints of any length in an object array"""
+    labels = np.asarray(labels)
+    if labels.dtype == np.uint64 and labels.ndim == 2:
+        bitsets = labels
+    elif labels.dtype == object:
+        values = [int(l) for l in labels.reshape(-1)]
+        n = max([1] + [(l.bit_length() + 63) // 64 for l in values])
+        bitsets = np.zeros([len(values), n], dtype=np.uint64)
+        for k in range(n):
+            bitsets[:, k] = [(l >> (64 * k)) & 0xFFFFFFFFFFFFFFFF for l in values]
+    else:
+        bitsets = labels.reshape(-1, 1).astype(np.uint64)
+
+    if words is None:
+        words = bitsets.shape[1]
+    if bitsets.shape[1] > words:
+        if np.any(bitsets[:, words:]):
+            raise ValueError("Labels do not fit {0} words".format(words))
+        bitsets = bitsets[:, :words]
+    elif bitsets.shape[1] < words:
+        bitsets = np.pad(bitsets, ((0, 0), (0, words - bitsets.shape[1])), 'constant')
+    return np.ascontiguousarray(bitsets)
+
+
+def relevance(a, b):
+    """Boolean matrix of shape [len(a), len(b)], True where bitsets of a and b share a tag"""
+    a = to_bitsets(a)
+    b = to_bitsets(b)
+    words = min(a.shape[1], b.shape[1])
+    mask = np.zeros([a.shape[0], b.shape[0]], dtype=np.bool_)
+    for k in range(words):
+        mask |= np.bitwise_and(a[:, k, None], b[None, :, k]) != 0
+    return mask
+
+
+def relevance_pairs(a, b):
+    """Same as relevance, but for pairs of items a[i], b[i]. Returns boolean array of shape [len(a)]"""
+    a = to_bitsets(a)
+    b = to_bitsets(b)
+    words = min(a.shape[1], b.shape[1])
+    return np.any(np.bitwise_and(a[:, :words], b[:, :words]) != 0, axis=1)
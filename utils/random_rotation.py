@@ -17,8 +17,8 @@
 import numpy as np
 
 
-def random_rotation(size):
+def random_rotation(size, rng=np.random):
     shape = [size, size]
-    a = np.random.normal(-1.0, 1.0, shape)
+    a = rng.normal(-1.0, 1.0, shape)
     u, s, v = np.linalg.svd(a, full_matrices=False)
     return u